@@ -0,0 +1,473 @@
+import asyncio
+import base64
+import os
+import re
+import socket
+import ssl
+import time
+import itertools
+import logging
+import smtplib
+from email_sender import EmailSender
+from streaming_mime import StreamingMessage
+from smtp_pool import is_connection_error, MessageTooLargeError, NOOP_AFTER_IDLE_SECONDS, BDAT_WINDOW
+from metrics import registry
+
+_connection_ids = itertools.count(1)
+
+_EOL_RE = re.compile(rb'(?:\r\n|\n|\r(?!\n))')
+_DOT_RE = re.compile(rb'(?m)^\.')
+
+
+def prepare_data(text):
+    """
+    Converts a message to the wire format used after DATA: CRLF line endings,
+    leading dots doubled, terminated by the end-of-data marker.
+    """
+    data = text.encode('utf-8') if isinstance(text, str) else text
+    data = _DOT_RE.sub(b'..', _EOL_RE.sub(b'\r\n', data))
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+class AsyncSMTPConnection:
+    """
+    Minimal asyncio SMTP client. Uses PIPELINING, when the server advertises
+    it, to send MAIL, RCPT and DATA in a single round-trip, and BINARYMIME
+    with CHUNKING to send streamed attachments unencoded. Errors are raised
+    as the same smtplib exception types the blocking backend produces.
+    """
+    def __init__(self, server, port, email, password, use_tls=True, use_ssl=False,
+                 max_messages=0, timeout=60, binary_mime=True):
+        self.server = server
+        self.port = port
+        self.email = email
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.binary_mime = binary_mime
+
+        self.session_id = next(_connection_ids)
+        self.reader = None
+        self.writer = None
+        self.extensions = {}
+        self.messages_sent = 0
+        self.last_used = 0.0
+
+    @property
+    def exhausted(self):
+        return bool(self.max_messages) and self.messages_sent >= self.max_messages
+
+    @property
+    def pipelining(self):
+        return 'pipelining' in self.extensions
+
+    @property
+    def max_message_size(self):
+        size = self.extensions.get('size', '').strip()
+        return int(size) if size.isdigit() else 0
+
+    @property
+    def supports_binary_mime(self):
+        return self.binary_mime and 'binarymime' in self.extensions and 'chunking' in self.extensions
+
+    async def connect(self):
+        logging.debug(f"[async session {self.session_id}] Connecting to SMTP server: "
+                      f"{self.server}:{self.port} (SSL: {self.use_ssl}, TLS: {self.use_tls})")
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        # Connecting runs up to the first EHLO reply, as in SMTPSession
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port, ssl=ssl_context), self.timeout)
+        try:
+            code, response = await self._read_reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, response)
+
+            await self._ehlo()
+            registry.observe('connect', time.perf_counter() - start)
+            if self.use_tls and not self.use_ssl:
+                with registry.timer('tls'):
+                    await self._starttls()
+                    await self._ehlo() # Re-identify after TLS
+
+            with registry.timer('auth'):
+                await self._login()
+        except BaseException:
+            self._abort()
+            raise
+        self.last_used = time.monotonic()
+        registry.count('connections')
+
+    async def is_alive(self):
+        if self.writer is None or self.writer.is_closing():
+            return False
+        if time.monotonic() - self.last_used < NOOP_AFTER_IDLE_SECONDS:
+            return True
+        try:
+            code, _ = await self._command("NOOP")
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            return False
+        self.last_used = time.monotonic()
+        return code == 250
+
+    async def sendmail(self, from_addr, recipients, message):
+        """
+        Sends one message, given as text or as a StreamingMessage. Returns the
+        dict of refused recipients, like smtplib.SMTP.sendmail.
+        """
+        binary = isinstance(message, StreamingMessage) and self.supports_binary_mime
+        if isinstance(message, StreamingMessage):
+            data = None
+            size = message.size(binary)
+        else:
+            with registry.timer('encode'):
+                data = prepare_data(message)
+            size = len(data)
+        if self.max_message_size and size > self.max_message_size:
+            raise MessageTooLargeError(size, self.max_message_size)
+        with registry.timer('data'):
+            mail_cmd = f"MAIL FROM:<{from_addr}>"
+            if 'size' in self.extensions:
+                mail_cmd += f" SIZE={size}"
+            if binary:
+                mail_cmd += " BODY=BINARYMIME"
+            rcpt_cmds = [f"RCPT TO:<{addr}>" for addr in recipients]
+
+            if self.pipelining:
+                # BDAT carries its data with it, so there is no DATA to pipeline
+                self._write_lines([mail_cmd] + rcpt_cmds + ([] if binary else ["DATA"]))
+                await self.writer.drain()
+                mail_reply = await self._read_reply()
+                rcpt_replies = [await self._read_reply() for _ in rcpt_cmds]
+                data_reply = None if binary else await self._read_reply()
+            else:
+                mail_reply = await self._command(mail_cmd)
+                if mail_reply[0] != 250:
+                    await self._rset()
+                    raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+                rcpt_replies = [await self._command(cmd) for cmd in rcpt_cmds]
+                data_reply = None
+
+            if mail_reply[0] != 250:
+                await self._abort_data(data_reply)
+                raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+
+            refused = {addr: reply for addr, reply in zip(recipients, rcpt_replies)
+                       if reply[0] not in (250, 251)}
+            if len(refused) == len(recipients):
+                await self._abort_data(data_reply)
+                raise smtplib.SMTPRecipientsRefused(refused)
+
+            if binary:
+                code, response = await self._write_bdat(message)
+            else:
+                if data_reply is None:
+                    data_reply = await self._command("DATA")
+                if data_reply[0] != 354:
+                    await self._rset()
+                    raise smtplib.SMTPDataError(data_reply[0], data_reply[1])
+
+                if data is None:
+                    await self._write_stream(message)
+                else:
+                    self.writer.write(data)
+                    await self.writer.drain()
+                code, response = await self._read_reply()
+            if code != 250:
+                if code != 421:
+                    await self._rset()
+                raise smtplib.SMTPDataError(code, response)
+
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+        registry.count('messages_sent')
+        registry.count('bytes_sent', size)
+        if binary:
+            registry.count('binary_messages')
+        return refused
+
+    async def _write_stream(self, message):
+        # Chunks are read and encoded off the event loop, one at a time, so
+        # neither disk reads nor memory use grow with the attachment size.
+        chunks = message.iter_chunks()
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            self.writer.write(chunk)
+            await self.writer.drain()
+        self.writer.write(b'.\r\n')
+        await self.writer.drain()
+
+    async def _write_bdat(self, message):
+        # Same chunking and reply window as SMTPSession._send_bdat
+        window = BDAT_WINDOW if self.pipelining else 1
+        pending = 0
+        failure = None
+        chunks = message.iter_chunks(binary=True)
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            self.writer.write(f"BDAT {len(chunk)}\r\n".encode('ascii'))
+            self.writer.write(chunk)
+            await self.writer.drain()
+            pending += 1
+            if pending >= window:
+                reply = await self._read_reply()
+                pending -= 1
+                if reply[0] != 250:
+                    failure = reply
+                    break
+        if failure is None:
+            self._write_lines(["BDAT 0 LAST"])
+            await self.writer.drain()
+            pending += 1
+        reply = None
+        while pending and not (failure and failure[0] == 421):
+            reply = await self._read_reply()
+            pending -= 1
+            if failure is None and reply[0] != 250:
+                failure = reply
+        return failure or reply
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await self._command("QUIT")
+        except Exception:
+            pass
+        self._abort()
+
+    async def _ehlo(self):
+        code, response = await self._command(f"EHLO {socket.getfqdn() or 'localhost'}")
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, response)
+        self.extensions = {}
+        for line in response.decode('latin-1').split('\n')[1:]:
+            parts = line.strip().split(None, 1)
+            if parts:
+                self.extensions[parts[0].lower()] = parts[1] if len(parts) > 1 else ''
+        logging.debug(f"EHLO response: {code} {response}")
+
+    async def _starttls(self):
+        if 'starttls' not in self.extensions:
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        if not hasattr(self.writer, 'start_tls'):
+            raise smtplib.SMTPNotSupportedError("STARTTLS with the asyncio backend requires Python 3.11 or newer.")
+        logging.debug("Starting TLS...")
+        code, response = await self._command("STARTTLS")
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, response)
+        await self.writer.start_tls(ssl.create_default_context(), server_hostname=self.server)
+
+    async def _login(self):
+        logging.debug(f"Logging in as {self.email}...")
+        mechanisms = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms or not mechanisms:
+            token = base64.b64encode(f"\0{self.email}\0{self.password}".encode()).decode()
+            code, response = await self._command(f"AUTH PLAIN {token}")
+        else:
+            code, response = await self._command("AUTH LOGIN")
+            if code == 334:
+                code, response = await self._command(base64.b64encode(self.email.encode()).decode())
+            if code == 334:
+                code, response = await self._command(base64.b64encode(self.password.encode()).decode())
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, response)
+
+    async def _rset(self):
+        try:
+            await self._command("RSET")
+        except (smtplib.SMTPServerDisconnected, OSError):
+            pass
+
+    async def _abort_data(self, data_reply):
+        # A pipelined DATA may have been accepted even though the envelope
+        # was not; end it with an empty body so the transaction is dropped.
+        if self.writer is None:
+            return
+        if data_reply is not None and data_reply[0] == 354:
+            self.writer.write(b'.\r\n')
+            await self.writer.drain()
+            await self._read_reply()
+        await self._rset()
+
+    async def _command(self, line):
+        self._write_lines([line])
+        await self.writer.drain()
+        return await self._read_reply()
+
+    def _write_lines(self, lines):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        self.writer.write(("\r\n".join(lines) + "\r\n").encode('utf-8'))
+
+    async def _read_reply(self):
+        if self.reader is None:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                self._abort()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            try:
+                code = int(line[:3])
+            except ValueError:
+                self._abort()
+                raise smtplib.SMTPServerDisconnected(f"Malformed reply: {line!r}")
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        if code == 421:
+            self._abort()
+        return code, b"\n".join(lines)
+
+    def _abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class AsyncConnectionPool:
+    """
+    asyncio counterpart of SMTPConnectionPool.
+    """
+    def __init__(self, connection_factory, max_size=1):
+        self.connection_factory = connection_factory
+        self.max_size = max(1, int(max_size))
+        self._idle = []
+        self._slots = asyncio.Semaphore(self.max_size)
+        self._closed_stats = []
+
+    async def acquire(self):
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                connection = self._idle.pop()
+                if not connection.exhausted and await connection.is_alive():
+                    return connection
+                await self._retire(connection)
+
+            connection = self.connection_factory()
+            await connection.connect()
+            return connection
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, connection, discard=False):
+        try:
+            if discard or connection.exhausted or connection.writer is None:
+                await self._retire(connection)
+            else:
+                self._idle.append(connection)
+        finally:
+            self._slots.release()
+
+    async def close_all(self):
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            await self._retire(connection)
+
+    def connection_stats(self):
+        return list(self._closed_stats)
+
+    async def _retire(self, connection):
+        await connection.close()
+        self._closed_stats.append((connection.session_id, connection.messages_sent))
+        logging.info(f"Closed SMTP session {connection.session_id} after "
+                     f"{connection.messages_sent} message(s)")
+
+
+class AsyncEmailSender:
+    """
+    asyncio sending engine. A single event loop drives up to max_connections
+    concurrent SMTP connections. Message building is shared with EmailSender.
+    """
+    def __init__(self, config_manager, max_connections=1, settings=None):
+        self.config_manager = config_manager
+        self.email_sender = EmailSender(config_manager, settings=settings)
+        self.max_connections = max_connections
+        self.pool = None
+
+    def _get_pool(self):
+        if self.pool is None:
+            settings = self.email_sender.session_settings()
+            self.pool = AsyncConnectionPool(lambda: AsyncSMTPConnection(**settings),
+                                            max_size=self.max_connections)
+        return self.pool
+
+    async def send_email(self, to_email, file_path):
+        """
+        Sends an email with the specified file as attachment. Makes a single
+        attempt; retries are scheduled by the caller (see retry_scheduler).
+        """
+        sender_email, recipients, message = await self.build_message(to_email, file_path)
+        return await self.send_message(sender_email, recipients, message, os.path.basename(file_path))
+
+    async def build_message(self, to_email, file_path):
+        """
+        Builds the message in a worker thread, so reading and encoding the
+        attachment does not stall the event loop.
+        """
+        return await asyncio.to_thread(self.email_sender.build_message, to_email, file_path)
+
+    async def server_size_limit(self):
+        """
+        Message size limit announced by the server, 0 if none.
+        """
+        pool = self._get_pool()
+        connection = await pool.acquire()
+        try:
+            return connection.max_message_size
+        finally:
+            await pool.release(connection)
+
+    async def send_message(self, sender_email, recipients, message, filename):
+        try:
+            logging.debug(f"Sending email to {recipients}...")
+            failed_recipients = await self._sendmail(sender_email, recipients, message)
+
+            if failed_recipients:
+                error_msg = f"Failed to send to some recipients: {failed_recipients}"
+                logging.error(error_msg)
+                raise smtplib.SMTPException(error_msg)
+
+            logging.info(f"Email sent successfully to {recipients} for file {filename}")
+            return True
+        except Exception as e:
+            logging.error(f"Failed to send email for {filename}: {e}")
+            raise e
+
+    async def _sendmail(self, sender_email, recipients, message):
+        pool = self._get_pool()
+        while True:
+            connection = await pool.acquire()
+            reused = connection.messages_sent > 0
+            try:
+                failed_recipients = await connection.sendmail(sender_email, recipients, message)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, MessageTooLargeError) as e:
+                await pool.release(connection, discard=is_connection_error(e))
+                raise
+            except Exception as e:
+                await pool.release(connection, discard=True)
+                if reused and is_connection_error(e):
+                    logging.info(f"SMTP session {connection.session_id} was closed by the server "
+                                 f"after {connection.messages_sent} message(s), reconnecting: {e}")
+                    continue
+                raise
+            await pool.release(connection)
+            return failed_recipients
+
+    async def close(self):
+        if self.pool is None:
+            return []
+        await self.pool.close_all()
+        return self.pool.connection_stats()
@@ -0,0 +1,1096 @@
+import os
+import time
+import shutil
+import hashlib
+import datetime
+import asyncio
+import logging
+import threading
+from email.utils import make_msgid
+from email_sender import EmailSender
+from async_email_sender import AsyncEmailSender
+from delivery_journal import DeliveryJournal, STATUS_SENT, STATUS_FAILED, normalize_recipients, file_version
+from content_index import ContentIndex, ContentHasher, delivery_key, message_id
+from retry_scheduler import RetryPolicy, RetryQueue, Delivery
+from streaming_mime import base64_size, raw_size_within
+from smtp_pool import MessageTooLargeError
+from compression import Compressor, is_compressible
+from mail_merge import MailMerge, MergeMessage
+from outbox import SpoolJob
+from rate_limiter import RateLimiter, QuotaExceeded, is_throttle_error, is_quota_error, share_limits
+from smtp_router import SMTPRouter, Relay, is_relay_error
+from directory_scanner import DirectoryScanner, SENT_DIR_NAME
+from scheduler import SendScheduler
+from metrics import registry
+
+# While the daily quota is used up, check this often whether it has reset
+QUOTA_POLL_SECONDS = 60
+
+# Headers and MIME boundaries added per message, and per attachment, when
+# checking sizes against the server's SIZE limit
+MESSAGE_OVERHEAD = 4096
+BUNDLE_PART_OVERHEAD = 512
+
+
+def list_files(directory, **scan_settings):
+    """
+    Lists the files to send in directory: regular, non-hidden files only.
+    scan_settings (see DirectoryScanner) select subfolders and patterns.
+    """
+    scanner = DirectoryScanner(directory, **scan_settings).start()
+    scanner.wait()
+    for path, error in scanner.errors:
+        if path == scanner.directory:
+            raise error
+    return scanner.files
+
+
+def move_to_sent(file_path, replace=True):
+    """
+    Moves a delivered file into the SENTEMAILS folder next to it. Without
+    replace, a file already there under the same name is kept, and
+    FileExistsError is raised instead.
+    """
+    with registry.timer('move'):
+        sent_dir = os.path.join(os.path.dirname(file_path), SENT_DIR_NAME)
+        os.makedirs(sent_dir, exist_ok=True)
+        new_path = os.path.join(sent_dir, os.path.basename(file_path))
+        if not replace and os.path.exists(new_path):
+            raise FileExistsError(f"{new_path} already exists, the file is left in place")
+        shutil.move(file_path, new_path)
+    return new_path
+
+
+def format_eta(seconds):
+    """
+    Remaining time for progress displays, e.g. "about 3 min left".
+    """
+    if seconds < 60:
+        return "less than a minute left"
+    if seconds < 3600:
+        return f"about {round(seconds / 60)} min left"
+    return f"about {seconds / 3600:.1f} h left"
+
+
+def _item_fields(item, recipient_email):
+    """
+    (file_path, recipients, subject, body) of a file path, MergeMessage or
+    SpoolJob.
+    """
+    if isinstance(item, str):
+        return item, recipient_email, None, None
+    return item.file_path, item.recipient, item.subject, item.body
+
+
+def _item_path(item):
+    return item if isinstance(item, str) else item.file_path
+
+
+def _identity(file_path, recipient_email, subject=None, body=None):
+    return os.path.abspath(file_path), normalize_recipients(recipient_email or ''), subject, body
+
+
+class BatchSender:
+    """
+    Sends a list of files, one email per file, over a configurable number of
+    parallel SMTP connections, using either worker threads (smtplib backend)
+    or a single event loop (asyncio backend). Files that fail with a
+    transient error are queued for a later attempt while the rest of the
+    batch keeps flowing. With bundling enabled in [BUNDLE], small files are
+    grouped into fewer messages; outcomes are still reported per file.
+    Files larger than the server's SIZE limit are compressed, split or
+    rejected before any upload, as configured in [LARGE_FILES]. Files are
+    sent in the order, and over the lanes, set in [SCHEDULE]. Progress is
+    reported through plain callbacks so the same engine can drive the GUI
+    worker or a headless run: on_progress gets the percentage of bytes done
+    and the estimated seconds left. worker_share, (index, count), marks one of
+    count outbox worker processes; each gets an even share of the rate
+    limits.
+    """
+    def __init__(self, config_manager, logger_manager, on_log=None, on_status=None, on_progress=None,
+                 worker_share=None):
+        self.config_manager = config_manager
+        self.logger_manager = logger_manager
+        self.on_log = on_log or (lambda message: None)
+        self.on_status = on_status or (lambda file_path, status: None)
+        self.on_progress = on_progress or (lambda percent, eta: None)
+        self.is_running = True
+        self._stopped = threading.Event()
+
+        self._lock = threading.Lock()
+        self._results = {'sent': 0, 'failed': 0, 'skipped': 0}
+        self._completed = 0
+        self._total = 0
+        # File sizes for byte-based progress, when the whole list is known
+        self._sizes = {}
+        self._total_bytes = 0
+        self._done_bytes = 0
+        # Bytes actually sent or failed, for the rate behind the ETA
+        self._processed_bytes = 0
+        self._started = 0.0
+        self._journal = None
+        self._batch_id = None
+        self._content_index = None
+        self._hasher = None
+        # (file, recipients, subject, body) -> (delivery key, content digest)
+        self._content_keys = {}
+        # Delivery key -> the first copy being sent and the later copies
+        # waiting on its outcome, and -> the copy delivered in this batch
+        self._held = {}
+        self._delivered_in_batch = {}
+        self._held_lock = threading.Lock()
+        self._message_domain = 'localhost'
+        self._source = None
+        self._retry_policy = RetryPolicy(**config_manager.get_retry_settings())
+        self._retries = RetryQueue()
+        self._wake_workers = lambda: None
+        self._bundle_settings = config_manager.get_bundle_settings()
+        self._large_file_settings = config_manager.get_large_file_settings()
+        self._schedule_settings = config_manager.get_schedule_settings()
+        self._dedup_settings = config_manager.get_dedup_settings()
+        self._bundle = None
+        self._size_limit = 0
+        self._compressor = None
+        self._move_sent = True
+        self._quota_paused = False
+        self.worker_share = worker_share
+        registry.enabled = config_manager.get_metrics_settings()['enabled']
+
+    def stop(self):
+        self.is_running = False
+        self._stopped.set()
+        # Sources such as DirectoryWatcher block waiting for files; wake them
+        source_stop = getattr(self._source, 'stop', None)
+        if source_stop:
+            source_stop()
+        self._wake_workers()
+
+    def run(self, files, recipient_email=None, root=None):
+        """
+        Sends every file in files to recipient_email. files can be a list or
+        any iterable that keeps producing paths, such as a DirectoryWatcher;
+        progress percentages are only reported when its length is known.
+        root is the folder a list of files was taken from, which [SCHEDULE]
+        priority patterns with a slash are relative to.
+        files can also be a MailMerge, whose rows carry their own recipient,
+        subject and body; merged files are left in place, since the same
+        file may appear in several rows.
+        Returns a dict with 'sent', 'failed' and 'skipped' counts, and the
+        health of each SMTP profile under 'relays'.
+        """
+        settings = self.config_manager.get_smtp_settings()
+        profiles = self.config_manager.get_profiles()
+        # One worker per connection, across every relay profile
+        workers = sum(profile.max_connections for profile in profiles)
+        self._results = {'sent': 0, 'failed': 0, 'skipped': 0}
+        self._total = len(files) if hasattr(files, '__len__') else None
+        self._completed = 0
+        self._sizes = {}
+        self._total_bytes = self._done_bytes = self._processed_bytes = 0
+        self._started = time.monotonic()
+        self._source = files
+        self._retries = RetryQueue()
+        self._move_sent = not isinstance(files, MailMerge)
+        blocking_source = not isinstance(files, (list, tuple))
+        if self._total is not None:
+            workers = min(workers, max(1, self._total))
+        lanes, large_workers = self._schedule(files, blocking_source, workers, root)
+        # Message-IDs carry the default profile's domain, whichever relay sends
+        self._message_domain = settings.email.rpartition('@')[2] or 'localhost'
+
+        self._journal = self._open_journal()
+        try:
+            delivered = set()
+            if self._journal:
+                self._batch_id = self._journal.start_batch()
+                if recipient_email:
+                    delivered = self._journal.delivered_files(recipient_email)
+            pending = [self._skip_delivered(lane, recipient_email, delivered) for lane in lanes]
+            self._content_index = self._open_content_index()
+            if self._content_index:
+                self._hasher = ContentHasher(self._dedup_settings['workers'])
+                # Hashing ahead would hold back files from a source that waits for more
+                pending = [self._skip_duplicates(lane, recipient_email, lookahead=1 if blocking_source else None)
+                           for lane in pending]
+
+            if len(profiles) > 1:
+                self.on_log(f"Sending with {workers} parallel connections over {len(profiles)} SMTP profiles: "
+                            f"{', '.join(profile.name for profile in profiles)}.")
+            elif workers > 1:
+                self.on_log(f"Sending with {workers} parallel connections.")
+
+            self._bundle = self._bundle_settings if self._bundle_settings['enabled'] else None
+            if self._bundle and not self._move_sent:
+                self.on_log("Bundling is not used for mail merge, every row is its own message.")
+                self._bundle = None
+            elif self._bundle and blocking_source:
+                # A bundle would wait for files that may never come
+                self.on_log("Bundling is not used in watch mode, files are sent as they arrive.")
+                self._bundle = None
+            if self._large_file_settings['compress'] != 'never':
+                self._compressor = Compressor(self._large_file_settings['processes'])
+
+            if settings.backend == 'asyncio':
+                router = asyncio.run(self._run_async(profiles, pending, recipient_email, workers, large_workers))
+            else:
+                router = self._run_threaded(profiles, pending, recipient_email, workers, large_workers)
+            self._results['relays'] = router.health()
+
+            # Only left over when stopped early
+            for delivery in self._retries.drain():
+                self._record_failure(delivery, delivery.last_error)
+
+            if self._results['skipped']:
+                self.on_log(f"Resumed batch: {self._results['skipped']} already delivered file(s) skipped.")
+        finally:
+            self.logger_manager.flush_audit_log()
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+            if self._hasher:
+                self._hasher.shutdown()
+                self._hasher = None
+            if self._content_index:
+                self._content_index.close()
+                self._content_index = None
+            self._content_keys = {}
+            self._held = {}
+            self._delivered_in_batch = {}
+            if self._compressor:
+                self._compressor.shutdown()
+                self._compressor = None
+            self._source = None
+            self._wake_workers = lambda: None
+        return self._results
+
+    def _schedule(self, files, blocking_source, workers, root=None):
+        """
+        Orders files as set in [SCHEDULE] and splits off the large-file
+        lane. Returns (lanes, large_workers): the lists of files to send,
+        small files first, and how many of the workers serve the large-file
+        lane. Sources that keep producing files are sent as they arrive.
+        """
+        schedule = self._schedule_settings
+        scheduler = SendScheduler(schedule['policy'], schedule['priority_patterns'], schedule['large_file_bytes'],
+                                  root)
+        if blocking_source:
+            if scheduler.reorders:
+                self.on_log("The [SCHEDULE] order is not used for this source, files are sent as they arrive.")
+            return [files], 0
+
+        large_workers = min(schedule['large_connections'], workers - 1) if scheduler.large_file_bytes else 0
+        lanes, self._sizes = scheduler.plan(files, _item_path, lanes=large_workers > 0)
+        self._total_bytes = sum(self._sizes[_item_path(item)] for item in files)
+        if large_workers:
+            self.on_log(f"{len(lanes[1])} file(s) of {schedule['large_file_bytes'] / (1024 * 1024):g} MB or more "
+                        f"are sent over {large_workers} of the {workers} connections.")
+        elif scheduler.large_file_bytes and len(files) > 1:
+            self.on_log("Large files share the only connection, a separate lane needs at least two.")
+        return lanes, large_workers
+
+    @staticmethod
+    def _lane_order(lanes, worker, large_workers):
+        # The first large_workers workers serve the large-file lane; once a
+        # worker's own lane runs dry it helps with the other one
+        if len(lanes) == 1:
+            return [lanes[0]]
+        return [lanes[1], lanes[0]] if worker < large_workers else [lanes[0], lanes[1]]
+
+    @staticmethod
+    def _open_lane(order):
+        """
+        The lane to pull the next delivery from, or None while it is being
+        pulled by another worker (or every lane is exhausted).
+        """
+        for lane in order:
+            if not lane['exhausted']:
+                return None if lane['pulling'] else lane
+        return None
+
+    def _open_journal(self):
+        journal_settings = self.config_manager.get_journal_settings()
+        if not journal_settings['enabled']:
+            return None
+        try:
+            return DeliveryJournal(journal_settings['path'])
+        except Exception as e:
+            self.on_log(f"Warning: Could not open delivery journal, resume is disabled: {e}")
+            return None
+
+    def _open_content_index(self):
+        if not self._dedup_settings['enabled']:
+            return None
+        try:
+            return ContentIndex(self._dedup_settings['path'], self._dedup_settings['window_days'])
+        except Exception as e:
+            self.on_log(f"Warning: Could not open the content index, duplicates are not detected: {e}")
+            return None
+
+    def _skip_delivered(self, files, recipient_email, delivered):
+        """
+        Yields the files that still need sending. Files the journal says were
+        already delivered to these recipients, unchanged, were sent but never
+        moved (e.g. the app crashed in between), so they are just moved to
+        SENTEMAILS, never over a file already there. Merge rows and outbox
+        jobs are checked against the journal one by one.
+        """
+        for item in files:
+            if isinstance(item, (MergeMessage, SpoolJob)):
+                if item.error or not self._journal or not self._journal.is_delivered(item.file_path, item.recipient):
+                    yield item
+                    continue
+                filename = os.path.basename(item.file_path)
+                if getattr(item, 'move_sent', False) and os.path.exists(item.file_path):
+                    try:
+                        move_to_sent(item.file_path, replace=False)
+                    except OSError as e:
+                        self.on_log(f"Warning: Could not move already delivered {filename} to SENTEMAILS: {e}")
+                self.on_log(f"SKIPPED: {filename} was already delivered to {item.recipient}")
+                self.on_status(item.file_path, "SENT")
+                self._settle(item)
+                self._advance('skipped', item.file_path)
+                continue
+
+            file_path = item
+            if (os.path.abspath(file_path), *file_version(file_path)) not in delivered:
+                yield file_path
+                continue
+            filename = os.path.basename(file_path)
+            try:
+                move_to_sent(file_path, replace=False)
+            except OSError as e:
+                self.on_log(f"Warning: Could not move already delivered {filename} to SENTEMAILS: {e}")
+            self.on_log(f"SKIPPED: {filename} was already delivered to {recipient_email}")
+            self.on_status(file_path, "SENT")
+            self._advance('skipped', file_path)
+
+    def _skip_duplicates(self, items, recipient_email, lookahead=None):
+        """
+        Yields the items whose content has not been delivered to the same
+        recipients yet, hashing files ahead of sending on several threads.
+        A file already delivered under any name is skipped before any SMTP
+        work and moved to SENTEMAILS like a sent one. A second copy within
+        the batch waits for the first: it is skipped and left in place once
+        the first is delivered, and sent instead if the first fails.
+        """
+        for item, digest, error in self._hasher.hashed(items, _item_path, lookahead):
+            file_path, recipient, subject, body = _item_fields(item, recipient_email)
+            if error is not None or getattr(item, 'error', None):
+                yield item  # Reported when the message is built
+                continue
+            key = delivery_key(digest, recipient, subject, body)
+            filename = os.path.basename(file_path)
+            with self._held_lock:
+                # Under the lock, so a first copy cannot be delivered in between
+                delivered_as = self._delivered_in_batch.get(key)
+                held = self._held.get(key) if delivered_as is None else None
+                earlier = None
+                if held is not None:
+                    held['waiting'].append((item, recipient_email, digest))
+                elif delivered_as is None:
+                    earlier = self._content_index.lookup(key)
+                    if earlier is None:
+                        self._held[key] = {'first': filename, 'waiting': []}
+            if delivered_as is not None:
+                self.on_log(f"SKIPPED: {filename} has the same content as {delivered_as} "
+                            f"in this batch and is left in place")
+                self.on_status(file_path, "SKIPPED")
+                self._settle(item if isinstance(item, SpoolJob) else None)
+                self._advance('skipped', file_path)
+                continue
+            if held is not None:
+                self.on_log(f"WAITING: {filename} has the same content as {held['first']} in this batch, "
+                            f"and is only sent if that one fails")
+                continue
+            if earlier is None:
+                self._content_keys[_identity(file_path, recipient, subject, body)] = (key, digest)
+                yield item
+                continue
+
+            if (isinstance(item, str) and self._move_sent) or getattr(item, 'move_sent', False):
+                try:
+                    move_to_sent(file_path, replace=False)
+                except OSError as e:
+                    self.on_log(f"Warning: Could not move already delivered {filename} to SENTEMAILS: {e}")
+            self.on_log(f"SKIPPED: {filename} has the same content as {earlier['filename']}, "
+                        f"already sent to {recipient} on {earlier['timestamp']}")
+            self.on_status(file_path, "SENT")
+            self._settle(item if isinstance(item, SpoolJob) else None)
+            self._advance('skipped', file_path)
+
+    def _resolve_held(self, key, delivered):
+        """
+        Settles the copies waiting on the first copy of content key: skipped
+        once it is delivered, otherwise the next one is sent in its place
+        (or, once the batch is stopping, none of them).
+        """
+        with self._held_lock:
+            held = self._held.get(key)
+            if held is None:
+                return
+            if delivered:
+                self._delivered_in_batch[key] = held['first']
+            if delivered or not held['waiting'] or not self.is_running:
+                del self._held[key]
+                waiting, released = held['waiting'], None
+            else:
+                waiting, released = [], held['waiting'].pop(0)
+                first, held['first'] = held['first'], os.path.basename(_item_path(released[0]))
+
+        for item, _, _ in waiting:
+            file_path = _item_path(item)
+            if delivered:
+                self.on_log(f"SKIPPED: {os.path.basename(file_path)} has the same content as {held['first']} "
+                            f"in this batch and is left in place")
+            else:
+                self.on_log(f"NOT SENT: {os.path.basename(file_path)} was not attempted, the batch was stopped")
+            self.on_status(file_path, "SKIPPED")
+            self._settle(item if isinstance(item, SpoolJob) else None,
+                         None if delivered else InterruptedError("Batch stopped before the message was sent."))
+            self._advance('skipped', file_path)
+        if released is None:
+            return
+
+        item, recipient_email, digest = released
+        file_path, recipient, subject, body = _item_fields(item, recipient_email)
+        self.on_log(f"{os.path.basename(file_path)} has the same content as {first}, which failed; "
+                    f"sending it instead")
+        self._content_keys[_identity(file_path, recipient, subject, body)] = (key, digest)
+        for delivery in self._deliveries([item], recipient_email):
+            self._retries.push(delivery, 0)
+        self._wake_workers()
+
+    def _message_id(self, delivery):
+        """
+        Derived from the content keys of delivery's files when they were
+        hashed, so it stays the same across retries, relays and runs;
+        otherwise a fresh one, still kept for every attempt of this batch.
+        """
+        keys = [self._content_keys.get(_identity(file_path, delivery.recipient, delivery.subject, delivery.body))
+                for file_path in delivery.files]
+        if not all(keys):
+            return make_msgid(domain=self._message_domain)
+        if len(keys) == 1:
+            return message_id(keys[0][0], self._message_domain)
+        combined = hashlib.sha256("\0".join(key for key, digest in keys).encode('ascii')).hexdigest()
+        return message_id(combined, self._message_domain)
+
+    def _bundled(self, files, bundle, size_limit):
+        """
+        Groups files into lists of at most max_files files and max_bytes of
+        attachments that, once base64-encoded, fit within the server's
+        size_limit (0 for no limit). A file too big to share a message is
+        yielded on its own.
+        """
+        group, group_bytes, group_encoded = [], 0, MESSAGE_OVERHEAD
+        for file_path in files:
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = 0  # Reported when the message is built
+            encoded = base64_size(size) + BUNDLE_PART_OVERHEAD
+            if group and (len(group) >= bundle['max_files']
+                          or group_bytes + size > bundle['max_bytes']
+                          or (size_limit and group_encoded + encoded > size_limit)):
+                yield group
+                group, group_bytes, group_encoded = [], 0, MESSAGE_OVERHEAD
+            group.append(file_path)
+            group_bytes += size
+            group_encoded += encoded
+        if group:
+            yield group
+
+    def _deliveries(self, files, recipient_email):
+        """
+        Turns the files to send into Deliveries: bundles when bundling is on,
+        and single files with their large-file handling decided up front.
+        """
+        if self._bundle:
+            groups = self._bundled(files, self._bundle, self._size_limit)
+        else:
+            groups = ([item] for item in files)
+        for group in groups:
+            item = group[0]
+            if isinstance(item, (MergeMessage, SpoolJob)):
+                if isinstance(item, SpoolJob):
+                    delivery = Delivery([item.file_path], item.recipient, subject=item.subject, body=item.body,
+                                        move_sent=item.move_sent, job=item)
+                else:
+                    delivery = Delivery([item.file_path], item.recipient, subject=item.subject, body=item.body,
+                                        move_sent=False)
+                if item.error:
+                    self._record_failure(delivery, ValueError(item.error))
+                    continue
+            else:
+                delivery = Delivery(group, recipient_email, move_sent=self._move_sent)
+            delivery.message_id = self._message_id(delivery)
+            if delivery.is_bundle or self._plan_large_file(delivery):
+                yield delivery
+
+    def _plan_large_file(self, delivery):
+        """
+        Starts compressing the file if configured to, marks it for splitting
+        if it cannot fit the server's limit, or rejects it right away.
+        Returns False if the delivery was rejected.
+        """
+        file_path = delivery.files[0]
+        large = self._large_file_settings
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            return True  # Reported when the message is built
+        encoded = base64_size(size) + MESSAGE_OVERHEAD
+        too_large = bool(self._size_limit) and encoded > self._size_limit
+
+        if self._compressor and is_compressible(file_path) and (
+                (large['compress'] == 'always' and size >= large['compress_min_bytes'])
+                or (large['compress'] == 'oversize' and too_large)):
+            delivery.compression = self._compressor.submit(file_path)
+            return True
+        if not too_large:
+            return True
+        if large['oversize'] == 'split':
+            delivery.split_bytes = raw_size_within(self._size_limit - MESSAGE_OVERHEAD)
+            return True
+        self._record_failure(delivery, MessageTooLargeError(encoded, self._size_limit))
+        return False
+
+    def _build(self, email_sender, delivery):
+        """
+        Builds the message(s) for delivery: one per bundle or file, or one per
+        part for a file that is split.
+        """
+        if delivery.is_bundle:
+            return [email_sender.build_bundle_message(delivery.recipient, delivery.files, self._bundle['compress'],
+                                                      message_id=delivery.message_id)]
+
+        file_path = delivery.files[0]
+        filename = os.path.basename(file_path)
+        size = os.path.getsize(file_path)
+        if delivery.compression is not None:
+            delivery.temp_path = delivery.compression.result()
+            compressed_size = os.path.getsize(delivery.temp_path)
+            logging.info(f"Compressed {filename} from {size} to {compressed_size} bytes")
+            if compressed_size < size:
+                file_path, filename, size = delivery.temp_path, filename + ".gz", compressed_size
+            encoded = base64_size(size) + MESSAGE_OVERHEAD
+            if self._size_limit and encoded > self._size_limit:
+                if self._large_file_settings['oversize'] != 'split':
+                    raise MessageTooLargeError(encoded, self._size_limit)
+                delivery.split_bytes = raw_size_within(self._size_limit - MESSAGE_OVERHEAD)
+
+        if delivery.split_bytes:
+            return email_sender.build_split_messages(delivery.recipient, file_path, filename, delivery.split_bytes,
+                                                     message_id=delivery.message_id)
+        return [email_sender.build_message(delivery.recipient, file_path, filename,
+                                           subject=delivery.subject, body=delivery.body,
+                                           message_id=delivery.message_id)]
+
+    def _router(self, profiles, sender_factory):
+        """
+        An SMTPRouter over one Relay per profile, each with its own sender
+        (made by sender_factory) and rate limiter.
+        """
+        relays = [Relay(profile, sender_factory(profile), self._rate_limiter(profile)) for profile in profiles]
+        return SMTPRouter(relays, **self.config_manager.get_routing_settings())
+
+    def _rate_limiter(self, profile):
+        settings = self.config_manager.get_rate_limit_settings(profile.name)
+        if self.worker_share:
+            settings = share_limits(settings, *self.worker_share)
+        return RateLimiter(**settings)
+
+    def _size_limit_read(self, router, relay, size_limit, error):
+        """
+        Records the SIZE limit read from relay at startup, or takes the relay
+        out of rotation if it could not be reached.
+        """
+        if error is None:
+            relay.size_limit = size_limit
+            return
+        if len(router) > 1:
+            self.on_log(f"Warning: SMTP profile '{relay.name}' is not available, "
+                        f"sending through the others: {error}")
+            router.mark_down(relay, error)
+        else:
+            logging.warning(f"Could not read the server's message size limit: {error}")
+
+    def _close_router(self, router, stats):
+        for relay, relay_stats in zip(router.relays, stats):
+            relay.limiter.close()
+            self._report_connections(relay_stats)
+        if len(router) > 1:
+            for health in router.health():
+                state = "healthy" if health['healthy'] else f"out of rotation ({health['last_error']})"
+                self.on_log(f"SMTP profile '{health['profile']}' ({health['server']}): "
+                            f"{health['sent']} sent, {health['failed']} failed, {state}")
+
+    def _run_threaded(self, profiles, lanes, recipient_email, workers, large_workers):
+        router = self._router(profiles, lambda profile: EmailSender(
+            self.config_manager, max_connections=profile.max_connections, settings=profile))
+        for relay in router.relays:
+            try:
+                self._size_limit_read(router, relay, relay.sender.server_size_limit(), None)
+            except Exception as e:
+                self._size_limit_read(router, relay, 0, e)
+        # Messages are built to fit whichever relay they end up on
+        self._size_limit = router.size_limit()
+        lanes = [{'deliveries': self._deliveries(files, recipient_email), 'exhausted': False, 'pulling': False}
+                 for files in lanes]
+        changed = threading.Condition()
+
+        def wake_workers():
+            with changed:
+                changed.notify_all()
+
+        self._wake_workers = wake_workers
+
+        def next_delivery(order):
+            while True:
+                with changed:
+                    while True:
+                        if not self.is_running:
+                            return None
+                        delivery = self._retries.pop_ready()
+                        if delivery is not None:
+                            return delivery
+                        lane = self._open_lane(order)
+                        if lane is not None:
+                            lane['pulling'] = True
+                            break
+                        if all(lane['exhausted'] for lane in lanes) and not self._retries:
+                            return None
+                        changed.wait(self._retries.seconds_until_ready())
+
+                # Generators are not thread-safe, so one worker pulls from a
+                # lane at a time; the others keep serving due retries meanwhile
+                delivery = None
+                try:
+                    delivery = next(lane['deliveries'], None)
+                finally:
+                    with changed:
+                        lane['pulling'] = False
+                        lane['exhausted'] = delivery is None
+                        changed.notify_all()
+                if delivery is not None:
+                    return delivery
+
+        def worker_loop(order):
+            while True:
+                delivery = next_delivery(order)
+                if delivery is None:
+                    return
+                self.process_file(router, delivery)
+
+        threads = [threading.Thread(target=worker_loop, args=(self._lane_order(lanes, n, large_workers),),
+                                    name=f"sender-{n + 1}", daemon=True)
+                   for n in range(workers)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self._close_router(router, [relay.sender.close() for relay in router.relays])
+        return router
+
+    async def _run_async(self, profiles, lanes, recipient_email, workers, large_workers):
+        router = self._router(profiles, lambda profile: AsyncEmailSender(
+            self.config_manager, max_connections=profile.max_connections, settings=profile))
+        limits = await asyncio.gather(*(relay.sender.server_size_limit() for relay in router.relays),
+                                      return_exceptions=True)
+        for relay, limit in zip(router.relays, limits):
+            if isinstance(limit, Exception):
+                self._size_limit_read(router, relay, 0, limit)
+            else:
+                self._size_limit_read(router, relay, limit, None)
+        self._size_limit = router.size_limit()
+        lanes = [{'deliveries': self._deliveries(files, recipient_email), 'exhausted': False, 'pulling': False}
+                 for files in lanes]
+        changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def wake_workers():
+            try:
+                loop.call_soon_threadsafe(changed.set)
+            except RuntimeError:
+                pass  # Loop already closed
+
+        self._wake_workers = wake_workers
+
+        async def next_delivery(order):
+            while True:
+                if not self.is_running:
+                    return None
+                delivery = self._retries.pop_ready()
+                if delivery is not None:
+                    return delivery
+                lane = self._open_lane(order)
+                if lane is not None:
+                    lane['pulling'] = True
+                    delivery = None
+                    try:
+                        # Off the event loop: the lane may wait for the next file,
+                        # and hashes, stats and looks files up in the journal
+                        delivery = await asyncio.to_thread(next, lane['deliveries'], None)
+                    finally:
+                        lane['pulling'] = False
+                        lane['exhausted'] = delivery is None
+                        changed.set()
+                    if delivery is not None:
+                        return delivery
+                    continue
+                if all(lane['exhausted'] for lane in lanes) and not self._retries:
+                    return None
+                changed.clear()
+                try:
+                    await asyncio.wait_for(changed.wait(), self._retries.seconds_until_ready())
+                except asyncio.TimeoutError:
+                    pass
+
+        async def worker_loop(order):
+            while True:
+                delivery = await next_delivery(order)
+                if delivery is None:
+                    return
+                self._log_attempt(delivery)
+                relay = router.choose(exclude=delivery.failed_relay)
+                try:
+                    if self._needs_build(relay, delivery):
+                        # Reading, compressing and encoding happen off the event loop
+                        delivery.messages = await asyncio.to_thread(
+                            self._build, relay.sender.email_sender, delivery)
+                        delivery.relay = relay.name
+                except Exception as e:
+                    router.release(relay)
+                    self._record_failure(delivery, e)
+                    continue
+                try:
+                    for message in delivery.messages[delivery.sent_parts:]:
+                        recipients = len(message[1])
+                        await self._pace_async(router, relay, recipients)
+                        try:
+                            await relay.sender.send_message(*message, delivery.label)
+                        except Exception:
+                            relay.limiter.refund(recipients)
+                            raise
+                        delivery.sent_parts += 1
+                        relay.limiter.succeeded()
+                except Exception as e:
+                    self._handle_send_error(router, relay, delivery, e)
+                else:
+                    router.finished(relay)
+                    self._record_success(delivery)
+
+        try:
+            await asyncio.gather(*(worker_loop(self._lane_order(lanes, n, large_workers)) for n in range(workers)))
+        finally:
+            self._close_router(router, [await relay.sender.close() for relay in router.relays])
+        return router
+
+    def process_file(self, router, delivery):
+        """
+        Makes one attempt at sending delivery through the relay the router
+        picks, and records the outcome. Returns True on success. The message
+        is only built on the first attempt, or again when it moves to another
+        relay; a transient SMTP failure puts the delivery back in the retry
+        queue.
+        """
+        self._log_attempt(delivery)
+        relay = router.choose(exclude=delivery.failed_relay)
+
+        try:
+            if self._needs_build(relay, delivery):
+                delivery.messages = self._build(relay.sender, delivery)
+                delivery.relay = relay.name
+        except Exception as e:
+            # Unreadable file, too large or bad configuration: retrying will not help
+            router.release(relay)
+            self._record_failure(delivery, e)
+            return False
+        try:
+            # A split file resumes from the first part not yet delivered
+            for message in delivery.messages[delivery.sent_parts:]:
+                recipients = len(message[1])
+                self._pace(router, relay, recipients)
+                try:
+                    relay.sender.send_message(*message, delivery.label)
+                except Exception:
+                    relay.limiter.refund(recipients)
+                    raise
+                delivery.sent_parts += 1
+                relay.limiter.succeeded()
+        except Exception as e:
+            self._handle_send_error(router, relay, delivery, e)
+            return False
+        router.finished(relay)
+        return self._record_success(delivery)
+
+    def _needs_build(self, relay, delivery):
+        # The From address belongs to the profile, so a delivery moving to
+        # another relay gets its messages rebuilt
+        return delivery.messages is None or delivery.relay != relay.name
+
+    def _pace(self, router, relay, recipients):
+        """
+        Blocks until the relay's rate limiter lets a message to recipients
+        through.
+        """
+        while True:
+            if not self.is_running:
+                raise InterruptedError("Batch stopped before the message was sent.")
+            try:
+                delay = relay.limiter.reserve(recipients)
+            except QuotaExceeded as e:
+                self._stopped.wait(self._quota_pause(router, relay, e))
+                continue
+            self._quota_resumed()
+            if delay and self._stopped.wait(delay):
+                relay.limiter.refund(recipients)
+                continue
+            return
+
+    async def _pace_async(self, router, relay, recipients):
+        while True:
+            if not self.is_running:
+                raise InterruptedError("Batch stopped before the message was sent.")
+            try:
+                delay = relay.limiter.reserve(recipients)
+            except QuotaExceeded as e:
+                await self._sleep_async(self._quota_pause(router, relay, e))
+                continue
+            self._quota_resumed()
+            if delay and not await self._sleep_async(delay):
+                relay.limiter.refund(recipients)
+                continue
+            return
+
+    async def _sleep_async(self, seconds):
+        """
+        Sleeps in short steps so stop() is noticed. Returns False if stopped.
+        """
+        deadline = time.monotonic() + seconds
+        while self.is_running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            await asyncio.sleep(min(remaining, 0.5))
+        return False
+
+    def _quota_pause(self, router, relay, error):
+        """
+        Handles a used-up daily quota: moves on to another relay if there is
+        one, stops the batch, or returns how long to wait before checking
+        again.
+        """
+        if router.has_alternative(relay):
+            raise error
+        if relay.limiter.when_exhausted == 'stop':
+            self.on_log(f"{error} Stopping; the remaining files are left for the next run.")
+            self.stop()
+            raise error
+        with self._lock:
+            first = not self._quota_paused
+            self._quota_paused = True
+        if first:
+            self.on_log(f"PAUSED: {error} Sending resumes at {error.resume_at:%Y-%m-%d %H:%M}.")
+        remaining = (error.resume_at - datetime.datetime.now()).total_seconds()
+        return max(1.0, min(remaining, QUOTA_POLL_SECONDS))
+
+    def _quota_resumed(self):
+        if self._quota_paused:
+            with self._lock:
+                resumed, self._quota_paused = self._quota_paused, False
+            if resumed:
+                self.on_log("RESUMED: Daily quota available again.")
+
+    def _log_attempt(self, delivery):
+        if delivery.attempts:
+            self.on_log(f"Retrying {delivery.label} (attempt {delivery.attempts + 1} of "
+                        f"{self._retry_policy.max_attempts})...")
+        else:
+            self.on_log(f"Processing {delivery.label}...")
+
+    def _handle_send_error(self, router, relay, delivery, error):
+        if not self.is_running and isinstance(error, (InterruptedError, QuotaExceeded)):
+            # Stopped before this message went out: nothing was attempted
+            router.release(relay)
+            self._record_unsent(delivery, error)
+            return
+        delivery.last_error = error
+        registry.failure(error)
+        quota = is_quota_error(error)
+        if quota:
+            relay.limiter.exhausted()
+            self.on_log(f"SMTP profile '{relay.name}' reports its daily sending quota is used up: {error}")
+        delay = self._retry_policy.backoff(delivery.attempts + 1)
+        if is_throttle_error(error):
+            # Slow every worker on this relay down, not just this file
+            relay.limiter.throttled(pause=delay)
+        router.finished(relay, error, pause=delay)
+
+        if self.is_running and is_relay_error(error) and router.has_alternative(relay):
+            # Another relay can take it right away; this attempt does not count
+            delivery.failed_relay = relay.name
+            self.on_log(f"FAILOVER: {delivery.label} could not be sent through SMTP profile "
+                        f"'{relay.name}', trying another one: {error}")
+            registry.count('failovers')
+            self._retries.push(delivery, 0)
+            self._wake_workers()
+            return
+        if self.is_running and quota:
+            # Not this message's fault: it goes out once the quota resets
+            self._retries.push(delivery, 0)
+            self._wake_workers()
+            return
+
+        delivery.attempts += 1
+        if not self.is_running or not self._retry_policy.should_retry(error, delivery.attempts):
+            self._record_failure(delivery, error)
+            return
+
+        logging.warning(f"Attempt {delivery.attempts} for {delivery.label} failed, "
+                        f"retrying in {delay:.1f}s: {error}")
+        self.on_log(f"RETRY: {delivery.label} failed with a temporary error, retrying in {delay:.0f}s: {error}")
+        registry.count('retries')
+        self._retries.push(delivery, delay)
+        self._wake_workers()
+
+    def _record_success(self, delivery):
+        """
+        Records every file of a delivered message. Returns True if all of
+        them were moved to SENTEMAILS (or are left in place on purpose).
+        """
+        self._discard_temp(delivery)
+        moved = True
+        delivered_keys = []
+        for file_path in delivery.files:
+            filename = os.path.basename(file_path)
+            if self._journal:
+                # Journal before moving, so a crash in between cannot cause a resend
+                self._journal.record(self._batch_id, file_path, delivery.recipient, STATUS_SENT)
+            content_key = self._content_keys.pop(
+                _identity(file_path, delivery.recipient, delivery.subject, delivery.body), None)
+            if content_key:
+                # Likewise indexed before moving
+                with self._held_lock:
+                    self._content_index.record(*content_key, file_path, delivery.recipient, delivery.message_id)
+                delivered_keys.append(content_key[0])
+            if not delivery.move_sent:
+                self.logger_manager.log_delivery_status(file_path, delivery.recipient, True)
+                self.on_log(f"SUCCESS: Sent {filename} to {delivery.recipient}")
+                self.on_status(file_path, "SENT")
+                self._advance('sent', file_path)
+                continue
+            try:
+                # Move file to SENTEMAILS folder
+                move_to_sent(file_path)
+            except Exception as e:
+                self._record_file_failure(file_path, delivery.recipient, e)
+                moved = False
+                continue
+
+            self.logger_manager.log_delivery_status(file_path, delivery.recipient, True)
+            if delivery.is_bundle:
+                self.on_log(f"SUCCESS: Sent {filename} in a bundle of {len(delivery.files)} "
+                            f"files and moved to SENTEMAILS folder")
+            else:
+                self.on_log(f"SUCCESS: Sent {filename} and moved to SENTEMAILS folder")
+            self.on_status(file_path, "SENT")
+            self._advance('sent', file_path)
+        for key in delivered_keys:
+            self._resolve_held(key, True)
+        self._settle(delivery.job)
+        return moved
+
+    def _record_failure(self, delivery, error):
+        self._discard_temp(delivery)
+        for file_path in delivery.files:
+            content_key = self._content_keys.pop(
+                _identity(file_path, delivery.recipient, delivery.subject, delivery.body), None)
+            self._record_file_failure(file_path, delivery.recipient, error)
+            if content_key:
+                self._resolve_held(content_key[0], False)
+        self._settle(delivery.job, error)
+
+    def _record_unsent(self, delivery, error):
+        """
+        Reports the files of a delivery the batch stopped before sending.
+        They are neither journaled nor audited as failed, so the next run
+        sends them, and an outbox job goes back in the queue.
+        """
+        self._discard_temp(delivery)
+        for file_path in delivery.files:
+            content_key = self._content_keys.pop(
+                _identity(file_path, delivery.recipient, delivery.subject, delivery.body), None)
+            self.on_log(f"NOT SENT: {os.path.basename(file_path)} was not attempted, the batch was stopped")
+            self.on_status(file_path, "SKIPPED")
+            self._advance('skipped', file_path)
+            if content_key:
+                self._resolve_held(content_key[0], False)
+        if not isinstance(error, InterruptedError):
+            error = InterruptedError(str(error))
+        self._settle(delivery.job, error)
+
+    def _settle(self, job, error=None):
+        # Sources such as OutboxSource want to know how each of their jobs ended
+        settle = getattr(self._source, 'settle', None)
+        if settle and job is not None:
+            settle(job, error)
+
+    def _discard_temp(self, delivery):
+        delivery.messages = None
+        if delivery.temp_path:
+            try:
+                os.remove(delivery.temp_path)
+            except OSError as e:
+                logging.warning(f"Could not remove temporary file {delivery.temp_path}: {e}")
+            delivery.temp_path = None
+
+    def _record_file_failure(self, file_path, recipient_email, error):
+        filename = os.path.basename(file_path)
+        error_msg = str(error)
+        if self._journal:
+            self._journal.record(self._batch_id, file_path, recipient_email, STATUS_FAILED, error_msg)
+        self.logger_manager.log_delivery_status(file_path, recipient_email, False, error_msg)
+        self.on_log(f"FAILURE: Could not send {filename}. Error: {error_msg}")
+        self.on_status(file_path, "FAILED")
+        self._advance('failed', file_path)
+
+    def _advance(self, outcome, file_path):
+        registry.count(f'files_{outcome}')
+        size = self._sizes.get(file_path, 0)
+        with self._lock:
+            self._results[outcome] += 1
+            self._completed += 1
+            self._done_bytes += size
+            if outcome != 'skipped':
+                self._processed_bytes += size
+            if not self._total:
+                return
+            if self._total_bytes:
+                percent = int(self._done_bytes / self._total_bytes * 100)
+                if self._completed < self._total:
+                    percent = min(percent, 99)  # Empty files may still be left
+            else:
+                percent = int(self._completed / self._total * 100)
+            eta = self._eta()
+        self.on_progress(percent, eta)
+
+    def _eta(self):
+        """
+        Seconds until the remaining bytes are sent at the rate so far, or
+        None before anything was sent. Skipped files do not count towards
+        the rate.
+        """
+        remaining = self._total_bytes - self._done_bytes
+        if remaining <= 0:
+            return 0.0
+        elapsed = time.monotonic() - self._started
+        if not self._processed_bytes or elapsed <= 0:
+            return None
+        return remaining / (self._processed_bytes / elapsed)
+
+    def _report_connections(self, stats):
+        for session_id, messages_sent in stats:
+            self.on_log(f"SMTP connection {session_id} carried {messages_sent} message(s)")
@@ -0,0 +1,3 @@
+"""
+Benchmark harness for the sending engine; see benchmarks/run.py.
+"""
@@ -0,0 +1,200 @@
+"""
+In-process SMTP sink for the benchmarks. It speaks enough ESMTP for
+EmailSender and AsyncEmailSender (EHLO, AUTH, PIPELINING, SIZE, DATA, and
+with chunking, CHUNKING and BINARYMIME with BDAT), accepts any credentials
+and throws messages away after counting them.
+
+Faults can be injected to exercise the retry and reconnect paths:
+latency before each reply to DATA, a share of messages answered with
+fault_code (every Nth message for a rate of 1/N, so runs are repeatable),
+and throttling that answers 421 and drops the connection after
+throttle_after messages.
+"""
+import socketserver
+import threading
+import time
+
+
+class SinkStats:
+    """
+    What the sink saw, shared by all connections.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self.faults = 0
+        self.throttled = 0
+        self.bytes_received = 0
+        self.binary_messages = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'messages': self.messages,
+                'recipients': self.recipients,
+                'faults': self.faults,
+                'throttled': self.throttled,
+                'bytes_received': self.bytes_received,
+                'binary_messages': self.binary_messages,
+            }
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Replies go out one line at a time; with Nagle on, each would wait for
+    # the client's delayed ACK and every message would pay ~40ms for it
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def readline(self):
+        line = self.rfile.readline()
+        self.server.stats.add(bytes_received=len(line))
+        return line
+
+    def end_of_message(self, recipients, binary):
+        """
+        Answers the end of a message, after the configured latency and
+        maybe with an injected fault. Returns 1 if it was accepted.
+        """
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.inject_fault():
+            server.stats.add(faults=1)
+            self.reply(f"{server.fault_code} Injected fault")
+            return 0
+        server.stats.add(messages=1, recipients=recipients, binary_messages=int(binary))
+        self.reply("250 2.0.0 Queued")
+        return 1
+
+    def handle(self):
+        server = self.server
+        server.stats.add(connections=1)
+        self.reply("220 benchmark sink ESMTP")
+        sent = 0
+        recipients = 0
+        binary = False
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith("EHLO"):
+                extensions = ["250-benchmark sink", "250-PIPELINING", "250-8BITMIME"]
+                if server.size_limit:
+                    extensions.append(f"250-SIZE {server.size_limit}")
+                if server.chunking:
+                    extensions += ["250-CHUNKING", "250-BINARYMIME"]
+                extensions.append("250 AUTH PLAIN LOGIN")
+                for extension in extensions:
+                    self.reply(extension)
+            elif command.startswith("HELO"):
+                self.reply("250 benchmark sink")
+            elif command.startswith("AUTH PLAIN"):
+                self.reply("235 2.7.0 Authentication successful")
+            elif command.startswith("AUTH LOGIN"):
+                self.reply("334 VXNlcm5hbWU6")
+                self.readline()
+                self.reply("334 UGFzc3dvcmQ6")
+                self.readline()
+                self.reply("235 2.7.0 Authentication successful")
+            elif command.startswith("MAIL"):
+                if server.throttle_after and sent >= server.throttle_after:
+                    server.stats.add(throttled=1)
+                    self.reply("421 4.7.0 Too many messages, try again later")
+                    return
+                recipients = 0
+                binary = "BODY=BINARYMIME" in command
+                self.reply("250 2.1.0 OK")
+            elif command.startswith("RCPT"):
+                recipients += 1
+                self.reply("250 2.1.5 OK")
+            elif command.startswith("DATA"):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data_line = self.rfile.readline()
+                    size += len(data_line)
+                    if not data_line or data_line == b".\r\n":
+                        break
+                server.stats.add(bytes_received=size)
+                if not data_line:
+                    return
+                sent += self.end_of_message(recipients, binary=False)
+            elif command.startswith("BDAT"):
+                parts = command.split()
+                size = int(parts[1])
+                data = self.rfile.read(size)
+                server.stats.add(bytes_received=len(data))
+                if len(data) < size:
+                    return
+                if parts[-1] == "LAST":
+                    sent += self.end_of_message(recipients, binary)
+                else:
+                    self.reply(f"250 2.0.0 {size} octets received")
+            elif command.startswith(("RSET", "NOOP")):
+                self.reply("250 2.0.0 OK")
+            elif command.startswith("QUIT"):
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("502 5.5.2 Command not recognized")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    SMTP sink on 127.0.0.1 with a free port, served from a daemon thread.
+    latency is in seconds; fault_code should be a 4xx (retried) or 5xx
+    (permanent) reply code. chunking announces CHUNKING and BINARYMIME.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0.0, fault_rate=0.0, fault_code=451, throttle_after=0, size_limit=0,
+                 chunking=False):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.chunking = chunking
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.fault_code = fault_code
+        self._fault_every = max(1, round(1 / fault_rate)) if fault_rate else 0
+        self._arrivals = 0
+        self._arrivals_lock = threading.Lock()
+        self.throttle_after = throttle_after
+        self.size_limit = size_limit
+        self.stats = SinkStats()
+        self._thread = None
+
+    def inject_fault(self):
+        """
+        Whether the message that just ended gets the injected fault: every
+        Nth one, counted over all connections, for a fault_rate of 1/N.
+        """
+        if not self._fault_every:
+            return False
+        with self._arrivals_lock:
+            self._arrivals += 1
+            return self._arrivals % self._fault_every == 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-smtp", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,395 @@
+"""
+Benchmarks for the sending engine, against the in-process SMTP sink in
+benchmarks/fake_smtp.py. Run from the project folder:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --quick --only batch-small,async-4conn-latency
+    python -m benchmarks.run --output after.json --compare before.json
+
+Each scenario runs in a fresh process with its own temporary config.ini,
+key file and logs, so the real configuration is never touched and peak
+memory is measured per scenario. 'batch' scenarios drive BatchSender, the
+engine behind the GUI's EmailWorker and cli.py; 'sender' scenarios call
+EmailSender directly. Results are printed and written as JSON.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict, replace
+
+KB = 1024
+MB = 1024 * KB
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+RECIPIENT = 'bench@example.com'
+
+
+@dataclass
+class Scenario:
+    """
+    One benchmark run: how many files of which size, sent how, to a sink
+    with which faults. latency_ms is added by the sink before it answers
+    each message.
+    """
+    name: str
+    files: int
+    file_size: int
+    mode: str = 'batch'
+    backend: str = 'smtplib'
+    connections: int = 1
+    latency_ms: float = 0.0
+    fault_rate: float = 0.0
+    fault_code: int = 451
+    throttle_after: int = 0
+    chunking: bool = False
+
+
+SCENARIOS = [
+    Scenario('sender-small', 200, 10 * KB, mode='sender'),
+    Scenario('batch-small', 200, 10 * KB),
+    Scenario('batch-4conn-latency', 200, 10 * KB, connections=4, latency_ms=5),
+    Scenario('async-4conn-latency', 200, 10 * KB, backend='asyncio', connections=4, latency_ms=5),
+    Scenario('batch-large-files', 8, 16 * MB, connections=2),
+    Scenario('batch-large-files-bdat', 8, 16 * MB, connections=2, chunking=True),
+    Scenario('batch-transient-faults', 200, 10 * KB, connections=4, fault_rate=0.1, fault_code=451),
+    Scenario('batch-permanent-faults', 200, 10 * KB, connections=4, fault_rate=0.05, fault_code=550),
+    Scenario('batch-throttled', 200, 10 * KB, connections=4, throttle_after=25),
+]
+
+
+def quick(scenario):
+    """
+    A smaller version of scenario, for a fast sanity check.
+    """
+    return replace(scenario, files=max(5, scenario.files // 10), file_size=min(scenario.file_size, 2 * MB),
+                   throttle_after=scenario.throttle_after and max(1, scenario.throttle_after // 10))
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of values, or None if there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _isolate(workdir):
+    """
+    Points every file the application writes into workdir.
+    """
+    import config_manager
+    import content_index
+    import delivery_journal
+    import logger_manager
+    import outbox
+    import rate_limiter
+    import security
+    # The defaults are read when used, so patching the owning module is enough
+    config_manager.APP_PATH = workdir
+    config_manager.CONFIG_FILE = os.path.join(workdir, 'config.ini')
+    delivery_journal.JOURNAL_FILE = os.path.join(workdir, 'delivery_journal.db')
+    content_index.CONTENT_INDEX_FILE = os.path.join(workdir, 'content_index.db')
+    outbox.OUTBOX_FILE = os.path.join(workdir, 'outbox.db')
+    logger_manager.LOGS_DIR = os.path.join(workdir, 'LOGS')
+    logger_manager.DEBUG_LOG = os.path.join(workdir, 'debug.log')
+    rate_limiter.APP_PATH = workdir
+    rate_limiter.QUOTA_FILE = os.path.join(workdir, 'quota_state.db')
+    rate_limiter.LEGACY_QUOTA_FILE = os.path.join(workdir, 'quota_state.json')
+    security.KEY_FILE = os.path.join(workdir, 'secret.key')
+
+
+def _make_files(directory, count, size):
+    os.makedirs(directory)
+    payload = os.urandom(min(size, MB))
+    for index in range(count):
+        with open(os.path.join(directory, f"file_{index:05d}.bin"), 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(payload[:remaining])
+                remaining -= len(payload)
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory))
+
+
+def _configure(scenario, port):
+    from config_manager import ConfigManager
+    config_manager = ConfigManager()
+    config_manager.update_smtp_config('127.0.0.1', port, 'sender@example.com', 'benchmark', False, False)
+    config_manager.config['SMTP']['max_connections'] = str(scenario.connections)
+    config_manager.config['SMTP']['backend'] = scenario.backend
+    config_manager.config['CONCURRENCY'] = {}
+    config_manager.config['RETRY'] = {'max_attempts': '5', 'base_delay_seconds': '0.05', 'max_delay_seconds': '0.5'}
+    config_manager.save_config()
+    return config_manager
+
+
+def _drive_batch(config_manager, files):
+    """
+    Sends files with BatchSender. Latency is measured per file, from the
+    first attempt to its final status, so retries are included.
+    """
+    from batch_sender import BatchSender
+    from logger_manager import LoggerManager
+
+    # The log names a delivery by its label, status updates by its path;
+    # start and end are both keyed on the path
+    paths = {os.path.basename(f): f for f in files}
+    started = {}
+    latencies = []
+
+    def on_log(message):
+        if message.startswith("Processing ") and message.endswith("..."):
+            label = message[len("Processing "):-3]
+            started.setdefault(paths.get(label, label), time.perf_counter())
+
+    def on_status(file_path, status):
+        start = started.pop(file_path, None)
+        if start is not None:
+            latencies.append(time.perf_counter() - start)
+
+    logger_manager = LoggerManager(audit_settings=config_manager.get_audit_settings())
+    logger_manager.create_audit_log(files)
+    batch_sender = BatchSender(config_manager, logger_manager, on_log=on_log, on_status=on_status)
+    try:
+        results = batch_sender.run(files, RECIPIENT)
+    finally:
+        logger_manager.close_audit_log()
+    return results['sent'], results['failed'], latencies
+
+
+def _drive_sender(config_manager, files, connections):
+    """
+    Builds and sends each file with EmailSender from connections threads.
+    One attempt per file, no retries.
+    """
+    from email_sender import EmailSender
+
+    sender = EmailSender(config_manager, max_connections=connections)
+    pending = list(reversed(files))
+    lock = threading.Lock()
+    counts = {'sent': 0, 'failed': 0}
+    latencies = []
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                file_path = pending.pop()
+            start = time.perf_counter()
+            try:
+                message = sender.build_message(RECIPIENT, file_path)
+                sender.send_message(*message, os.path.basename(file_path))
+                outcome = 'sent'
+            except Exception:
+                outcome = 'failed'
+            elapsed = time.perf_counter() - start
+            with lock:
+                counts[outcome] += 1
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sender.close()
+    return counts['sent'], counts['failed'], latencies
+
+
+def run_scenario(scenario_fields, workdir):
+    """
+    Runs one scenario in the current process. Called in a child process.
+    """
+    import logging
+    logging.disable(logging.CRITICAL)
+    from benchmarks.fake_smtp import FakeSMTPServer
+
+    scenario = Scenario(**scenario_fields)
+    _isolate(workdir)
+    files = _make_files(os.path.join(workdir, 'outbox'), scenario.files, scenario.file_size)
+    server = FakeSMTPServer(latency=scenario.latency_ms / 1000.0, fault_rate=scenario.fault_rate,
+                            fault_code=scenario.fault_code, throttle_after=scenario.throttle_after,
+                            chunking=scenario.chunking).start()
+    try:
+        config_manager = _configure(scenario, server.port)
+        start = time.perf_counter()
+        if scenario.mode == 'sender':
+            sent, failed, latencies = _drive_sender(config_manager, files, scenario.connections)
+        else:
+            sent, failed, latencies = _drive_batch(config_manager, files)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    if (sent or failed) and not latencies:
+        # Would report throughput with no latency at all, e.g. if the
+        # callbacks stop matching up
+        raise RuntimeError(f"Scenario '{scenario.name}' collected no latency samples.")
+
+    sink = server.stats.as_dict()
+    if scenario.fault_rate and not sink['faults']:
+        # The fault paths it is meant to measure never ran
+        raise RuntimeError(f"Scenario '{scenario.name}' injected no faults.")
+    p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+    return {
+        'scenario': asdict(scenario),
+        'sent': sent,
+        'failed': failed,
+        'elapsed_seconds': round(elapsed, 3),
+        'messages_per_second': round(sent / elapsed, 1) if elapsed else None,
+        'latency_p50_ms': round(p50 * 1000, 2) if p50 is not None else None,
+        'latency_p99_ms': round(p99 * 1000, 2) if p99 is not None else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'bytes_on_wire': sink['bytes_received'],
+        'sink': sink,
+    }
+
+
+def run_isolated(scenario):
+    """
+    Runs scenario in a fresh process and temporary directory.
+    """
+    workdir = tempfile.mkdtemp(prefix="batchmail_bench_")
+    try:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            return pool.submit(run_scenario, asdict(scenario), workdir).result()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def format_row(result):
+    def show(value, unit=''):
+        return '-' if value is None else f"{value}{unit}"
+    return (f"{result['scenario']['name']:<26} {result['sent']:>6} {result['failed']:>6} "
+            f"{show(result['messages_per_second']):>9} {show(result['latency_p50_ms']):>9} "
+            f"{show(result['latency_p99_ms']):>9} {show(result['peak_rss_mb']):>8} "
+            f"{result['bytes_on_wire'] / MB:>10.1f}")
+
+
+HEADER = (f"{'scenario':<26} {'sent':>6} {'failed':>6} {'msg/s':>9} {'p50 ms':>9} "
+          f"{'p99 ms':>9} {'rss MB':>8} {'wire MB':>10}")
+
+
+def compare(results, baseline_path):
+    """
+    Prints how each scenario changed against a previous results file.
+    """
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {r['scenario']['name']: r for r in json.load(f)['results']}
+
+    def change(new, old, higher_is_better):
+        if new is None or not old:
+            return '-'
+        delta = (new - old) / old * 100
+        better = delta > 0 if higher_is_better else delta < 0
+        return f"{delta:+.1f}%{'' if abs(delta) < 5 else (' better' if better else ' worse')}"
+
+    print(f"\nCompared with {baseline_path}:")
+    print(f"{'scenario':<26} {'msg/s':>16} {'p50':>16} {'p99':>16} {'rss':>16}")
+    for result in results:
+        old = baseline.get(result['scenario']['name'])
+        if old is None:
+            print(f"{result['scenario']['name']:<26} (not in baseline)")
+            continue
+        print(f"{result['scenario']['name']:<26} "
+              f"{change(result['messages_per_second'], old['messages_per_second'], True):>16} "
+              f"{change(result['latency_p50_ms'], old['latency_p50_ms'], False):>16} "
+              f"{change(result['latency_p99_ms'], old['latency_p99_ms'], False):>16} "
+              f"{change(result['peak_rss_mb'], old['peak_rss_mb'], False):>16}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sending engine against a local fake SMTP server.")
+    parser.add_argument('--only', help="Comma separated scenario names to run (default: all)")
+    parser.add_argument('--quick', action='store_true', help="Run smaller versions of the scenarios")
+    parser.add_argument('--list', action='store_true', help="List the scenarios and exit")
+    parser.add_argument('--output', '-o', help="Results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument('--compare', '-c', help="Previous results file to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = SCENARIOS
+    if args.list:
+        for scenario in scenarios:
+            print(f"{scenario.name:<26} {asdict(scenario)}")
+        return 0
+    if args.only:
+        names = {name.strip() for name in args.only.split(',') if name.strip()}
+        unknown = names - {scenario.name for scenario in scenarios}
+        if unknown:
+            print(f"Unknown scenario(s): {', '.join(sorted(unknown))}", file=sys.stderr)
+            return 2
+        scenarios = [scenario for scenario in scenarios if scenario.name in names]
+    if args.quick:
+        scenarios = [quick(scenario) for scenario in scenarios]
+
+    print(HEADER)
+    results = []
+    for scenario in scenarios:
+        result = run_isolated(scenario)
+        results.append(result)
+        print(format_row(result), flush=True)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'quick': args.quick,
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
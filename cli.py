@@ -0,0 +1,512 @@
+"""
+Headless entry point. Sends a directory of files without the GUI and without
+importing Qt, for use from cron jobs, containers and scripts.
+
+    python cli.py --directory ./reports --to someone@example.com --json
+
+With --watch it keeps running and sends files as they arrive in the
+directory, until interrupted with SIGINT or SIGTERM.
+
+Extra SMTP profiles are configured as [SMTP:<name>] sections in config.ini;
+store a profile's password encrypted with
+
+    python cli.py --set-password backup
+
+With --manifest it runs a mail merge instead: a CSV or JSON Lines file with
+'file' and 'to' columns, whose other columns fill in the subject and body
+templates.
+
+    python cli.py --manifest merge.csv --subject 'Invoice $number' --body-file body.txt
+
+With --enqueue the files (or manifest rows) are only added to the durable
+outbox; --work then sends whatever is waiting there from several processes,
+and jobs of a crashed sender are picked up again once their lease runs out.
+
+    python cli.py --directory ./reports --to someone@example.com --enqueue
+    python cli.py --work --processes 4
+
+With --coordinate the outbox is served to sender nodes on other hosts,
+which pull jobs with --work --coordinator; every delivery lands in the
+coordinator's audit log, and the jobs of a node that drops out go to the
+others.
+
+    python cli.py --coordinate --listen 0.0.0.0:8470
+    python cli.py --work --coordinator mailhub:8470 --processes 4
+
+Per-stage timings and counters can be exported in the Prometheus text format
+with --metrics-file (e.g. for node_exporter's textfile collector) or scraped
+from --metrics-port while the batch runs; --json includes them as well.
+
+Exit codes: 0 all files delivered, 1 some files failed, 2 invalid usage or
+configuration, 3 the run was aborted by an error rather than by failed
+files (e.g. the outbox could not be read, the coordinator could not listen,
+or a worker process crashed), 130 interrupted (batch mode only).
+"""
+import time
+
+_START = time.perf_counter()
+
+import argparse
+import getpass
+import json
+import os
+import signal
+import ssl
+import sys
+from config_manager import ConfigManager
+from logger_manager import LoggerManager
+from batch_sender import BatchSender, list_files, format_eta
+from directory_watcher import DirectoryWatcher
+from mail_merge import MailMerge
+from directory_scanner import parse_patterns
+from metrics import registry, MetricsExporter
+from outbox import Outbox, STATUS_QUEUED, STATUS_LEASED
+from outbox_worker import WorkerPool
+from outbox_broker import OutboxBroker, parse_address
+
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+EXIT_ERROR = 3
+EXIT_INTERRUPTED = 130
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB, or None where unavailable.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Send each file in a directory as an email attachment.")
+    parser.add_argument('--directory', '-d', help="Directory containing the files to send")
+    parser.add_argument('--to', '-t', help="Recipient address(es), comma separated")
+    parser.add_argument('--recursive', '-r', action='store_true',
+                        help="Also send files in subdirectories (default from config.ini)")
+    parser.add_argument('--include', help="Only send files matching these glob patterns, comma separated")
+    parser.add_argument('--exclude', help="Skip files and folders matching these glob patterns, comma separated")
+    parser.add_argument('--watch', '-w', action='store_true',
+                        help="Keep running and send new files as soon as they are fully written")
+    parser.add_argument('--manifest', '-m',
+                        help="Mail merge: CSV or JSONL file mapping files to recipients and template variables")
+    parser.add_argument('--subject', help="Mail merge subject template, e.g. 'Report for $name' (default from config.ini)")
+    parser.add_argument('--body-file', help="Mail merge body template file (default from config.ini)")
+    parser.add_argument('--enqueue', action='store_true',
+                        help="Add the files or manifest rows to the outbox instead of sending them")
+    parser.add_argument('--work', action='store_true', help="Send the jobs waiting in the outbox")
+    parser.add_argument('--processes', type=int,
+                        help="With --work, sender processes to run (default from config.ini)")
+    parser.add_argument('--follow', action='store_true',
+                        help="With --work or --coordinate, keep waiting for new jobs until interrupted")
+    parser.add_argument('--coordinate', action='store_true',
+                        help="Serve the outbox to sender nodes on other hosts and keep their audit log")
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                        help="With --coordinate, address to listen on (default from config.ini)")
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help="With --work, take jobs from this coordinator instead of the local outbox")
+    parser.add_argument('--set-password', metavar='PROFILE',
+                        help="Prompt for the password of an SMTP profile, store it encrypted and exit")
+    parser.add_argument('--metrics-file', help="Write Prometheus metrics to this file (default from config.ini)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve Prometheus metrics on this local port while running (default from config.ini)")
+    parser.add_argument('--json', action='store_true', help="Print a JSON summary on stdout when done")
+    parser.add_argument('--quiet', '-q', action='store_true', help="Do not print progress on stderr")
+    parser.add_argument('--debug', action='store_true', help="Enable debug logging to debug.log")
+    args = parser.parse_args(argv)
+    if args.set_password:
+        return args
+    if args.coordinate:
+        if args.directory or args.manifest or args.to or args.watch or args.enqueue or args.work:
+            parser.error("--coordinate cannot be combined with --directory, --manifest, --to, --watch, "
+                         "--enqueue or --work")
+        if args.processes is not None or args.metrics_file or args.metrics_port:
+            parser.error("--processes, --metrics-file and --metrics-port cannot be combined with --coordinate")
+        return args
+    if args.listen:
+        parser.error("--listen needs --coordinate")
+    if args.work:
+        if args.directory or args.manifest or args.to or args.watch or args.enqueue:
+            parser.error("--work cannot be combined with --directory, --manifest, --to, --watch or --enqueue")
+        if args.metrics_file or args.metrics_port:
+            # Each worker process has its own registry
+            parser.error("--metrics-file and --metrics-port cannot be combined with --work")
+        if args.coordinator and args.follow:
+            parser.error("--follow is up to the coordinator (cli.py --coordinate --follow)")
+        return args
+    if args.processes is not None or args.follow or args.coordinator:
+        parser.error("--processes, --follow and --coordinator need --work")
+    if args.manifest:
+        if args.directory or args.to or args.watch:
+            parser.error("--manifest cannot be combined with --directory, --to or --watch")
+    elif not (args.directory and args.to):
+        parser.error("--directory and --to are required unless --manifest is given")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    def progress(message):
+        if not args.quiet:
+            print(message, file=sys.stderr, flush=True)
+
+    if args.manifest and not os.path.isfile(args.manifest):
+        progress(f"Error: {args.manifest} does not exist.")
+        return EXIT_USAGE
+    if args.directory and not os.path.isdir(args.directory):
+        progress(f"Error: {args.directory} is not a directory.")
+        return EXIT_USAGE
+
+    if args.set_password:
+        try:
+            ConfigManager().set_profile_password(args.set_password, getpass.getpass(
+                f"Password for SMTP profile '{args.set_password}': "))
+        except (ValueError, EOFError) as e:
+            progress(f"Error: {e}")
+            return EXIT_USAGE
+        progress(f"Password for SMTP profile '{args.set_password}' saved.")
+        return EXIT_OK
+
+    try:
+        config_manager = ConfigManager()
+        config_manager.get_profiles()
+        config_manager.get_routing_settings()
+    except Exception as e:
+        progress(f"Error: Invalid configuration: {e}")
+        return EXIT_USAGE
+
+    if args.work:
+        return work_outbox(args, config_manager, progress)
+    if args.coordinate:
+        return coordinate_outbox(args, config_manager, progress)
+
+    merge = None
+    if args.manifest:
+        try:
+            templates = config_manager.get_merge_templates()
+            if args.subject is not None:
+                templates['subject_template'] = args.subject
+            if args.body_file:
+                with open(args.body_file, encoding='utf-8') as f:
+                    templates['body_template'] = f.read()
+            merge = MailMerge(args.manifest, **templates)
+        except (OSError, ValueError) as e:
+            progress(f"Error: Invalid mail merge templates: {e}")
+            return EXIT_USAGE
+
+    logger_manager = LoggerManager(debug_mode=args.debug, audit_settings=config_manager.get_audit_settings())
+    scan_settings = config_manager.get_scan_settings()
+    if args.recursive:
+        scan_settings['recursive'] = True
+    if args.include is not None:
+        scan_settings['include'] = parse_patterns(args.include)
+    if args.exclude is not None:
+        scan_settings['exclude'] = parse_patterns(args.exclude)
+    if args.enqueue:
+        return enqueue_outbox(args, config_manager, scan_settings, merge, progress)
+    file_list = list_files(args.directory, **scan_settings) if args.directory else []
+    summary = {
+        'directory': os.path.abspath(args.directory) if args.directory else None,
+        'manifest': os.path.abspath(args.manifest) if args.manifest else None,
+        'recipients': args.to,
+        'total': len(file_list),
+        'sent': 0,
+        'failed': 0,
+        'skipped': 0,
+        'audit_log': None,
+        'failures': [],
+    }
+
+    if merge:
+        summary['audit_log'] = logger_manager.create_audit_log([])
+        progress(f"Mail merge from {summary['manifest']}. Audit Log created: {summary['audit_log']}")
+    elif file_list or args.watch:
+        summary['audit_log'] = logger_manager.create_audit_log(file_list)
+        progress(f"Found {len(file_list)} files. Audit Log created: {summary['audit_log']}")
+    else:
+        progress("No files found in the selected directory.")
+
+    if merge:
+        source = merge
+    elif args.watch:
+        source = DirectoryWatcher(args.directory, **config_manager.get_watch_settings())
+        progress(f"Watching {summary['directory']} for new files. Press Ctrl+C to stop.")
+    else:
+        source = file_list
+
+    def on_status(file_path, status):
+        if status == "FAILED":
+            summary['failures'].append(file_path)
+
+    last_reported = [0]
+
+    def on_progress(value, eta):
+        if value >= last_reported[0] + 10 or (value == 100 and last_reported[0] != 100):
+            last_reported[0] = value
+            message = f"Progress: {value}%"
+            if eta is not None and value < 100:
+                message += f", {format_eta(eta)}"
+            progress(message)
+
+    batch_sender = BatchSender(config_manager, logger_manager,
+                               on_log=progress,
+                               on_status=on_status,
+                               on_progress=on_progress)
+
+    interrupted = []
+
+    def handle_signal(signum, frame):
+        # Let in-flight messages finish, then stop taking new files
+        interrupted.append(signum)
+        batch_sender.stop()
+        progress("Interrupted, finishing in-flight messages...")
+
+    signal.signal(signal.SIGINT, handle_signal)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, handle_signal)
+
+    metrics_settings = config_manager.get_metrics_settings()
+    if args.metrics_file is not None:
+        metrics_settings['textfile'] = os.path.abspath(args.metrics_file)
+    if args.metrics_port is not None:
+        metrics_settings['port'] = args.metrics_port
+    exporter = None
+    if registry.enabled and (metrics_settings['textfile'] or metrics_settings['port']):
+        try:
+            exporter = MetricsExporter(registry, textfile=metrics_settings['textfile'], port=metrics_settings['port'],
+                                       host=metrics_settings['host'], interval=metrics_settings['interval']).start()
+        except OSError as e:
+            progress(f"Warning: Could not export metrics: {e}")
+
+    startup_seconds = time.perf_counter() - _START
+    send_start = time.perf_counter()
+    if file_list or args.watch or merge:
+        try:
+            summary.update(batch_sender.run(source, args.to, root=args.directory))
+        except Exception as e:
+            progress(f"Error: {e}")
+            summary['error'] = str(e)
+        finally:
+            logger_manager.close_audit_log()
+    if exporter:
+        exporter.stop()
+
+    if args.watch or merge:
+        summary['total'] = summary['sent'] + summary['failed'] + summary['skipped']
+    summary['startup_seconds'] = round(startup_seconds, 3)
+    summary['elapsed_seconds'] = round(time.perf_counter() - send_start, 3)
+    summary['peak_rss_mb'] = peak_rss_mb()
+    if registry.enabled:
+        summary['metrics'] = registry.snapshot()
+    progress(f"Processing complete: {summary['sent']} sent, {summary['failed']} failed, "
+             f"{summary['skipped']} skipped.")
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+
+    if interrupted and not args.watch:
+        return EXIT_INTERRUPTED
+    if 'error' in summary:
+        return EXIT_ERROR
+    if summary['failed']:
+        return EXIT_FAILURES
+    return EXIT_OK
+
+
+def enqueue_outbox(args, config_manager, scan_settings, merge, progress):
+    """
+    --enqueue: adds the directory's files or the manifest's rows to the
+    outbox for cli.py --work to send; with --watch, files as they arrive.
+    """
+    settings = config_manager.get_outbox_settings()
+    outbox = Outbox(settings['path'], settings['max_claims'])
+    summary = {'outbox': settings['path'], 'added': 0, 'invalid': 0}
+    try:
+        if args.watch:
+            watcher = DirectoryWatcher(args.directory, **config_manager.get_watch_settings())
+
+            def handle_signal(signum, frame):
+                watcher.stop()
+
+            signal.signal(signal.SIGINT, handle_signal)
+            if hasattr(signal, 'SIGTERM'):
+                signal.signal(signal.SIGTERM, handle_signal)
+            progress(f"Watching {os.path.abspath(args.directory)}, queueing new files. Press Ctrl+C to stop.")
+            for file_path in watcher:
+                if outbox.enqueue([file_path], args.to):
+                    summary['added'] += 1
+                    progress(f"QUEUED: {os.path.basename(file_path)}")
+        elif merge:
+            rows = []
+            for row in merge:
+                if row.error:
+                    summary['invalid'] += 1
+                    progress(f"INVALID: {row.error}")
+                    continue
+                rows.append(row)
+                if len(rows) >= 1000:
+                    summary['added'] += outbox.enqueue(rows)
+                    rows = []
+            summary['added'] += outbox.enqueue(rows)
+        else:
+            summary['added'] = outbox.enqueue(list_files(args.directory, **scan_settings), args.to)
+        counts = outbox.counts()
+    finally:
+        outbox.close()
+    summary['waiting'] = counts[STATUS_QUEUED] + counts[STATUS_LEASED]
+    progress(f"Queued {summary['added']} job(s) in {summary['outbox']}; {summary['waiting']} waiting to be sent.")
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    return EXIT_FAILURES if summary['invalid'] else EXIT_OK
+
+
+def work_outbox(args, config_manager, progress):
+    """
+    --work: sends the outbox's jobs from several processes until it is
+    empty, or with --follow until interrupted.
+    """
+    settings = config_manager.get_outbox_settings()
+    processes = args.processes if args.processes is not None else settings['processes']
+    if processes < 1:
+        progress("Error: --processes must be at least 1.")
+        return EXIT_USAGE
+    if args.coordinator:
+        try:
+            parse_address(args.coordinator)
+        except ValueError as e:
+            progress(f"Error: {e}")
+            return EXIT_USAGE
+    pool = WorkerPool(processes, follow=args.follow, debug=args.debug, quiet=args.quiet,
+                      coordinator=args.coordinator)
+    interrupted = []
+
+    def handle_signal(signum, frame):
+        interrupted.append(signum)
+        pool.stop()
+        progress("Interrupted, finishing in-flight messages...")
+
+    signal.signal(signal.SIGINT, handle_signal)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, handle_signal)
+
+    progress(f"Sending from {args.coordinator or settings['path']} with {processes} worker process(es).")
+    send_start = time.perf_counter()
+    summary = pool.start().wait()
+    if args.coordinator:
+        # What is left is up to the coordinator
+        summary.update({'coordinator': args.coordinator, 'processes': processes})
+        progress(f"Processing complete: {summary['sent']} sent, {summary['failed']} failed, "
+                 f"{summary['skipped']} skipped.")
+    else:
+        outbox = Outbox(settings['path'], settings['max_claims'])
+        try:
+            counts = outbox.counts()
+        finally:
+            outbox.close()
+        summary.update({
+            'outbox': settings['path'],
+            'processes': processes,
+            'waiting': counts[STATUS_QUEUED] + counts[STATUS_LEASED],
+        })
+        progress(f"Processing complete: {summary['sent']} sent, {summary['failed']} failed, "
+                 f"{summary['skipped']} skipped; {summary['waiting']} job(s) left in the outbox.")
+    summary['elapsed_seconds'] = round(time.perf_counter() - send_start, 3)
+    if summary['crashed']:
+        progress(f"Warning: {summary['crashed']} worker process(es) stopped without a result; "
+                 f"their jobs are picked up again once their lease runs out.")
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+
+    if interrupted and not args.follow:
+        return EXIT_INTERRUPTED
+    if summary['crashed']:
+        return EXIT_ERROR
+    if summary['failed']:
+        return EXIT_FAILURES
+    return EXIT_OK
+
+
+def coordinate_outbox(args, config_manager, progress):
+    """
+    --coordinate: hands the outbox's jobs to sender nodes on other hosts
+    and records their results in one audit log, until every job is settled
+    (or with --follow until interrupted).
+    """
+    settings = config_manager.get_outbox_settings()
+    cluster = config_manager.get_cluster_settings()
+    address = args.listen or cluster['listen']
+    ssl_context = None
+    if cluster['tls']:
+        try:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(cluster['tls_cert'], cluster['tls_key'] or None)
+        except (OSError, ssl.SSLError) as e:
+            progress(f"Error: Could not load the [CLUSTER] TLS certificate: {e}")
+            return EXIT_USAGE
+
+    logger_manager = LoggerManager(debug_mode=args.debug, audit_settings=config_manager.get_audit_settings())
+    outbox = Outbox(settings['path'], settings['max_claims'])
+    summary = {'outbox': settings['path'], 'audit_log': logger_manager.create_audit_log([], name="cluster")}
+    try:
+        broker = OutboxBroker(outbox, logger_manager, address, cluster['token'], ssl_context,
+                              lease_seconds=settings['lease_seconds'], batch_size=settings['batch_size'],
+                              poll_interval=settings['poll_interval'], follow=args.follow, on_log=progress)
+        broker.start()
+    except (OSError, ValueError) as e:
+        outbox.close()
+        logger_manager.close_audit_log()
+        progress(f"Error: Could not listen on {address}: {e}")
+        return EXIT_USAGE if isinstance(e, ValueError) else EXIT_ERROR
+    summary['listen'] = f"{broker.host}:{broker.port}"
+    progress(f"Audit Log created: {summary['audit_log']}")
+    interrupted = []
+
+    def handle_signal(signum, frame):
+        interrupted.append(signum)
+        broker.stop()
+        progress("Interrupted, waiting for the nodes to finish their in-flight messages...")
+
+    signal.signal(signal.SIGINT, handle_signal)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, handle_signal)
+
+    send_start = time.perf_counter()
+    try:
+        nodes = broker.wait()
+        broker.close()
+        counts = outbox.counts()
+    finally:
+        outbox.close()
+        logger_manager.close_audit_log()
+    summary.update({
+        'sent': sum(node['sent'] for node in nodes.values()),
+        'failed': sum(node['failed'] for node in nodes.values()),
+        'nodes': nodes,
+        'waiting': counts[STATUS_QUEUED] + counts[STATUS_LEASED],
+        'elapsed_seconds': round(time.perf_counter() - send_start, 3),
+    })
+    for name, node in nodes.items():
+        progress(f"Node {name}: {node['sent']} sent, {node['failed']} failed")
+    progress(f"Processing complete: {summary['sent']} sent, {summary['failed']} failed; "
+             f"{summary['waiting']} job(s) left in the outbox.")
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+
+    if interrupted and not args.follow:
+        return EXIT_INTERRUPTED
+    if summary['failed']:
+        return EXIT_FAILURES
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import os
+import gzip
+import shutil
+import tempfile
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Formats that are already compressed; gzipping them again costs CPU for
+# next to no saving.
+COMPRESSED_EXTENSIONS = {
+    '.gz', '.tgz', '.zip', '.bz2', '.xz', '.7z', '.rar', '.zst',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.mp4', '.m4a', '.mov', '.avi', '.mkv', '.webm',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.jar', '.apk',
+}
+
+
+def is_compressible(file_path):
+    return os.path.splitext(file_path)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+def gzip_file(file_path, level=6):
+    """
+    Writes a gzip copy of file_path to a temporary file and returns its
+    path. Runs in a worker process.
+    """
+    fd, gz_path = tempfile.mkstemp(prefix="batchmail_", suffix=".gz")
+    try:
+        with open(file_path, 'rb') as src, os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(filename=os.path.basename(file_path), mode='wb',
+                               compresslevel=level, fileobj=raw) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+    except BaseException:
+        os.remove(gz_path)
+        raise
+    return gz_path
+
+
+class Compressor:
+    """
+    Compresses attachments in a pool of worker processes, so large files are
+    gzipped on other cores while the sending workers carry on. The pool is
+    only started when the first file is submitted.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes or None
+        self._executor = None
+
+    def submit(self, file_path):
+        """
+        Starts compressing file_path. Returns a Future for the gzip path.
+        """
+        if self._executor is None:
+            # spawn, as forking a process that runs Qt and sender threads is unsafe
+            self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        logging.debug(f"Compressing {file_path} in the background")
+        return self._executor.submit(gzip_file, file_path)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
@@ -1,7 +1,15 @@
 import configparser
 import os
 import sys
-from security import encrypt_password, decrypt_password
+from dataclasses import dataclass
+from security import encrypt_password, decrypt_password, clear_key_cache
+import delivery_journal
+import outbox
+import content_index
+from mail_merge import DEFAULT_SUBJECT, DEFAULT_BODY
+from rate_limiter import EXHAUSTED_MODES
+from scheduler import SCHEDULE_POLICIES
+from directory_scanner import parse_patterns
 
 if getattr(sys, 'frozen', False):
     APP_PATH = os.path.dirname(sys.executable)
@@ -10,12 +18,61 @@ else:
 
 CONFIG_FILE = os.path.join(APP_PATH, 'config.ini')
 
+SMTP_BACKENDS = ('smtplib', 'asyncio')
+COMPRESS_MODES = ('never', 'oversize', 'always')
+OVERSIZE_MODES = ('reject', 'split')
+BINARY_MIME_MODES = ('auto', 'off')
+ROUTING_STRATEGIES = ('weighted', 'least_outstanding')
+
+# Extra relay profiles live in sections named [SMTP:<name>]; [SMTP] itself
+# is the 'default' profile
+DEFAULT_PROFILE = 'default'
+PROFILE_PREFIX = 'SMTP:'
+RATE_LIMIT_PREFIX = 'RATE_LIMIT:'
+# Settings that apply to the whole batch and are always read from [SMTP]
+SHARED_SMTP_KEYS = ('backend', 'stream_threshold_mb', 'message_cache_mb')
+
+@dataclass(frozen=True)
+class SMTPSettings:
+    """
+    Parsed, typed view of the [SMTP] section with the password already
+    decrypted. Resolved once and reused for a whole batch.
+    """
+    server: str
+    port: int
+    email: str
+    password: str
+    use_tls: bool
+    use_ssl: bool
+    max_messages_per_connection: int
+    max_connections: int
+    backend: str
+    stream_threshold_bytes: int
+    message_cache_bytes: int
+    name: str = DEFAULT_PROFILE
+    weight: float = 1.0
+    binary_mime: bool = True
+
 class ConfigManager:
     def __init__(self):
         self.config = configparser.ConfigParser()
+        self._settings = None
+        self._profiles = None
+        self._password_cache = {}
         self.load_config()
 
+    def invalidate_cache(self):
+        """
+        Drops the cached SMTPSettings, decrypted password and encryption key.
+        Called whenever the configuration is loaded or written.
+        """
+        self._settings = None
+        self._profiles = None
+        self._password_cache = {}
+        clear_key_cache()
+
     def load_config(self):
+        self.invalidate_cache()
         if not os.path.exists(CONFIG_FILE):
             # Create default if not exists
             self.config['SMTP'] = {
@@ -24,7 +81,107 @@ class ConfigManager:
                 'email': '',
                 'password': '',
                 'use_tls': 'true',
-                'use_ssl': 'false'
+                'use_ssl': 'false',
+                'max_messages_per_connection': '0',
+                'max_connections': '1',
+                'backend': 'smtplib',
+                'stream_threshold_mb': '10',
+                'message_cache_mb': '64',
+                'binary_mime': 'auto'
+            }
+            self.config['ROUTING'] = {
+                'strategy': 'weighted',
+                'failure_threshold': '3',
+                'cooldown_seconds': '60'
+            }
+            self.config['CONCURRENCY'] = {
+                'smtp.gmail.com': '3'
+            }
+            self.config['AUDIT'] = {
+                'flush_interval_seconds': '1',
+                'flush_batch_size': '100',
+                'fsync': 'batch'
+            }
+            self.config['JOURNAL'] = {
+                'enabled': 'false',
+                'path': ''
+            }
+            self.config['DEDUP'] = {
+                'enabled': 'false',
+                'path': '',
+                'window_days': '0',
+                'hash_workers': '4'
+            }
+            self.config['OUTBOX'] = {
+                'enabled': 'false',
+                'path': '',
+                'processes': '0',
+                'lease_seconds': '60',
+                'max_claims': '5',
+                'claim_batch': '8',
+                'poll_interval_seconds': '1'
+            }
+            self.config['CLUSTER'] = {
+                'listen': '127.0.0.1:8470',
+                'token': '',
+                'node_name': '',
+                'tls': 'false',
+                'tls_cert': '',
+                'tls_key': '',
+                'tls_ca': '',
+                'reconnect_seconds': '60'
+            }
+            self.config['WATCH'] = {
+                'settle_seconds': '2',
+                'poll_interval_seconds': '1'
+            }
+            self.config['SCAN'] = {
+                'recursive': 'false',
+                'include': '',
+                'exclude': '',
+                'workers': '4'
+            }
+            self.config['RETRY'] = {
+                'max_attempts': '3',
+                'base_delay_seconds': '5',
+                'max_delay_seconds': '300'
+            }
+            self.config['SCHEDULE'] = {
+                'policy': 'fifo',
+                'priority_patterns': '',
+                'large_file_mb': '0',
+                'large_connections': '1'
+            }
+            self.config['LARGE_FILES'] = {
+                'compress': 'oversize',
+                'compress_min_kb': '256',
+                'oversize': 'reject',
+                'compression_processes': '0'
+            }
+            self.config['MERGE'] = {
+                'subject': DEFAULT_SUBJECT,
+                'body_file': ''
+            }
+            self.config['BUNDLE'] = {
+                'enabled': 'false',
+                'max_files': '20',
+                'max_size_mb': '10',
+                'compress': 'false'
+            }
+            self.config['RATE_LIMIT'] = {
+                'messages_per_minute': '0',
+                'recipients_per_minute': '0',
+                'messages_per_day': '0',
+                'recipients_per_day': '0',
+                'burst': '5',
+                'when_exhausted': 'wait'
+            }
+            self.config['METRICS'] = {
+                'enabled': 'true',
+                'textfile': '',
+                'http_port': '0',
+                'http_host': '127.0.0.1',
+                'write_interval_seconds': '15'
             }
             self.save_config()
         else:
@@ -33,10 +190,350 @@ class ConfigManager:
     def save_config(self):
         with open(CONFIG_FILE, 'w') as configfile:
             self.config.write(configfile)
+        self.invalidate_cache()
 
     def get_smtp_config(self):
         return self.config['SMTP']
 
+    def get_smtp_settings(self):
+        """
+        Returns the cached SMTPSettings, parsing the [SMTP] section and
+        decrypting the password only the first time after a load or save.
+        """
+        settings = self._settings
+        if settings is None:
+            settings = self._settings = self._parse_smtp_settings()
+        return settings
+
+    def get_profiles(self):
+        """
+        SMTPSettings for every relay profile: [SMTP] first, as 'default',
+        then each [SMTP:<name>] section. Cached like get_smtp_settings.
+        """
+        profiles = self._profiles
+        if profiles is None:
+            profiles = [self.get_smtp_settings()]
+            for section in self.config.sections():
+                if section.startswith(PROFILE_PREFIX):
+                    profiles.append(self._parse_smtp_settings(section))
+            self._profiles = profiles
+        return profiles
+
+    def get_profile_names(self):
+        return [DEFAULT_PROFILE] + [section[len(PROFILE_PREFIX):] for section in self.config.sections()
+                                    if section.startswith(PROFILE_PREFIX)]
+
+    def _profile_section(self, name):
+        if name == DEFAULT_PROFILE:
+            return 'SMTP'
+        section = PROFILE_PREFIX + name
+        if not self.config.has_section(section):
+            raise ValueError(f"Unknown SMTP profile '{name}'.")
+        return section
+
+    def _parse_smtp_settings(self, section='SMTP'):
+        smtp_config = self.config[section]
+        shared_config = self.config['SMTP']
+        name = section[len(PROFILE_PREFIX):] if section.startswith(PROFILE_PREFIX) else DEFAULT_PROFILE
+        if not name.strip():
+            raise ValueError(f"[{section}] needs a profile name, e.g. [{PROFILE_PREFIX}backup].")
+
+        # The [CONCURRENCY] section caps parallel connections per server host,
+        # e.g. "smtp.gmail.com = 3".
+        server = smtp_config.get('server', '')
+        max_connections = int(smtp_config.get('max_connections', 1))
+        host = server.strip().lower()
+        if self.config.has_section('CONCURRENCY') and host in self.config['CONCURRENCY']:
+            max_connections = min(max_connections, int(self.config['CONCURRENCY'][host]))
+
+        backend = shared_config.get('backend', 'smtplib').strip().lower()
+        if backend not in SMTP_BACKENDS:
+            raise ValueError(f"Unknown SMTP backend '{backend}', expected 'smtplib' or 'asyncio'.")
+
+        # 'auto' sends attachments unencoded to servers announcing BINARYMIME
+        # and CHUNKING; a profile can turn it off for a relay that mishandles it
+        binary_mime = smtp_config.get('binary_mime', shared_config.get('binary_mime', 'auto')).strip().lower()
+        if binary_mime not in BINARY_MIME_MODES:
+            raise ValueError(f"Unknown binary_mime mode '{binary_mime}', expected one of {BINARY_MIME_MODES}.")
+
+        return SMTPSettings(
+            server=server,
+            port=int(smtp_config.get('port', 587)),
+            email=smtp_config.get('email', ''),
+            password=self.get_decrypted_password(section),
+            use_tls=smtp_config.get('use_tls', 'true').lower() == 'true',
+            use_ssl=smtp_config.get('use_ssl', 'false').lower() == 'true',
+            max_messages_per_connection=int(smtp_config.get('max_messages_per_connection', 0)),
+            max_connections=max(1, max_connections),
+            backend=backend,
+            stream_threshold_bytes=int(float(shared_config.get('stream_threshold_mb', 10)) * 1024 * 1024),
+            message_cache_bytes=int(float(shared_config.get('message_cache_mb', 64)) * 1024 * 1024),
+            name=name,
+            weight=max(0.0, float(smtp_config.get('weight', 1))),
+            binary_mime=binary_mime == 'auto',
+        )
+
+    def get_max_connections(self):
+        """
+        Number of parallel SMTP connections to use, after per-server limits.
+        """
+        return self.get_smtp_settings().max_connections
+
+    def get_smtp_backend(self):
+        """
+        Sending engine: 'smtplib' (blocking, one thread per connection) or
+        'asyncio' (one event loop for all connections).
+        """
+        return self.get_smtp_settings().backend
+
+    def get_audit_settings(self):
+        """
+        Keyword arguments for AuditWriter, read from the [AUDIT] section.
+        """
+        audit_config = self.config['AUDIT'] if self.config.has_section('AUDIT') else {}
+        return {
+            'flush_interval': float(audit_config.get('flush_interval_seconds', 1)),
+            'flush_batch_size': int(audit_config.get('flush_batch_size', 100)),
+            'fsync_policy': audit_config.get('fsync', 'batch').strip().lower(),
+        }
+
+    def get_journal_settings(self):
+        """
+        Whether the SQLite delivery journal is enabled, and where it lives.
+        An empty path means delivery_journal.db next to the application.
+        """
+        journal_config = self.config['JOURNAL'] if self.config.has_section('JOURNAL') else {}
+        path = journal_config.get('path', '').strip()
+        if path and not os.path.isabs(path):
+            path = os.path.join(APP_PATH, path)
+        return {
+            'enabled': journal_config.get('enabled', 'false').strip().lower() == 'true',
+            'path': path or delivery_journal.JOURNAL_FILE,
+        }
+
+    def get_dedup_settings(self):
+        """
+        Content-hash deduplication, read from the [DEDUP] section: whether
+        it is on, where the index lives (an empty path means
+        content_index.db next to the application), how many days a delivery
+        counts (0 = forever) and how many files are hashed in parallel.
+        """
+        dedup_config = self.config['DEDUP'] if self.config.has_section('DEDUP') else {}
+        path = dedup_config.get('path', '').strip()
+        if path and not os.path.isabs(path):
+            path = os.path.join(APP_PATH, path)
+        return {
+            'enabled': dedup_config.get('enabled', 'false').strip().lower() == 'true',
+            'path': path or content_index.CONTENT_INDEX_FILE,
+            'window_days': max(0.0, float(dedup_config.get('window_days', 0))),
+            'workers': max(1, int(dedup_config.get('hash_workers', 4))),
+        }
+
+    def get_outbox_settings(self):
+        """
+        The durable outbox, read from the [OUTBOX] section: whether the GUI
+        queues its batches there, where it lives (an empty path means
+        outbox.db next to the application), how many sender processes
+        cli.py --work starts (0 = one per CPU) and how jobs are leased.
+        """
+        outbox_config = self.config['OUTBOX'] if self.config.has_section('OUTBOX') else {}
+        path = outbox_config.get('path', '').strip()
+        if path and not os.path.isabs(path):
+            path = os.path.join(APP_PATH, path)
+        return {
+            'enabled': outbox_config.get('enabled', 'false').strip().lower() == 'true',
+            'path': path or outbox.OUTBOX_FILE,
+            'processes': int(outbox_config.get('processes', 0)) or os.cpu_count() or 1,
+            'lease_seconds': max(5.0, float(outbox_config.get('lease_seconds', 60))),
+            'max_claims': max(1, int(outbox_config.get('max_claims', 5))),
+            'batch_size': max(1, int(outbox_config.get('claim_batch', 8))),
+            'poll_interval': float(outbox_config.get('poll_interval_seconds', 1)),
+        }
+
+    def get_cluster_settings(self):
+        """
+        Distributed sending, read from the [CLUSTER] section: the address
+        cli.py --coordinate listens on, the shared token nodes authenticate
+        with, optional TLS files, the name this node reports and how long a
+        node keeps trying to reach a coordinator that went away.
+        """
+        cluster_config = self.config['CLUSTER'] if self.config.has_section('CLUSTER') else {}
+
+        def path_setting(key):
+            path = cluster_config.get(key, '').strip()
+            return os.path.join(APP_PATH, path) if path and not os.path.isabs(path) else path
+
+        return {
+            'listen': cluster_config.get('listen', '127.0.0.1:8470').strip() or '127.0.0.1:8470',
+            'token': cluster_config.get('token', '').strip(),
+            'node_name': cluster_config.get('node_name', '').strip(),
+            'tls': cluster_config.get('tls', 'false').strip().lower() == 'true',
+            'tls_cert': path_setting('tls_cert'),
+            'tls_key': path_setting('tls_key'),
+            'tls_ca': path_setting('tls_ca'),
+            'reconnect_seconds': float(cluster_config.get('reconnect_seconds', 60)),
+        }
+
+    def get_watch_settings(self):
+        """
+        Keyword arguments for DirectoryWatcher, read from the [WATCH] section.
+        """
+        watch_config = self.config['WATCH'] if self.config.has_section('WATCH') else {}
+        return {
+            'settle_seconds': float(watch_config.get('settle_seconds', 2)),
+            'poll_interval': float(watch_config.get('poll_interval_seconds', 1)),
+        }
+
+    def get_scan_settings(self):
+        """
+        Keyword arguments for DirectoryScanner, read from the [SCAN] section.
+        """
+        scan_config = self.config['SCAN'] if self.config.has_section('SCAN') else {}
+        return {
+            'recursive': scan_config.get('recursive', 'false').strip().lower() == 'true',
+            'include': parse_patterns(scan_config.get('include', '')),
+            'exclude': parse_patterns(scan_config.get('exclude', '')),
+            'workers': max(1, int(scan_config.get('workers', 4))),
+        }
+
+    def get_retry_settings(self):
+        """
+        Keyword arguments for RetryPolicy, read from the [RETRY] section.
+        """
+        retry_config = self.config['RETRY'] if self.config.has_section('RETRY') else {}
+        return {
+            'max_attempts': int(retry_config.get('max_attempts', 3)),
+            'base_delay': float(retry_config.get('base_delay_seconds', 5)),
+            'max_delay': float(retry_config.get('max_delay_seconds', 300)),
+        }
+
+    def get_bundle_settings(self):
+        """
+        Whether small files are grouped into shared messages, read from the
+        [BUNDLE] section, and the limits for each message.
+        """
+        bundle_config = self.config['BUNDLE'] if self.config.has_section('BUNDLE') else {}
+        return {
+            'enabled': bundle_config.get('enabled', 'false').strip().lower() == 'true',
+            'max_files': max(1, int(bundle_config.get('max_files', 20))),
+            'max_bytes': int(float(bundle_config.get('max_size_mb', 10)) * 1024 * 1024),
+            'compress': bundle_config.get('compress', 'false').strip().lower() == 'true',
+        }
+
+    def get_schedule_settings(self):
+        """
+        Sending order and large-file lane, read from the [SCHEDULE] section.
+        """
+        schedule_config = self.config['SCHEDULE'] if self.config.has_section('SCHEDULE') else {}
+        policy = schedule_config.get('policy', 'fifo').strip().lower()
+        if policy not in SCHEDULE_POLICIES:
+            raise ValueError(f"Unknown schedule policy '{policy}', expected one of {SCHEDULE_POLICIES}.")
+        return {
+            'policy': policy,
+            'priority_patterns': parse_patterns(schedule_config.get('priority_patterns', '')),
+            'large_file_bytes': int(float(schedule_config.get('large_file_mb', 0)) * 1024 * 1024),
+            'large_connections': max(1, int(schedule_config.get('large_connections', 1))),
+        }
+
+    def get_large_file_settings(self):
+        """
+        How attachments that are large, or too large for the server, are
+        handled, read from the [LARGE_FILES] section.
+        """
+        large_config = self.config['LARGE_FILES'] if self.config.has_section('LARGE_FILES') else {}
+        compress = large_config.get('compress', 'oversize').strip().lower()
+        if compress not in COMPRESS_MODES:
+            raise ValueError(f"Unknown compress mode '{compress}', expected one of {COMPRESS_MODES}.")
+        oversize = large_config.get('oversize', 'reject').strip().lower()
+        if oversize not in OVERSIZE_MODES:
+            raise ValueError(f"Unknown oversize mode '{oversize}', expected one of {OVERSIZE_MODES}.")
+        return {
+            'compress': compress,
+            'compress_min_bytes': int(float(large_config.get('compress_min_kb', 256)) * 1024),
+            'oversize': oversize,
+            'processes': int(large_config.get('compression_processes', 0)),
+        }
+
+    def get_merge_templates(self):
+        """
+        Subject and body templates for mail merge, from the [MERGE] section.
+        The body is read from body_file, relative to the application folder.
+        """
+        merge_config = self.config['MERGE'] if self.config.has_section('MERGE') else {}
+        body = DEFAULT_BODY
+        body_file = merge_config.get('body_file', '').strip()
+        if body_file:
+            if not os.path.isabs(body_file):
+                body_file = os.path.join(APP_PATH, body_file)
+            with open(body_file, encoding='utf-8') as f:
+                body = f.read()
+        return {
+            'subject_template': merge_config.get('subject', DEFAULT_SUBJECT),
+            'body_template': body,
+        }
+
+    def get_rate_limit_settings(self, profile=DEFAULT_PROFILE):
+        """
+        Keyword arguments for a profile's RateLimiter, read from the
+        [RATE_LIMIT] section; [RATE_LIMIT:<profile>] overrides it per profile.
+        0 means no limit.
+        """
+        rate_config = dict(self.config['RATE_LIMIT']) if self.config.has_section('RATE_LIMIT') else {}
+        if self.config.has_section(RATE_LIMIT_PREFIX + profile):
+            rate_config.update(self.config[RATE_LIMIT_PREFIX + profile])
+        when_exhausted = rate_config.get('when_exhausted', 'wait').strip().lower()
+        if when_exhausted not in EXHAUSTED_MODES:
+            raise ValueError(f"Unknown quota mode '{when_exhausted}', expected one of {EXHAUSTED_MODES}.")
+        return {
+            'profile': profile,
+            'messages_per_minute': float(rate_config.get('messages_per_minute', 0)),
+            'recipients_per_minute': float(rate_config.get('recipients_per_minute', 0)),
+            'messages_per_day': int(rate_config.get('messages_per_day', 0)),
+            'recipients_per_day': int(rate_config.get('recipients_per_day', 0)),
+            'burst': max(1, int(rate_config.get('burst', 5))),
+            'when_exhausted': when_exhausted,
+        }
+
+    def get_routing_settings(self):
+        """
+        How batches spread over several SMTP profiles, from the [ROUTING]
+        section.
+        """
+        routing_config = self.config['ROUTING'] if self.config.has_section('ROUTING') else {}
+        strategy = routing_config.get('strategy', 'weighted').strip().lower()
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing strategy '{strategy}', expected one of {ROUTING_STRATEGIES}.")
+        return {
+            'strategy': strategy,
+            'failure_threshold': max(1, int(routing_config.get('failure_threshold', 3))),
+            'cooldown': float(routing_config.get('cooldown_seconds', 60)),
+        }
+
+    def get_metrics_settings(self):
+        """
+        Whether per-stage timings and counters are collected, read from the
+        [METRICS] section, and where headless runs export them. A relative
+        textfile is placed next to the application.
+        """
+        metrics_config = self.config['METRICS'] if self.config.has_section('METRICS') else {}
+        textfile = metrics_config.get('textfile', '').strip()
+        if textfile and not os.path.isabs(textfile):
+            textfile = os.path.join(APP_PATH, textfile)
+        return {
+            'enabled': metrics_config.get('enabled', 'true').strip().lower() == 'true',
+            'textfile': textfile,
+            'port': int(metrics_config.get('http_port', 0)),
+            'host': metrics_config.get('http_host', '127.0.0.1').strip() or '127.0.0.1',
+            'interval': float(metrics_config.get('write_interval_seconds', 15)),
+        }
+
+    def set_profile_password(self, name, password):
+        """
+        Stores the encrypted password of an SMTP profile.
+        """
+        self.config[self._profile_section(name)]['password'] = encrypt_password(password)
+        self.save_config()
+
     def update_smtp_config(self, server, port, email, password, use_tls, use_ssl):
         self.config['SMTP']['server'] = server
         self.config['SMTP']['port'] = str(port)
@@ -58,6 +555,9 @@ class ConfigManager:
         self.config['SMTP']['use_ssl'] = str(use_ssl)
         self.save_config()
 
-    def get_decrypted_password(self):
-        encrypted = self.config['SMTP'].get('password', '')
-        return decrypt_password(encrypted)
+    def get_decrypted_password(self, section='SMTP'):
+        encrypted = self.config[section].get('password', '')
+        cached = self._password_cache.get(section)
+        if cached is None or cached[0] != encrypted:
+            cached = self._password_cache[section] = (encrypted, decrypt_password(encrypted))
+        return cached[1]
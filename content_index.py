@@ -0,0 +1,156 @@
+import os
+import sys
+import hashlib
+import sqlite3
+import datetime
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from delivery_journal import normalize_recipients
+from metrics import registry
+
+if getattr(sys, 'frozen', False):
+    APP_PATH = os.path.dirname(sys.executable)
+else:
+    APP_PATH = os.path.dirname(os.path.abspath(__file__))
+
+CONTENT_INDEX_FILE = os.path.join(APP_PATH, 'content_index.db')
+
+# Files are hashed in blocks of this size, so memory use does not depend on
+# the file size
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    key TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_deliveries_digest ON deliveries (digest);
+"""
+
+
+def file_digest(file_path):
+    """
+    SHA-256 of the file's content, read in blocks, as hex.
+    """
+    with registry.timer('hash'):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(HASH_CHUNK_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.hexdigest()
+
+
+def delivery_key(digest, recipient_email, subject=None, body=None):
+    """
+    Identity of a delivery: the file's content and the recipient set, plus
+    the subject and body when a mail merge rendered them, so different
+    messages with the same attachment are not mistaken for each other.
+    """
+    key = hashlib.sha256(f"{digest}\0{normalize_recipients(recipient_email)}".encode('utf-8'))
+    if subject is not None or body is not None:
+        key.update(f"\0{subject or ''}\0{body or ''}".encode('utf-8'))
+    return key.hexdigest()
+
+
+def message_id(key, domain):
+    """
+    Message-ID for the delivery with key. The same content to the same
+    recipients always gets the same one, so a resend can be recognised by
+    the receiving side.
+    """
+    return f"<{key[:40]}@{domain}>"
+
+
+class ContentIndex:
+    """
+    SQLite index of delivered content, keyed by delivery_key. Catches the
+    same file sent twice to the same recipients under another name or from
+    another folder, and files that were sent but could not be moved to
+    SENTEMAILS. With window_days, older deliveries no longer count.
+    """
+    def __init__(self, path=None, window_days=0):
+        self.path = path or CONTENT_INDEX_FILE
+        self.window_days = window_days
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def lookup(self, key):
+        """
+        The earlier delivery with key as a dict (filename, recipient,
+        message_id, timestamp), or None.
+        """
+        query = "SELECT filename, recipient, message_id, timestamp FROM deliveries WHERE key = ?"
+        params = [key]
+        if self.window_days:
+            query += " AND timestamp >= ?"
+            params.append((datetime.datetime.now() - datetime.timedelta(days=self.window_days))
+                          .isoformat(timespec='seconds'))
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('filename', 'recipient', 'message_id', 'timestamp'), row))
+
+    def record(self, key, digest, file_path, recipient_email, message_id):
+        row = (key, digest, normalize_recipients(recipient_email), os.path.basename(file_path), message_id,
+               datetime.datetime.now().isoformat(timespec='seconds'))
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO deliveries (key, digest, recipient, filename, message_id, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", row)
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to write to content index: {e}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ContentHasher:
+    """
+    Hashes files on worker threads (hashlib releases the GIL), keeping up
+    to lookahead files in progress ahead of the one being sent.
+    """
+    def __init__(self, workers=4):
+        self.workers = max(1, workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="content-hash")
+
+    def hashed(self, items, path_of, lookahead=None):
+        """
+        Yields (item, digest, error) for every item in order; path_of gives
+        the file of an item. lookahead defaults to a few files per worker;
+        use 1 for sources that wait for new items, so none is held back.
+        """
+        lookahead = lookahead or self.workers * 4
+        pending = deque()
+        for item in items:
+            pending.append((item, self._executor.submit(file_digest, path_of(item))))
+            while len(pending) >= lookahead:
+                yield self._result(*pending.popleft())
+        while pending:
+            yield self._result(*pending.popleft())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def _result(item, future):
+        try:
+            return item, future.result(), None
+        except OSError as e:
+            return item, None, e
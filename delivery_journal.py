@@ -0,0 +1,158 @@
+import os
+import sys
+import uuid
+import sqlite3
+import datetime
+import threading
+import logging
+
+if getattr(sys, 'frozen', False):
+    APP_PATH = os.path.dirname(sys.executable)
+else:
+    APP_PATH = os.path.dirname(os.path.abspath(__file__))
+
+JOURNAL_FILE = os.path.join(APP_PATH, 'delivery_journal.db')
+
+STATUS_SENT = 'SENT'
+STATUS_FAILED = 'FAILED'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL,
+    file_size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_deliveries_filename ON deliveries (filename);
+CREATE INDEX IF NOT EXISTS idx_deliveries_recipient ON deliveries (recipient);
+CREATE INDEX IF NOT EXISTS idx_deliveries_status ON deliveries (status);
+CREATE INDEX IF NOT EXISTS idx_deliveries_timestamp ON deliveries (timestamp);
+CREATE INDEX IF NOT EXISTS idx_deliveries_resume ON deliveries (recipient, status, file_path);
+"""
+
+
+def file_version(file_path):
+    """
+    (size, mtime_ns) of file_path, telling apart a file from a later one
+    saved under the same name, or (None, None) if it cannot be read.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None, None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def normalize_recipients(recipient_email):
+    """
+    Canonical form of a recipient list, so "b@x.com, a@x.com" and
+    "a@x.com,b@x.com" are treated as the same delivery target.
+    """
+    if isinstance(recipient_email, str):
+        recipient_email = recipient_email.split(',')
+    return ",".join(sorted({e.strip().lower() for e in recipient_email if e.strip()}))
+
+
+class DeliveryJournal:
+    """
+    SQLite record of every delivery attempt. Used to skip files that were
+    already delivered to the same recipients, so a crashed or interrupted
+    batch resumes where it stopped instead of starting over. Files are
+    matched on path, size and modification time, so a new file saved under
+    the name of a delivered one is still sent.
+    """
+    def __init__(self, path=None):
+        self.path = path or JOURNAL_FILE
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # Journals written before file versions were recorded
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(deliveries)")}
+        for column in ('file_size', 'mtime_ns'):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE deliveries ADD COLUMN {column} INTEGER")
+        self._conn.commit()
+
+    def start_batch(self):
+        return datetime.datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:8]
+
+    def record(self, batch_id, file_path, recipient_email, status, error_msg=""):
+        row = (batch_id, os.path.abspath(file_path), os.path.basename(file_path),
+               normalize_recipients(recipient_email), status, error_msg,
+               datetime.datetime.now().isoformat(timespec='seconds'), *file_version(file_path))
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO deliveries (batch_id, file_path, filename, recipient, status, error, timestamp, "
+                    "file_size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to write to delivery journal: {e}")
+
+    def delivered_files(self, recipient_email):
+        """
+        (absolute path, size, mtime_ns) of every file version already
+        delivered to recipient_email; see file_version.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT file_path, file_size, mtime_ns FROM deliveries "
+                "WHERE recipient = ? AND status = ? AND file_size IS NOT NULL",
+                (normalize_recipients(recipient_email), STATUS_SENT)).fetchall()
+        return set(rows)
+
+    def is_delivered(self, file_path, recipient_email):
+        """
+        True if this version of file_path was already delivered to
+        recipient_email. A file that no longer exists (e.g. moved away by a
+        sender that died before reporting) is matched on its path alone.
+        """
+        query = "SELECT 1 FROM deliveries WHERE recipient = ? AND status = ? AND file_path = ?"
+        params = [normalize_recipients(recipient_email), STATUS_SENT, os.path.abspath(file_path)]
+        size, mtime_ns = file_version(file_path)
+        if size is not None:
+            query += " AND file_size = ? AND mtime_ns = ?"
+            params += [size, mtime_ns]
+        with self._lock:
+            row = self._conn.execute(query + " LIMIT 1", params).fetchone()
+        return row is not None
+
+    def history(self, filename=None, recipient_email=None, status=None, since=None, limit=1000):
+        """
+        Returns matching deliveries, newest first, as dicts.
+        """
+        clauses, params = [], []
+        if filename:
+            clauses.append("filename = ?")
+            params.append(filename)
+        if recipient_email:
+            clauses.append("recipient = ?")
+            params.append(normalize_recipients(recipient_email))
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        query = "SELECT batch_id, file_path, filename, recipient, status, error, timestamp FROM deliveries"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,161 @@
+import os
+import fnmatch
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Folder delivered files are moved into; never scanned, so nothing is resent
+SENT_DIR_NAME = "SENTEMAILS"
+
+# Files are published to readers in chunks of this many entries, so a huge
+# single directory still streams instead of appearing all at once
+PUBLISH_EVERY = 256
+
+
+def parse_patterns(value):
+    """
+    Splits a comma or whitespace separated list of glob patterns.
+    """
+    return tuple(p for p in value.replace(',', ' ').split() if p)
+
+
+def _matches(patterns, rel_path, name):
+    # Patterns with a slash are matched against the path relative to the
+    # scanned directory, the others against the name alone
+    return any(fnmatch.fnmatch(rel_path if '/' in pattern else name, pattern) for pattern in patterns)
+
+
+class DirectoryScanner:
+    """
+    Lists the files to send in a directory on background threads, using
+    os.scandir so most entries need no extra stat call. With recursive,
+    subdirectories are scanned in parallel by up to workers threads.
+
+    Hidden entries and SENTEMAILS folders are skipped; include patterns
+    (if any) select files, exclude patterns drop files and whole folders.
+
+    Iterating yields files as they are found and only ends once the scan is
+    complete, so a batch can start sending before the scan finishes.
+    Several iterators may run at once, each seeing every file.
+    """
+    def __init__(self, directory, recursive=False, include=(), exclude=(), workers=4):
+        self.directory = os.path.abspath(directory)
+        self.recursive = recursive
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.workers = max(1, workers)
+        self.files = []
+        self.errors = []
+        self.done = False
+
+        self._changed = threading.Condition()
+        self._pending = 0
+        self._executor = None
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts scanning in the background. Returns self.
+        """
+        with self._changed:
+            if self._executor is not None:
+                return self
+            self._executor = ThreadPoolExecutor(max_workers=self.workers if self.recursive else 1,
+                                                thread_name_prefix="scanner")
+            self._pending = 1
+        self._executor.submit(self._scan, self.directory, "")
+        return self
+
+    def stop(self):
+        """
+        Stops scanning; iterators end after the files found so far.
+        """
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the scan is complete. Returns True if it is.
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self.done, timeout)
+
+    def found_since(self, start):
+        """
+        Files found after the first start ones, for polling readers.
+        """
+        with self._changed:
+            return self.files[start:]
+
+    def __iter__(self):
+        self.start()
+        position = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: position < len(self.files) or self.done or self._stopped)
+                batch = self.files[position:]
+                finished = self.done or self._stopped
+            position += len(batch)
+            yield from batch
+            if finished and not batch:
+                return
+
+    def _scan(self, directory, rel_dir):
+        chunk = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if self._stopped:
+                        break
+                    name = entry.name
+                    if name.startswith('.'):
+                        continue
+                    rel_path = f"{rel_dir}/{name}" if rel_dir else name
+                    try:
+                        # Symlinked folders are not followed, so links cannot loop
+                        if entry.is_dir(follow_symlinks=False):
+                            if (self.recursive and name != SENT_DIR_NAME
+                                    and not _matches(self.exclude, rel_path, name)):
+                                self._submit(entry.path, rel_path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError as e:
+                        self._record_error(entry.path, e)
+                        continue
+                    if self.include and not _matches(self.include, rel_path, name):
+                        continue
+                    if _matches(self.exclude, rel_path, name):
+                        continue
+                    chunk.append(entry.path)
+                    if len(chunk) >= PUBLISH_EVERY:
+                        self._publish(sorted(chunk))
+                        chunk = []
+        except OSError as e:
+            self._record_error(directory, e)
+        finally:
+            self._publish(sorted(chunk), finished_dir=True)
+
+    def _submit(self, directory, rel_dir):
+        with self._changed:
+            if self._stopped:
+                return
+            self._pending += 1
+        self._executor.submit(self._scan, directory, rel_dir)
+
+    def _publish(self, paths, finished_dir=False):
+        with self._changed:
+            self.files.extend(paths)
+            if finished_dir:
+                self._pending -= 1
+                if self._pending == 0:
+                    self.done = True
+            self._changed.notify_all()
+        if finished_dir and self.done:
+            self._executor.shutdown(wait=False)
+
+    def _record_error(self, path, error):
+        logging.warning(f"Could not scan {path}: {error}")
+        with self._changed:
+            self.errors.append((path, error))
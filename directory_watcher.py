@@ -0,0 +1,167 @@
+import os
+import sys
+import stat
+import time
+import errno
+import struct
+import select
+import threading
+import ctypes
+import ctypes.util
+import logging
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """
+    Thin ctypes wrapper around the Linux inotify API, watching one directory.
+    """
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err))
+
+    def read_names(self, timeout):
+        """
+        Waits up to timeout seconds and returns the names of entries that
+        changed since the last call, or None if events were lost and the
+        directory has to be rescanned.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+
+        names = set()
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """
+    Iterable that yields files from a directory as soon as they are complete,
+    and keeps waiting for new ones until stop() is called.
+
+    A file counts as complete once its size and modification time have not
+    changed for settle_seconds, so files that are still being copied in are
+    not picked up half written. Uses inotify on Linux and falls back to
+    polling every poll_interval seconds elsewhere.
+    """
+    def __init__(self, directory, settle_seconds=2.0, poll_interval=1.0, use_inotify=True):
+        self.directory = directory
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def __iter__(self):
+        return self.watch()
+
+    def watch(self):
+        notifier = self._open_inotify()
+        # path -> (size, mtime_ns, time of last change) for files still settling
+        settling = {}
+        # path -> (size, mtime_ns) of files already handed out
+        yielded = {}
+
+        for name in os.listdir(self.directory):
+            self._observe(os.path.join(self.directory, name), settling, yielded)
+
+        try:
+            while not self._stopped.is_set():
+                if notifier is not None:
+                    # Wake up at least often enough to notice settled files
+                    timeout = min(self.poll_interval, self.settle_seconds / 2) if settling else self.poll_interval
+                    names = notifier.read_names(timeout)
+                    if names is None:
+                        names = os.listdir(self.directory)
+                    for name in names:
+                        self._observe(os.path.join(self.directory, name), settling, yielded)
+                    for path in list(settling):
+                        self._observe(path, settling, yielded)
+                else:
+                    self._stopped.wait(self.poll_interval)
+                    present = {os.path.join(self.directory, name) for name in os.listdir(self.directory)}
+                    for path in present | set(settling) | set(yielded):
+                        self._observe(path, settling, yielded)
+
+                now = time.monotonic()
+                for path, (size, mtime_ns, changed_at) in list(settling.items()):
+                    if now - changed_at < self.settle_seconds:
+                        continue
+                    del settling[path]
+                    yielded[path] = (size, mtime_ns)
+                    if self._stopped.is_set():
+                        return
+                    yield path
+        finally:
+            if notifier is not None:
+                notifier.close()
+
+    def _open_inotify(self):
+        if not self.use_inotify or not sys.platform.startswith('linux'):
+            return None
+        try:
+            return _Inotify(self.directory)
+        except (OSError, AttributeError) as e:
+            logging.info(f"inotify unavailable, polling {self.directory} instead: {e}")
+            return None
+
+    def _observe(self, path, settling, yielded):
+        if os.path.basename(path).startswith('.'):
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            # Gone (e.g. moved to SENTEMAILS): forget it so a new file with
+            # the same name is picked up again
+            settling.pop(path, None)
+            yielded.pop(path, None)
+            return
+
+        state = (st.st_size, st.st_mtime_ns)
+        if yielded.get(path) == state:
+            return
+        previous = settling.get(path)
+        if previous is None or previous[:2] != state:
+            settling[path] = state + (time.monotonic(),)
@@ -1,38 +1,104 @@
 import smtplib
+import io
 import os
+import base64
+import zipfile
 import mimetypes
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
-from email import encoders
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 from config_manager import ConfigManager
+from streaming_mime import StreamingMessage
+from message_cache import shared_cache
+from smtp_pool import SMTPSession, SMTPConnectionPool, MessageTooLargeError, is_connection_error
+from metrics import registry
 import logging
 
 class EmailSender:
-    def __init__(self, config_manager: ConfigManager):
+    def __init__(self, config_manager: ConfigManager, max_connections=1, settings=None):
         self.config_manager = config_manager
+        # Resolved once; the hot path never touches configparser or the key file.
+        # settings selects an SMTP profile other than the default one.
+        self.settings = settings or config_manager.get_smtp_settings()
+        self.attachment_cache = shared_cache(self.settings.message_cache_bytes)
+        self.max_connections = max_connections
+        self.pool = None
+        self._pool_lock = threading.Lock()
 
-    @retry(
-        stop=stop_after_attempt(3), 
-        wait=wait_fixed(5),
-        retry=retry_if_exception_type((smtplib.SMTPException, OSError))
-    )
-    def send_email(self, to_email, file_path):
+    def _get_pool(self):
+        with self._pool_lock:
+            if self.pool is None:
+                self.pool = self._create_pool()
+            return self.pool
+
+    def session_settings(self):
         """
-        Sends an email with the specified file as attachment.
-        Retries 3 times with 5 seconds wait on failure.
+        Connection parameters for SMTPSession.
         """
-        smtp_config = self.config_manager.get_smtp_config()
-        smtp_server = smtp_config.get('server')
-        smtp_port = int(smtp_config.get('port', 587))
-        sender_email = smtp_config.get('email')
-        
-        # Get decrypted password
-        sender_password = self.config_manager.get_decrypted_password()
-        
-        use_tls = smtp_config.get('use_tls', 'true').lower() == 'true'
-        use_ssl = smtp_config.get('use_ssl', 'false').lower() == 'true'
+        settings = self.settings
+        return {
+            'server': settings.server,
+            'port': settings.port,
+            'email': settings.email,
+            'password': settings.password,
+            'use_tls': settings.use_tls,
+            'use_ssl': settings.use_ssl,
+            'max_messages': settings.max_messages_per_connection,
+            'binary_mime': settings.binary_mime,
+        }
+
+    def _create_pool(self):
+        settings = self.session_settings()
+
+        def session_factory():
+            return SMTPSession(**settings)
+
+        return SMTPConnectionPool(session_factory, max_size=self.max_connections)
+
+    def _sendmail(self, sender_email, recipients, message):
+        """
+        Sends over a pooled session. If a reused session turns out to have been
+        closed by the server (disconnect or 421), the message is sent once more
+        on a fresh connection before the error is reported.
+        """
+        pool = self._get_pool()
+        while True:
+            session = pool.acquire()
+            reused = session.messages_sent > 0
+            try:
+                failed_recipients = session.sendmail(sender_email, recipients, message)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, MessageTooLargeError) as e:
+                # No transaction left open (smtplib resets it), the connection is fine
+                pool.release(session, discard=is_connection_error(e))
+                raise
+            except Exception as e:
+                pool.release(session, discard=True)
+                if reused and is_connection_error(e):
+                    logging.info(f"SMTP session {session.session_id} was closed by the server "
+                                 f"after {session.messages_sent} message(s), reconnecting: {e}")
+                    continue
+                raise
+            pool.release(session)
+            return failed_recipients
+
+    def close(self):
+        """
+        Closes all pooled sessions. Returns (session_id, messages_sent) for
+        every connection used by this sender.
+        """
+        if self.pool is None:
+            return []
+        self.pool.close_all()
+        return self.pool.connection_stats()
+
+    def _new_message(self, to_email, subject, body, message_id=None):
+        """
+        Starts an email with the envelope headers and text body filled in.
+        Returns (sender_email, recipients, msg).
+        """
+        sender_email = self.settings.email
+        sender_password = self.settings.password
 
         if not sender_email or not sender_password:
             raise ValueError("Email credentials are not configured properly.")
@@ -49,66 +115,139 @@ class EmailSender:
             recipients = [e.strip() for e in to_email.split(',') if e.strip()]
             msg['To'] = to_email
             
-        filename = os.path.basename(file_path)
-        msg['Subject'] = filename
-        
-        body = f"Please find the attached file: {filename}"
+        msg['Subject'] = subject
+        if message_id:
+            # Kept across retries and relays, so a resend can be recognised
+            msg['Message-ID'] = message_id
         msg.attach(MIMEText(body, 'plain'))
+        return sender_email, recipients, msg
+
+    def _attachment_part(self, payload, filename):
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(payload)
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header(
+            "Content-Disposition",
+            f"attachment; filename= {filename}",
+        )
+        return part
+
+    def build_message(self, to_email, file_path, filename=None, subject=None, body=None, message_id=None):
+        """
+        Builds the email for file_path. Returns (sender_email, recipients, message)
+        where message is the full text, or a StreamingMessage for files larger
+        than stream_threshold_mb so the attachment is never held in memory,
+        and for every file with binary_mime on, so each session can send it
+        raw or in base64 depending on what its server announced.
+        filename overrides the attachment name (e.g. for a compressed copy);
+        subject and body replace the defaults (e.g. rendered by a mail merge).
+        """
+        filename = filename or os.path.basename(file_path)
+        sender_email, recipients, msg = self._new_message(
+            to_email,
+            filename if subject is None else subject,
+            f"Please find the attached file: {filename}" if body is None else body,
+            message_id)
 
         # Attachment
         try:
             with open(file_path, "rb") as attachment:
-                part = MIMEBase("application", "octet-stream")
-                part.set_payload(attachment.read())
-            
-            encoders.encode_base64(part)
-            part.add_header(
-                "Content-Disposition",
-                f"attachment; filename= {filename}",
-            )
-            msg.attach(part)
+                if (self.settings.binary_mime
+                        or os.fstat(attachment.fileno()).st_size > self.settings.stream_threshold_bytes):
+                    return sender_email, recipients, StreamingMessage(msg, file_path, filename)
+
+                # Encoded once per file version; retries and other recipients reuse it
+                encoded = self.attachment_cache.encoded(attachment, file_path)
+            msg.attach(self._attachment_part(encoded, filename))
         except Exception as e:
             logging.error(f"Failed to read file {file_path}: {e}")
             raise e
 
-        # Sending
+        with registry.timer('encode'):
+            return sender_email, recipients, msg.as_string()
+
+    def build_bundle_message(self, to_email, file_paths, compress=False, message_id=None):
+        """
+        Builds one email carrying every file in file_paths, as separate
+        attachments or, with compress, as a single zip archive. Returns
+        (sender_email, recipients, message) like build_message.
+        """
+        filenames = [os.path.basename(p) for p in file_paths]
+        subject = f"{filenames[0]} and {len(filenames) - 1} more file(s)"
+        body = "Please find the attached files:\n" + "\n".join(f"- {name}" for name in filenames)
+        sender_email, recipients, msg = self._new_message(to_email, subject, body, message_id)
+
         try:
-            logging.debug(f"Connecting to SMTP server: {smtp_server}:{smtp_port} (SSL: {use_ssl}, TLS: {use_tls})")
-            
-            if use_ssl:
-                server = smtplib.SMTP_SSL(smtp_server, smtp_port)
-            else:
-                server = smtplib.SMTP(smtp_server, smtp_port)
-                
-            server.set_debuglevel(1 if logging.getLogger().getEffectiveLevel() == logging.DEBUG else 0)
-            
-            # Identify to server
-            code, response = server.ehlo()
-            logging.debug(f"EHLO response: {code} {response}")
-            
-            if use_tls and not use_ssl:
-                logging.debug("Starting TLS...")
-                server.starttls()
-                code, response = server.ehlo() # Re-identify after TLS
-                logging.debug(f"EHLO (after TLS) response: {code} {response}")
-            
-            # Verify connection
-            code, response = server.noop()
-            if code != 250:
-                 logging.warning(f"NOOP check failed: {code} {response}")
+            if compress:
+                archive = io.BytesIO()
+                with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+                    for file_path, filename in zip(file_paths, filenames):
+                        zf.write(file_path, arcname=filename)
+                archive_name = f"{os.path.splitext(filenames[0])[0]}_and_{len(filenames) - 1}_more.zip"
+                msg.attach(self._attachment_part(
+                    base64.encodebytes(archive.getvalue()).decode('ascii'), archive_name))
             else:
-                 logging.debug("Connection verified (NOOP OK).")
+                for file_path, filename in zip(file_paths, filenames):
+                    with open(file_path, "rb") as attachment:
+                        encoded = self.attachment_cache.encoded(attachment, file_path)
+                    msg.attach(self._attachment_part(encoded, filename))
+        except Exception as e:
+            logging.error(f"Failed to read files for bundle {subject}: {e}")
+            raise e
 
-            logging.debug(f"Logging in as {sender_email}...")
-            server.login(sender_email, sender_password)
-            
-            text = msg.as_string()
+        with registry.timer('encode'):
+            return sender_email, recipients, msg.as_string()
+
+    def build_split_messages(self, to_email, file_path, filename, part_bytes, message_id=None):
+        """
+        Builds one email per part_bytes slice of file_path, for a file too
+        large for the server to take in one message. Parts are attached as
+        <filename>.001, .002, ... and are always streamed. Each part's
+        Message-ID is message_id with the part number added.
+        """
+        count = max(1, -(-os.path.getsize(file_path) // part_bytes))
+        messages = []
+        for index in range(count):
+            subject = f"{filename} (part {index + 1} of {count})"
+            body = (f"Please find attached part {index + 1} of {count} of {filename}.\n"
+                    f"Join the parts in order to restore it, e.g. cat {filename}.0* > {filename}")
+            part_id = None
+            if message_id:
+                local_part, _, domain = message_id.strip('<>').partition('@')
+                part_id = f"<{local_part}.{index + 1}@{domain}>"
+            sender_email, recipients, msg = self._new_message(to_email, subject, body, part_id)
+            messages.append((sender_email, recipients, StreamingMessage(
+                msg, file_path, f"{filename}.{index + 1:03d}", offset=index * part_bytes, length=part_bytes)))
+        return messages
+
+    def server_size_limit(self):
+        """
+        Message size limit announced by the server (EHLO SIZE), 0 if none.
+        """
+        pool = self._get_pool()
+        session = pool.acquire()
+        try:
+            return session.max_message_size
+        finally:
+            pool.release(session)
+
+    def send_email(self, to_email, file_path):
+        """
+        Sends an email with the specified file as attachment. Makes a single
+        attempt; retries are scheduled by the caller (see retry_scheduler).
+        """
+        sender_email, recipients, message = self.build_message(to_email, file_path)
+        return self.send_message(sender_email, recipients, message, os.path.basename(file_path))
+
+    def send_message(self, sender_email, recipients, message, filename):
+        """
+        Sends a message returned by build_message.
+        """
+        try:
             logging.debug(f"Sending email to {recipients}...")
             
             # sendmail returns a dict of failed recipients, empty if all success
-            failed_recipients = server.sendmail(sender_email, recipients, text)
-            
-            server.quit()
+            failed_recipients = self._sendmail(sender_email, recipients, message)
             
             if failed_recipients:
                 error_msg = f"Failed to send to some recipients: {failed_recipients}"
@@ -1,17 +1,178 @@
 import sys
 import os
-import shutil
 import logging
 import smtplib
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                                QHBoxLayout, QLabel, QLineEdit, QPushButton, 
-                               QFileDialog, QCheckBox, QProgressBar, QTextEdit, 
+                               QFileDialog, QCheckBox, QProgressBar, QPlainTextEdit, 
                                QMessageBox, QDialog, QFormLayout, QGroupBox,
-                               QStyle, QTableWidget, QTableWidgetItem, QHeaderView)
-from PySide6.QtCore import Qt, QThread, Signal
+                               QStyle, QTableView, QHeaderView, QGridLayout)
+from PySide6.QtCore import Qt, QThread, Signal, QTimer, QAbstractTableModel, QModelIndex
+from PySide6.QtGui import QColor
 from config_manager import ConfigManager
 from logger_manager import LoggerManager
-from email_sender import EmailSender
+from batch_sender import BatchSender, format_eta
+from directory_watcher import DirectoryWatcher
+from directory_scanner import DirectoryScanner
+from outbox import Outbox, OutboxSource
+from metrics import registry, STAGES
+
+# Worker updates are buffered and applied to the widgets at most this often
+UI_REFRESH_MS = 100
+# The activity log keeps only the most recent lines
+LOG_MAX_LINES = 5000
+# How often the statistics panel is refreshed while sending
+STATS_REFRESH_MS = 1000
+
+class StatusTableModel(QAbstractTableModel):
+    """
+    File/status rows for the dashboard, with a path -> row index so status
+    updates do not have to search the table. Rows are keyed on the full path,
+    so files of the same name in different subdirectories keep their own
+    row; they are shown relative to root.
+    """
+    HEADERS = ["File", "Status"]
+    COLORS = {"SENT": QColor(Qt.green), "FAILED": QColor(Qt.red)}
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []
+        self._index = {}
+        self.root = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            return row[index.column()]
+        if role == Qt.ToolTipRole and index.column() == 0:
+            return row[2]
+        if role == Qt.BackgroundRole and index.column() == 1:
+            return self.COLORS.get(row[1])
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def set_files(self, paths, root=None):
+        self.beginResetModel()
+        self.root = root
+        self._rows = []
+        self._index = {}
+        for path in paths:
+            self._append(path)
+        self.endResetModel()
+
+    def add_files(self, paths):
+        """
+        Appends PENDING rows for files not in the table yet, e.g. as a scan
+        finds them.
+        """
+        new_paths = [path for path in dict.fromkeys(paths) if self._key(path) not in self._index]
+        if not new_paths:
+            return
+        first = len(self._rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(new_paths) - 1)
+        for path in new_paths:
+            self._append(path)
+        self.endInsertRows()
+
+    def update_statuses(self, statuses):
+        """
+        Applies a {path: status} batch. Unknown files (picked up in watch
+        mode) are appended.
+        """
+        self.add_files(statuses)
+        changed = []
+        for path, status in statuses.items():
+            row = self._index[self._key(path)]
+            self._rows[row][1] = status
+            changed.append(row)
+        if changed:
+            self.dataChanged.emit(self.index(min(changed), 1), self.index(max(changed), 1))
+
+    def _key(self, path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def _append(self, path):
+        key = self._key(path)
+        if key in self._index:
+            return
+        shown = path
+        if self.root:
+            try:
+                shown = os.path.relpath(path, self.root)
+            except ValueError:
+                pass  # On another drive
+        self._index[key] = len(self._rows)
+        self._rows.append([shown, "PENDING", path])
+
+class StatsPanel(QGroupBox):
+    """
+    Live view of the metrics registry: count, average and maximum time of
+    each sending stage, and the main counters. Totals are since start-up.
+    """
+    COUNTER_LABELS = [("Messages sent", 'messages_sent'), ("Connections", 'connections'),
+                      ("Retries", 'retries'), ("Failovers", 'failovers')]
+
+    def __init__(self, parent=None):
+        super().__init__("Statistics", parent)
+        layout = QHBoxLayout(self)
+
+        stage_grid = QGridLayout()
+        for column, header in enumerate(["Stage", "Count", "Avg ms", "Max ms"]):
+            label = QLabel(f"<b>{header}</b>")
+            if column:
+                label.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+            stage_grid.addWidget(label, 0, column)
+        self.stage_labels = {}
+        for row, stage in enumerate(STAGES, start=1):
+            stage_grid.addWidget(QLabel(stage), row, 0)
+            labels = [QLabel("0") for _ in range(3)]
+            for column, label in enumerate(labels, start=1):
+                label.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                stage_grid.addWidget(label, row, column)
+            self.stage_labels[stage] = labels
+
+        counter_form = QFormLayout()
+        self.counter_labels = {}
+        for title, name in self.COUNTER_LABELS:
+            self.counter_labels[name] = QLabel("0")
+            counter_form.addRow(f"{title}:", self.counter_labels[name])
+        self.bytes_label = QLabel("0 MB")
+        counter_form.addRow("Data sent:", self.bytes_label)
+        self.failures_label = QLabel("none")
+        self.failures_label.setWordWrap(True)
+        counter_form.addRow("Failures by code:", self.failures_label)
+
+        layout.addLayout(stage_grid, 1)
+        layout.addLayout(counter_form, 1)
+
+    def refresh(self):
+        if not registry.enabled:
+            self.setTitle("Statistics (disabled in config.ini)")
+            return
+        snapshot = registry.snapshot()
+        for stage, (count, avg, peak) in self.stage_labels.items():
+            stats = snapshot['stages'][stage]
+            count.setText(str(stats['count']))
+            avg.setText(f"{stats['avg_ms']:.1f}")
+            peak.setText(f"{stats['max_ms']:.1f}")
+        counters = snapshot['counters']
+        for name, label in self.counter_labels.items():
+            label.setText(str(counters[name]))
+        self.bytes_label.setText(f"{counters['bytes_sent'] / (1024 * 1024):.1f} MB")
+        failures = snapshot['failures_by_code']
+        self.failures_label.setText(", ".join(f"{code}: {count}" for code, count in failures.items()) or "none")
 
 class ConfigDialog(QDialog):
     def __init__(self, config_manager, parent=None):
@@ -105,7 +266,8 @@ class ConfigDialog(QDialog):
             else:
                 smtp = smtplib.SMTP(server, int(port), timeout=10)
             
-            smtp.set_debuglevel(1)
+            # The protocol dump goes to stderr, so only with debug logging on
+            smtp.set_debuglevel(1 if logging.getLogger().getEffectiveLevel() == logging.DEBUG else 0)
             
             smtp.ehlo()
             if use_tls and not use_ssl:
@@ -136,71 +298,104 @@ class ConfigDialog(QDialog):
             QMessageBox.critical(self, "Error", f"Failed to save configuration: {str(e)}")
 
 class EmailWorker(QThread):
-    progress_signal = Signal(int)
+    progress_signal = Signal(int, object) # percent of bytes done, seconds left or None
     log_signal = Signal(str)
-    status_signal = Signal(str, str) # filename, status
+    status_signal = Signal(str, str) # file path, status
     finished_signal = Signal()
     
-    def __init__(self, file_list, recipient_email, config_manager, logger_manager):
+    def __init__(self, file_list, recipient_email, config_manager, logger_manager, audit_files=None,
+                 use_outbox=False, root=None):
         super().__init__()
-        self.file_list = file_list
+        self.file_list = file_list # or a DirectoryScanner still running, or a DirectoryWatcher
         self.recipient_email = recipient_email
+        # The scanned folder, which [SCHEDULE] priority patterns are relative to
+        self.root = root
         self.config_manager = config_manager
         self.logger_manager = logger_manager
+        # Paths for a new audit log's header, written here rather than on the UI thread
+        self.audit_files = audit_files
+        # Queue the files in the outbox first and send from there
+        self.use_outbox = use_outbox
+        self.batch_sender = None
         self.is_running = True
 
     def run(self):
-        email_sender = EmailSender(self.config_manager)
-        total_files = len(self.file_list)
-        
-        for i, file_path in enumerate(self.file_list):
-            if not self.is_running:
-                break
-            
-            filename = os.path.basename(file_path)
-            self.log_signal.emit(f"Processing {filename}...")
-            
-            try:
-                email_sender.send_email(self.recipient_email, file_path)
-
-                # Move file to SENTEMAILS folder
-                current_dir = os.path.dirname(file_path)
-                sent_dir = os.path.join(current_dir, "SENTEMAILS")
-                
-                if not os.path.exists(sent_dir):
-                    os.makedirs(sent_dir)
-                    
-                new_path = os.path.join(sent_dir, filename)
-                shutil.move(file_path, new_path)
-                
-                self.logger_manager.log_delivery_status(filename, self.recipient_email, True)
-                self.log_signal.emit(f"SUCCESS: Sent {filename} and moved to SENTEMAILS folder")
-                self.status_signal.emit(filename, "SENT")
-            except Exception as e:
-                error_msg = str(e)
-                self.logger_manager.log_delivery_status(filename, self.recipient_email, False, error_msg)
-                self.log_signal.emit(f"FAILURE: Could not send {filename}. Error: {error_msg}")
-                self.status_signal.emit(filename, "FAILED")
-            
-            self.progress_signal.emit(int((i + 1) / total_files * 100))
-        
-        self.finished_signal.emit()
+        try:
+            if self.audit_files is not None:
+                log_path = self.logger_manager.create_audit_log(self.audit_files)
+                self.log_signal.emit(f"Audit Log created: {log_path}")
+            self.batch_sender = BatchSender(self.config_manager, self.logger_manager,
+                                            on_log=self.log_signal.emit,
+                                            on_status=self.status_signal.emit,
+                                            on_progress=self.progress_signal.emit)
+            if self.is_running:
+                if self.use_outbox:
+                    self.send_from_outbox()
+                else:
+                    self.batch_sender.run(self.file_list, self.recipient_email, root=self.root)
+        except Exception as e:
+            # e.g. invalid settings, raised before any file is processed
+            logging.exception("Sending failed")
+            self.log_signal.emit(f"Error: {e}")
+        finally:
+            # The window re-enables its controls on this signal
+            self.finished_signal.emit()
+
+    def send_from_outbox(self):
+        """
+        Adds the files to the outbox, then sends everything waiting there,
+        including jobs an earlier run or a crashed sender left behind.
+        """
+        settings = self.config_manager.get_outbox_settings()
+        outbox = Outbox(settings['path'], settings['max_claims'])
+        source = OutboxSource(outbox, lease_seconds=settings['lease_seconds'],
+                              batch_size=settings['batch_size'], poll_interval=settings['poll_interval'])
+        try:
+            added = outbox.enqueue(self.file_list, self.recipient_email)
+            waiting = outbox.counts()
+            self.log_signal.emit(f"Added {added} file(s) to the outbox, "
+                                 f"{waiting['QUEUED'] + waiting['LEASED']} waiting.")
+            if self.is_running:
+                self.batch_sender.run(source)
+        except Exception as e:
+            logging.exception("Sending from the outbox failed")
+            self.log_signal.emit(f"Error: {e}")
+        finally:
+            source.close()
+            outbox.close()
 
     def stop(self):
         self.is_running = False
+        if self.batch_sender:
+            self.batch_sender.stop()
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Batch Email Sender")
-        self.resize(800, 600)
+        self.resize(800, 750)
         
         self.config_manager = ConfigManager()
-        self.logger_manager = LoggerManager()
+        self.logger_manager = LoggerManager(audit_settings=self.config_manager.get_audit_settings())
         self.worker = None
         self.file_list = []
+        self.scanner = None
+        self.scan_timer = QTimer(self)
+        self.scan_timer.setInterval(UI_REFRESH_MS)
+        self.scan_timer.timeout.connect(self.poll_scan)
+
+        self._pending_status = {}
+        self._pending_log = []
+        self._pending_progress = None
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(UI_REFRESH_MS)
+        self.refresh_timer.timeout.connect(self.flush_updates)
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setInterval(STATS_REFRESH_MS)
 
         self.init_ui()
+        self.stats_timer.timeout.connect(self.stats_panel.refresh)
 
     def init_ui(self):
         central_widget = QWidget()
@@ -239,6 +434,10 @@ class MainWindow(QMainWindow):
         
         self.debug_check = QCheckBox("Enable Debug Logging")
         self.debug_check.stateChanged.connect(self.toggle_debug)
+
+        self.watch_check = QCheckBox("Watch Directory")
+        self.watch_check.setToolTip("Keep running and send new files as soon as they arrive")
+        self.watch_check.stateChanged.connect(self.toggle_watch)
         
         self.send_btn = QPushButton("SEND EMAILS")
         self.send_btn.setStyleSheet("background-color: #4CAF50; color: white; font-weight: bold; padding: 10px;")
@@ -247,6 +446,7 @@ class MainWindow(QMainWindow):
 
         controls_layout.addWidget(config_btn)
         controls_layout.addWidget(self.debug_check)
+        controls_layout.addWidget(self.watch_check)
         controls_layout.addStretch()
         controls_layout.addWidget(self.send_btn)
         
@@ -260,9 +460,10 @@ class MainWindow(QMainWindow):
         left_layout = QVBoxLayout()
         self.progress_bar = QProgressBar()
         
-        self.status_table = QTableWidget()
-        self.status_table.setColumnCount(2)
-        self.status_table.setHorizontalHeaderLabels(["Filename", "Status"])
+        self.status_model = StatusTableModel(self)
+        self.status_table = QTableView()
+        self.status_table.setModel(self.status_model)
+        self.status_table.verticalHeader().setDefaultSectionSize(22)
         self.status_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
         self.status_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Fixed)
         self.status_table.setColumnWidth(1, 100)
@@ -274,8 +475,9 @@ class MainWindow(QMainWindow):
         
         # Right Column: Log
         right_layout = QVBoxLayout()
-        self.log_viewer = QTextEdit()
+        self.log_viewer = QPlainTextEdit()
         self.log_viewer.setReadOnly(True)
+        self.log_viewer.setMaximumBlockCount(LOG_MAX_LINES)
         
         right_layout.addWidget(QLabel("Activity Log:"))
         right_layout.addWidget(self.log_viewer)
@@ -285,7 +487,11 @@ class MainWindow(QMainWindow):
         dashboard_layout.addLayout(right_layout, 1) # Stretch factor 1
         
         dashboard_group.setLayout(dashboard_layout)
-        main_layout.addWidget(dashboard_group)
+        main_layout.addWidget(dashboard_group, 1)
+
+        # 4. Live statistics
+        self.stats_panel = StatsPanel()
+        main_layout.addWidget(self.stats_panel)
 
     def browse_directory(self):
         directory = QFileDialog.getExistingDirectory(self, "Select Directory")
@@ -294,99 +500,182 @@ class MainWindow(QMainWindow):
             self.scan_directory(directory)
 
     def scan_directory(self, directory):
+        """
+        Starts listing directory on background threads; poll_scan fills the
+        table as files are found, and sending may start before it is done.
+        """
+        if self.scanner:
+            self.scanner.stop()
+        self.file_list = []
+        self.status_model.set_files([], root=directory)
+        self.send_btn.setEnabled(self.watch_check.isChecked())
         try:
-            # Get all files (filtering out directories)
-            self.file_list = [os.path.join(directory, f) for f in os.listdir(directory) 
-                              if os.path.isfile(os.path.join(directory, f)) and not f.startswith('.')]
-            
-            if not self.file_list:
-                QMessageBox.warning(self, "No Files", "No files found in the selected directory.")
-                self.send_btn.setEnabled(False)
-                return
+            self.scanner = DirectoryScanner(directory, **self.config_manager.get_scan_settings()).start()
+            self.update_log(f"Scanning {directory}...")
+            self.scan_timer.start()
 
-            self.log_viewer.append(f"Found {len(self.file_list)} files.")
-            self.log_viewer.append("Initializing Audit Log...")
-            
-            # Populate Table
-            self.status_table.setRowCount(len(self.file_list))
-            for row, file_path in enumerate(self.file_list):
-                filename = os.path.basename(file_path)
-                self.status_table.setItem(row, 0, QTableWidgetItem(filename))
-                self.status_table.setItem(row, 1, QTableWidgetItem("PENDING"))
-            
-            # Create Audit Log
-            log_path = self.logger_manager.create_audit_log([os.path.basename(f) for f in self.file_list])
-            self.log_viewer.append(f"Audit Log created: {log_path}")
-            
             # Ensure SENTEMAILS folder exists immediately upon selection
             sent_dir = os.path.join(directory, "SENTEMAILS")
             if not os.path.exists(sent_dir):
                 try:
                     os.makedirs(sent_dir)
-                    self.log_viewer.append(f"Created SENTEMAILS folder at: {sent_dir}")
+                    self.update_log(f"Created SENTEMAILS folder at: {sent_dir}")
                 except Exception as e:
-                    self.log_viewer.append(f"Warning: Could not create SENTEMAILS folder: {e}")
+                    self.update_log(f"Warning: Could not create SENTEMAILS folder: {e}")
 
-            self.send_btn.setEnabled(True)
-            
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Error scanning directory: {str(e)}")
             self.file_list = []
             self.send_btn.setEnabled(False)
 
+    def poll_scan(self):
+        scanner = self.scanner
+        if scanner is None:
+            self.scan_timer.stop()
+            return
+        done = scanner.done
+        found = scanner.found_since(len(self.file_list))
+        if found:
+            self.file_list.extend(found)
+            self.status_model.add_files(found)
+            if not (self.worker and self.worker.isRunning()):
+                self.send_btn.setEnabled(True)
+        if not done:
+            return
+
+        self.scan_timer.stop()
+        root_errors = [error for path, error in scanner.errors if path == scanner.directory]
+        if root_errors:
+            QMessageBox.critical(self, "Error", f"Error scanning directory: {root_errors[0]}")
+            return
+        if scanner.errors:
+            path, error = scanner.errors[0]
+            self.update_log(f"Warning: {len(scanner.errors)} item(s) could not be read, e.g. {path}: {error}")
+        if not self.file_list:
+            QMessageBox.warning(self, "No Files", "No files found in the selected directory.")
+            return
+        self.update_log(f"Found {len(self.file_list)} files.")
+
     def open_config(self):
         dialog = ConfigDialog(self.config_manager, self)
         dialog.exec()
 
     def toggle_debug(self, state):
         self.logger_manager.set_debug_mode(state == Qt.Checked)
-        self.log_viewer.append(f"Debug mode {'enabled' if state == Qt.Checked else 'disabled'}.")
+        self.update_log(f"Debug mode {'enabled' if state == Qt.Checked else 'disabled'}.")
+
+    def toggle_watch(self, state):
+        if self.dir_input.text() and not (self.worker and self.worker.isRunning()):
+            self.send_btn.setEnabled(bool(self.file_list) or self.watch_check.isChecked())
 
     def start_sending(self):
+        # While watching, the button stops the watcher instead
+        if self.worker and self.worker.isRunning():
+            self.send_btn.setEnabled(False)
+            self.update_log("Stopping directory watch...")
+            self.worker.stop()
+            return
+
         recipient = self.email_input.text()
         if not recipient:
             QMessageBox.warning(self, "Validation Error", "Please enter a recipient email address.")
             return
 
-        if not self.file_list:
+        watching = self.watch_check.isChecked()
+        if not self.file_list and not watching:
             return
 
         # Disable controls
-        self.send_btn.setEnabled(False)
+        self.watch_check.setEnabled(False)
         self.progress_bar.setValue(0)
-        self.log_viewer.append("Starting email delivery...")
+        self.progress_bar.setFormat("%p%")
+        self.update_log("Starting email delivery...")
+
+        if watching:
+            directory = self.dir_input.text()
+            if not self.logger_manager.log_file_path:
+                log_path = self.logger_manager.create_audit_log([])
+                self.update_log(f"Audit Log created: {log_path}")
+            source = DirectoryWatcher(directory, **self.config_manager.get_watch_settings())
+            self.update_log(f"Watching {directory} for new files.")
+            self.send_btn.setText("STOP WATCHING")
+            self.progress_bar.setRange(0, 0) # Busy indicator, total is unknown
+            audit_files = None
+        elif self.scanner and not self.scanner.done:
+            # Send files as the scan finds them; the total is not known yet
+            source = self.scanner
+            audit_files = []
+            self.send_btn.setEnabled(False)
+            self.progress_bar.setRange(0, 0)
+        else:
+            source = list(self.file_list)
+            audit_files = list(source)
+            self.send_btn.setEnabled(False)
+
+        use_outbox = not watching and self.config_manager.get_outbox_settings()['enabled']
+        if use_outbox:
+            # Leftovers from earlier runs are sent too, so the total is not known
+            self.progress_bar.setRange(0, 0)
 
         # Start Worker
-        self.worker = EmailWorker(self.file_list, recipient, self.config_manager, self.logger_manager)
+        root = self.scanner.directory if self.scanner else None
+        self.worker = EmailWorker(source, recipient, self.config_manager, self.logger_manager, audit_files,
+                                  use_outbox, root)
         self.worker.progress_signal.connect(self.update_progress)
         self.worker.log_signal.connect(self.update_log)
         self.worker.status_signal.connect(self.update_status)
         self.worker.finished_signal.connect(self.sending_finished)
         self.worker.start()
+        self.stats_timer.start()
+
+    def closeEvent(self, event):
+        if self.scanner:
+            self.scanner.stop()
+        super().closeEvent(event)
 
-    def update_progress(self, val):
-        self.progress_bar.setValue(val)
+    def update_progress(self, val, eta=None):
+        self._pending_progress = (val, eta)
+        self._schedule_refresh()
 
     def update_log(self, message):
-        self.log_viewer.append(message)
+        self._pending_log.append(message)
+        self._schedule_refresh()
         
-    def update_status(self, filename, status):
-        # Find row with filename
-        # Since we populated in order, we could assume order, but searching is safer if list changes (it shouldn't here)
-        # Optimization: worker could send row index. But search is fine for < 10000 files.
-        items = self.status_table.findItems(filename, Qt.MatchExactly)
-        if items:
-            row = items[0].row()
-            self.status_table.setItem(row, 1, QTableWidgetItem(status))
-            # Optional: Color coding
-            if status == "SENT":
-                self.status_table.item(row, 1).setBackground(Qt.green)
-            elif status == "FAILED":
-                self.status_table.item(row, 1).setBackground(Qt.red)
+    def update_status(self, file_path, status):
+        self._pending_status[file_path] = status
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    def flush_updates(self):
+        """
+        Applies everything buffered since the last refresh in one go: one
+        model update, one log append and one progress change.
+        """
+        if self._pending_status:
+            statuses, self._pending_status = self._pending_status, {}
+            self.status_model.update_statuses(statuses)
+        if self._pending_log:
+            lines, self._pending_log = self._pending_log[-LOG_MAX_LINES:], []
+            self.log_viewer.appendPlainText("\n".join(lines))
+        if self._pending_progress is not None:
+            percent, eta = self._pending_progress
+            self.progress_bar.setValue(percent)
+            self.progress_bar.setFormat("%p%" if eta is None or percent >= 100 else f"%p% - {format_eta(eta)}")
+            self._pending_progress = None
 
     def sending_finished(self):
+        self.flush_updates()
+        self.stats_timer.stop()
+        self.stats_panel.refresh()
+        self.send_btn.setText("SEND EMAILS")
         self.send_btn.setEnabled(True)
-        self.log_viewer.append("Processing complete.")
+        self.watch_check.setEnabled(True)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setFormat("%p%")
+        self.update_log("Processing complete.")
         QMessageBox.information(self, "Done", "Email processing finished. Check audit log for details.")
 
 if __name__ == '__main__':
@@ -1,6 +1,10 @@
 import os
 import sys
 import datetime
+import threading
+import queue
+import time
+import atexit
 import logging
 
 if getattr(sys, 'frozen', False):
@@ -11,9 +15,119 @@ else:
 LOGS_DIR = os.path.join(APP_PATH, 'LOGS')
 DEBUG_LOG = os.path.join(APP_PATH, 'debug.log')
 
+FSYNC_POLICIES = ('none', 'batch', 'always')
+
+class AuditWriter:
+    """
+    Keeps the audit log open and appends entries from any thread.
+
+    With fsync_policy 'none' or 'batch', entries are queued and a background
+    thread writes them in batches of flush_batch_size, or every
+    flush_interval seconds, whichever comes first; 'batch' also fsyncs after
+    each write. With 'always', every entry is written and fsynced before
+    write() returns, so nothing is lost if the process dies.
+    """
+    _STOP = object()
+
+    def __init__(self, path, flush_interval=1.0, flush_batch_size=100, fsync_policy='batch'):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync_policy}', expected one of {FSYNC_POLICIES}.")
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch_size = max(1, flush_batch_size)
+        self.fsync_policy = fsync_policy
+
+        self._file = open(path, 'a')
+        self._file_lock = threading.Lock()
+        # Guards _closed, so nothing is queued after the stop marker
+        self._state_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = None
+        if fsync_policy != 'always':
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, entry):
+        with self._state_lock:
+            if self._closed:
+                raise ValueError(f"Audit log {self.path} is closed.")
+            if self._thread is None:
+                self._write_batch([entry])
+            else:
+                self._queue.put(entry)
+
+    def flush(self):
+        """
+        Blocks until every entry written so far is on disk.
+        """
+        with self._state_lock:
+            if self._thread is None or self._closed:
+                return
+            done = threading.Event()
+            self._queue.put(done)
+        # Queued before any stop marker, so the writer thread always sets it
+        done.wait()
+
+    def close(self):
+        with self._state_lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._thread is not None:
+                self._queue.put(self._STOP)
+        if self._thread is not None:
+            self._thread.join()
+        with self._file_lock:
+            self._file.close()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, str):
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(pending) < self.flush_batch_size:
+                    continue
+
+            # Batch full, interval elapsed, flush requested or shutting down
+            if pending:
+                self._write_batch(pending)
+                pending = []
+            deadline = None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is self._STOP:
+                return
+
+    def _write_batch(self, entries):
+        try:
+            with self._file_lock:
+                self._file.writelines(entries)
+                self._file.flush()
+                if self.fsync_policy != 'none':
+                    os.fsync(self._file.fileno())
+        except Exception as e:
+            logging.error(f"Failed to write to audit log: {e}")
+
 class LoggerManager:
-    def __init__(self, debug_mode=False):
+    def __init__(self, debug_mode=False, audit_settings=None):
         self.log_file_path = None
+        self.audit_writer = None
+        self.audit_settings = audit_settings or {}
+        # Set when delivery results are audited elsewhere, e.g. by a cluster coordinator
+        self.audit_elsewhere = False
         self.setup_debug_logging(debug_mode)
 
     def setup_debug_logging(self, debug_mode):
@@ -25,47 +139,66 @@ class LoggerManager:
             filemode='a'
         )
 
-    def create_audit_log(self, file_list):
+    def create_audit_log(self, file_list, name=None):
+        """
+        Starts a new audit log listing file_list as PENDING. name is added
+        to the file name, to tell apart logs of processes started together.
+        """
         if not os.path.exists(LOGS_DIR):
             os.makedirs(LOGS_DIR)
-        
+
+        self.close_audit_log()
+
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.log_file_path = os.path.join(LOGS_DIR, f"audit_log_{timestamp}.txt")
-        
+        suffix = f"_{name}" if name else ""
+        self.log_file_path = os.path.join(LOGS_DIR, f"audit_log_{timestamp}{suffix}.txt")
+
         with open(self.log_file_path, 'w') as f:
             f.write(f"Audit Log created at {datetime.datetime.now()}\n")
             f.write("-" * 50 + "\n")
             f.write("Initial File Status:\n")
-            for filename in file_list:
-                f.write(f"{filename}: PENDING\n")
+            for file_path in file_list:
+                f.write(f"{file_path}: PENDING\n")
             f.write("-" * 50 + "\n")
             f.write("Email Delivery Results:\n")
-            f.write(f"{'Timestamp':<20} | {'Filename':<30} | {'Email':<30} | {'Status':<10}\n")
+            f.write(f"{'Timestamp':<20} | {'File':<30} | {'Email':<30} | {'Status':<10}\n")
             f.write("-" * 100 + "\n")
-            
+
+        self.audit_writer = AuditWriter(self.log_file_path, **self.audit_settings)
         logging.info(f"Created audit log: {self.log_file_path}")
         return self.log_file_path
 
-    def log_delivery_status(self, filename, email, status, error_msg=""):
-        if not self.log_file_path:
-            logging.warning("Attempted to log delivery status but no audit log file is initialized.")
+    def log_delivery_status(self, file_path, email, status, error_msg="", node=None):
+        if not self.audit_writer:
+            if not self.audit_elsewhere:
+                logging.warning("Attempted to log delivery status but no audit log file is initialized.")
             return
 
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         status_str = "SUCCESS" if status else "FAILURE"
-        
-        log_entry = f"{timestamp:<20} | {filename:<30} | {email:<30} | {status_str:<10}"
+
+        log_entry = f"{timestamp:<20} | {file_path:<30} | {email:<30} | {status_str:<10}"
         if error_msg:
              log_entry += f" | Error: {error_msg}"
+        if node:
+            log_entry += f" | Node: {node}"
         log_entry += "\n"
 
         try:
-            with open(self.log_file_path, 'a') as f:
-                f.write(log_entry)
-            logging.info(f"Logged status for {filename}: {status_str}")
+            self.audit_writer.write(log_entry)
+            logging.debug(f"Logged status for {file_path}: {status_str}")
         except Exception as e:
             logging.error(f"Failed to write to audit log: {e}")
 
+    def flush_audit_log(self):
+        if self.audit_writer:
+            self.audit_writer.flush()
+
+    def close_audit_log(self):
+        if self.audit_writer:
+            self.audit_writer.close()
+            self.audit_writer = None
+
     def set_debug_mode(self, enabled):
         # Update root logger level
         logger = logging.getLogger()
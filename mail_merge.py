@@ -0,0 +1,120 @@
+import os
+import csv
+import json
+import string
+from dataclasses import dataclass
+from typing import Optional
+
+DEFAULT_SUBJECT = "$filename"
+DEFAULT_BODY = "Please find the attached file: $filename"
+
+# Manifest columns with a fixed meaning; every other column is a template variable
+FILE_COLUMN = 'file'
+TO_COLUMN = 'to'
+
+
+class MergeTemplate:
+    """
+    A template using string.Template syntax ($name or ${name}, $$ for a
+    literal $). It is parsed once into literal text and field names, so
+    rendering a row is a single join instead of a regex scan.
+    """
+    def __init__(self, template):
+        self.template = template
+        self._segments = []  # (literal, field name or None)
+        position = 0
+        for match in string.Template.pattern.finditer(template):
+            literal = template[position:match.start()]
+            if match.group('escaped') is not None:
+                self._segments.append((literal + '$', None))
+            elif match.group('invalid') is not None:
+                raise ValueError(f"Invalid placeholder at position {match.start()} in template: {template!r}")
+            else:
+                self._segments.append((literal, match.group('named') or match.group('braced')))
+            position = match.end()
+        self._segments.append((template[position:], None))
+        self.fields = {name for _, name in self._segments if name}
+
+    def render(self, values):
+        try:
+            return "".join(literal + (values[name] if name else "") for literal, name in self._segments)
+        except KeyError as e:
+            raise KeyError(f"Template variable {e.args[0]!r} is missing from the manifest row") from None
+
+
+@dataclass
+class MergeMessage:
+    """
+    One manifest row, rendered: which file goes to whom, with what subject
+    and body. error is set instead if the row could not be used.
+    """
+    file_path: str
+    recipient: str
+    subject: Optional[str] = None
+    body: Optional[str] = None
+    error: Optional[str] = None
+    line: int = 0
+
+
+def read_manifest(path):
+    """
+    Yields (line number, row, error) for the rows of a CSV or JSON Lines
+    manifest, one at a time. row is a dict of strings, or None with error
+    set if the line is not a JSON object.
+    """
+    if path.lower().endswith(('.jsonl', '.ndjson')):
+        with open(path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_number, None, f"Manifest line {line_number} is not valid JSON: {e.msg}"
+                    continue
+                if not isinstance(row, dict):
+                    yield line_number, None, f"Manifest line {line_number} is not a JSON object"
+                    continue
+                yield line_number, {str(k): "" if v is None else str(v) for k, v in row.items()}, None
+    else:
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, {k.strip(): (v or "") for k, v in row.items() if k}, None
+
+
+class MailMerge:
+    """
+    Streams a manifest that maps files to recipients and template variables,
+    and yields a rendered MergeMessage per row. File paths are relative to
+    the manifest's directory unless absolute. The row's columns, plus
+    $filename, are available in the subject and body templates.
+    """
+    def __init__(self, manifest_path, subject_template=DEFAULT_SUBJECT, body_template=DEFAULT_BODY):
+        self.manifest_path = manifest_path
+        self.base_dir = os.path.dirname(os.path.abspath(manifest_path))
+        self.subject = MergeTemplate(subject_template)
+        self.body = MergeTemplate(body_template)
+
+    def __iter__(self):
+        for line_number, row, error in read_manifest(self.manifest_path):
+            if error:
+                yield MergeMessage("", "", error=error, line=line_number)
+                continue
+            file_value = row.get(FILE_COLUMN, "").strip()
+            recipient = row.get(TO_COLUMN, "").strip()
+            file_path = os.path.join(self.base_dir, file_value) if file_value else ""
+            message = MergeMessage(file_path, recipient, line=line_number)
+            if not file_value or not recipient:
+                message.error = f"Manifest line {line_number} needs both '{FILE_COLUMN}' and '{TO_COLUMN}'"
+                yield message
+                continue
+
+            values = dict(row)
+            values.setdefault('filename', os.path.basename(file_path))
+            try:
+                message.subject = self.subject.render(values)
+                message.body = self.body.render(values)
+            except KeyError as e:
+                message.error = f"Manifest line {line_number}: {e.args[0]}"
+            yield message
@@ -0,0 +1,96 @@
+import os
+import base64
+import threading
+import logging
+from collections import OrderedDict
+from metrics import registry
+
+
+class AttachmentCache:
+    """
+    LRU cache of base64-encoded attachments, keyed by absolute path, size and
+    modification time, so a file is read and encoded once no matter how many
+    times it is sent. A changed file gets a new key and is encoded again.
+    Holds at most max_bytes of encoded data.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(file_path, st):
+        return (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+
+    def get(self, key):
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return encoded
+
+    def put(self, key, encoded):
+        if len(encoded) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = encoded
+            self._size += len(encoded)
+            self._evict()
+
+    def encoded(self, attachment, file_path):
+        """
+        Returns the base64 text of the open file attachment, from the cache
+        if this version of file_path was encoded before.
+        """
+        key = self.key(file_path, os.fstat(attachment.fileno()))
+        encoded = self.get(key)
+        if encoded is None:
+            with registry.timer('read'):
+                raw = attachment.read()
+            with registry.timer('encode'):
+                encoded = base64.encodebytes(raw).decode('ascii')
+            self.put(key, encoded)
+        return encoded
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, encoded = self._entries.popitem(last=False)
+            self._size -= len(encoded)
+
+
+# One cache per process, so encoded attachments survive from one batch to
+# the next (e.g. the same files sent again to another recipient).
+_shared_lock = threading.Lock()
+_shared_cache = None
+
+def shared_cache(max_bytes):
+    """
+    Returns the process-wide AttachmentCache, resized to max_bytes.
+    """
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = AttachmentCache(max_bytes)
+            logging.debug(f"Created attachment cache with a budget of {max_bytes} bytes")
+        elif _shared_cache.max_bytes != max_bytes:
+            _shared_cache.resize(max_bytes)
+        return _shared_cache
@@ -0,0 +1,255 @@
+import os
+import time
+import bisect
+import socket
+import asyncio
+import smtplib
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Where the time for a message goes. hash is the content hash taken ahead of
+# sending when [DEDUP] is enabled; read and encode happen while the
+# message is built (streamed attachments are encoded during data instead);
+# connect, tls and auth once per SMTP connection; data is the whole
+# MAIL/RCPT/DATA transaction; move is filing the sent file in SENTEMAILS.
+STAGES = ('hash', 'read', 'encode', 'connect', 'tls', 'auth', 'data', 'move')
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+COUNTERS = {
+    'messages_sent': "Messages accepted by the SMTP server (each part of a split file counts).",
+    'bytes_sent': "Message bytes accepted by the SMTP server.",
+    'binary_messages': "Messages sent with their attachment unencoded (BINARYMIME over BDAT).",
+    'connections': "SMTP connections opened and logged in.",
+    'files_sent': "Files delivered.",
+    'files_failed': "Files that could not be delivered.",
+    'files_skipped': "Files skipped because the journal shows them delivered.",
+    'retries': "Failed attempts scheduled for another try.",
+    'failovers': "Messages moved to another SMTP profile after a relay error.",
+}
+
+PREFIX = "batch_email"
+
+
+def failure_code(error):
+    """
+    Label for error in the failures-by-code counter: the SMTP reply code,
+    or 'disconnected', 'timeout' or 'other' when there is none.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        return str(next(iter(error.recipients.values()))[0])
+    code = getattr(error, 'smtp_code', None)
+    if isinstance(code, int) and code > 0:
+        return str(code)
+    if isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError)):
+        return 'disconnected'
+    if isinstance(error, (socket.timeout, asyncio.TimeoutError)):
+        return 'timeout'
+    return 'other'
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class Metrics:
+    """
+    Per-stage timings and counters for the sending hot path. Recording is a
+    perf_counter call and a few additions under a lock, cheap enough to
+    leave on; with enabled False the timers do nothing at all. Values are
+    cumulative for the life of the process, like Prometheus counters.
+    """
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = {stage: _Histogram() for stage in STAGES}
+            self._counters = dict.fromkeys(COUNTERS, 0)
+            self._failures = {}
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Times the with block as one occurrence of stage, whether or not it
+        raises.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            histogram = self._stages[stage]
+            histogram.buckets[index] += 1
+            histogram.count += 1
+            histogram.total += seconds
+            if seconds > histogram.max:
+                histogram.max = seconds
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] += value
+
+    def failure(self, error):
+        """
+        Counts a failed send attempt under its SMTP reply code.
+        """
+        if not self.enabled:
+            return
+        code = failure_code(error)
+        with self._lock:
+            self._failures[code] = self._failures.get(code, 0) + 1
+
+    def snapshot(self):
+        """
+        A plain dict of everything recorded so far, for the GUI panel and
+        JSON summaries. Times are in milliseconds.
+        """
+        with self._lock:
+            stages = {}
+            for stage, histogram in self._stages.items():
+                stages[stage] = {
+                    'count': histogram.count,
+                    'avg_ms': round(histogram.total / histogram.count * 1000, 2) if histogram.count else 0.0,
+                    'max_ms': round(histogram.max * 1000, 2),
+                    'total_ms': round(histogram.total * 1000, 2),
+                }
+            return {
+                'stages': stages,
+                'counters': dict(self._counters),
+                'failures_by_code': dict(sorted(self._failures.items())),
+            }
+
+    def prometheus_text(self):
+        """
+        Everything recorded so far in the Prometheus text exposition format.
+        """
+        with self._lock:
+            stages = {stage: (list(h.buckets), h.count, h.total) for stage, h in self._stages.items()}
+            counters = dict(self._counters)
+            failures = dict(self._failures)
+
+        lines = [f"# HELP {PREFIX}_stage_seconds Time spent in each stage of sending a message.",
+                 f"# TYPE {PREFIX}_stage_seconds histogram"]
+        for stage, (buckets, count, total) in stages.items():
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+        for name, value in counters.items():
+            lines.append(f"# HELP {PREFIX}_{name}_total {COUNTERS[name]}")
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            lines.append(f"{PREFIX}_{name}_total {value}")
+        lines.append(f"# HELP {PREFIX}_smtp_failures_total Failed send attempts by SMTP reply code.")
+        lines.append(f"# TYPE {PREFIX}_smtp_failures_total counter")
+        for code, value in sorted(failures.items()):
+            lines.append(f'{PREFIX}_smtp_failures_total{{code="{code}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+# One registry per process, shared by every sender and batch
+registry = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+
+class MetricsExporter:
+    """
+    Publishes a Metrics registry for headless runs: rewritten every
+    interval seconds to textfile (for node_exporter's textfile collector),
+    and/or served over HTTP on host:port for Prometheus to scrape. Either
+    may be left out.
+    """
+    def __init__(self, metrics=registry, textfile='', port=0, host='127.0.0.1', interval=15.0):
+        self.metrics = metrics
+        self.textfile = textfile
+        self.port = port
+        self.host = host
+        self.interval = max(1.0, interval)
+        self._server = None
+        self._threads = []
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Starts the writer and the HTTP endpoint. Returns self.
+        """
+        if self.port:
+            self._server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+            self._server.daemon_threads = True
+            self._server.metrics = self.metrics
+            self._threads.append(threading.Thread(target=self._server.serve_forever,
+                                                  name="metrics-http", daemon=True))
+            logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        if self.textfile:
+            self._threads.append(threading.Thread(target=self._write_loop, name="metrics-file", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops exporting; the text file is written one last time so it holds
+        the final values.
+        """
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.textfile:
+            self.write_textfile()
+
+    def write_textfile(self):
+        # Written aside and renamed, so a scraper never reads half a file
+        temp_path = f"{self.textfile}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(self.metrics.prometheus_text())
+            os.replace(temp_path, self.textfile)
+        except OSError as e:
+            logging.warning(f"Could not write metrics to {self.textfile}: {e}")
+
+    def _write_loop(self):
+        self.write_textfile()
+        while not self._stopped.wait(self.interval):
+            self.write_textfile()
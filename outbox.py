@@ -0,0 +1,329 @@
+import os
+import sys
+import time
+import uuid
+import socket
+import sqlite3
+import datetime
+import threading
+import logging
+from dataclasses import dataclass
+from typing import Optional
+from retry_scheduler import is_transient_error
+
+if getattr(sys, 'frozen', False):
+    APP_PATH = os.path.dirname(sys.executable)
+else:
+    APP_PATH = os.path.dirname(os.path.abspath(__file__))
+
+OUTBOX_FILE = os.path.join(APP_PATH, 'outbox.db')
+
+STATUS_QUEUED = 'QUEUED'
+STATUS_LEASED = 'LEASED'
+STATUS_SENT = 'SENT'
+STATUS_FAILED = 'FAILED'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_path TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    subject TEXT,
+    body TEXT,
+    move_sent INTEGER NOT NULL DEFAULT 1,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL NOT NULL DEFAULT 0,
+    claims INTEGER NOT NULL DEFAULT 0,
+    error TEXT NOT NULL DEFAULT '',
+    created TEXT NOT NULL,
+    finished TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, lease_expires, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs (owner);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (file_path, recipient, IFNULL(subject, ''))
+    WHERE status IN ('QUEUED', 'LEASED');
+"""
+
+
+def new_owner_id():
+    """
+    Name a worker claims jobs under: host, process and a random suffix.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+@dataclass
+class SpoolJob:
+    """
+    One queued email, as claimed from the outbox: which file goes to whom,
+    with the subject and body of a mail merge row if any. Shaped like
+    MergeMessage so BatchSender can send it the same way.
+    """
+    job_id: int
+    file_path: str
+    recipient: str
+    subject: Optional[str] = None
+    body: Optional[str] = None
+    move_sent: bool = True
+    claims: int = 0
+    error: Optional[str] = None
+
+
+class Outbox:
+    """
+    Durable queue of emails to send, in SQLite, shared by any number of
+    producer and sender processes. Senders claim jobs with a lease that
+    they keep renewing; jobs whose lease runs out (the sender crashed or
+    hung) are handed to the next sender that asks. A job claimed max_claims
+    times without being settled is failed instead of crashing more senders.
+    """
+    def __init__(self, path=None, max_claims=5):
+        self.path = path or OUTBOX_FILE
+        self.max_claims = max(1, max_claims)
+        self._lock = threading.Lock()
+        # Autocommit; claims open their own write transaction
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def enqueue(self, items, recipient_email=None, move_sent=True):
+        """
+        Adds jobs for items: file paths sent to recipient_email, or
+        MergeMessages carrying their own recipient, subject and body. Items
+        already waiting in the outbox are not added twice. Returns the
+        number of jobs added.
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        rows = []
+        for item in items:
+            if isinstance(item, str):
+                rows.append((os.path.abspath(item), recipient_email, None, None, int(move_sent), now))
+            elif item.error:
+                raise ValueError(item.error)
+            else:
+                rows.append((os.path.abspath(item.file_path), item.recipient, item.subject, item.body, 0, now))
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO jobs (file_path, recipient, subject, body, move_sent, status, created) "
+                    f"VALUES (?, ?, ?, ?, ?, '{STATUS_QUEUED}', ?)", rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return self._conn.total_changes - before
+
+    def claim(self, owner, lease_seconds, limit=1):
+        """
+        Atomically leases up to limit jobs to owner: queued ones first, in
+        the order they were added, then ones whose lease has run out.
+        Returns them as SpoolJobs.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, file_path, recipient, subject, body, move_sent, claims FROM jobs "
+                    f"WHERE status = '{STATUS_QUEUED}' OR (status = '{STATUS_LEASED}' AND lease_expires < ?) "
+                    "ORDER BY status DESC, id LIMIT ?", (now, limit)).fetchall()
+                jobs, abandoned = [], []
+                for job_id, file_path, recipient, subject, body, move_sent, claims in rows:
+                    if claims >= self.max_claims:
+                        abandoned.append(job_id)
+                        continue
+                    jobs.append(SpoolJob(job_id, file_path, recipient, subject, body, bool(move_sent), claims + 1))
+                self._conn.executemany(
+                    f"UPDATE jobs SET status = '{STATUS_LEASED}', owner = ?, lease_expires = ?, "
+                    "claims = claims + 1 WHERE id = ?",
+                    [(owner, now + lease_seconds, job.job_id) for job in jobs])
+                self._conn.executemany(
+                    f"UPDATE jobs SET status = '{STATUS_FAILED}', owner = NULL, finished = ?, error = ? WHERE id = ?",
+                    [(self._now(), f"Abandoned after {self.max_claims} claims without a result", job_id)
+                     for job_id in abandoned])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        for job_id in abandoned:
+            logging.error(f"Outbox job {job_id} failed: claimed {self.max_claims} times without a result")
+        return jobs
+
+    def renew(self, owner, lease_seconds, job_ids=None):
+        """
+        Extends the lease on every job owner holds, or only on job_ids.
+        """
+        expires = time.time() + lease_seconds
+        with self._lock:
+            if job_ids is None:
+                self._conn.execute(
+                    f"UPDATE jobs SET lease_expires = ? WHERE owner = ? AND status = '{STATUS_LEASED}'",
+                    (expires, owner))
+            else:
+                self._conn.executemany(
+                    f"UPDATE jobs SET lease_expires = ? WHERE id = ? AND owner = ? AND status = '{STATUS_LEASED}'",
+                    [(expires, job_id, owner) for job_id in job_ids])
+
+    def expire(self, owner, seconds):
+        """
+        Lets the leases owner holds run out within seconds at the latest.
+        """
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET lease_expires = MIN(lease_expires, ?) WHERE owner = ? AND status = '{STATUS_LEASED}'",
+                (time.time() + seconds, owner))
+
+    def get(self, job_id):
+        """
+        Returns (SpoolJob, owner, status) for job_id, or None if there is no
+        such job.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, file_path, recipient, subject, body, move_sent, claims, owner, status "
+                "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return SpoolJob(*row[:5], bool(row[5]), row[6]), row[7], row[8]
+
+    def complete(self, job_id, owner=None):
+        return self._finish(job_id, STATUS_SENT, '', owner)
+
+    def fail(self, job_id, error_msg, owner=None):
+        return self._finish(job_id, STATUS_FAILED, error_msg, owner)
+
+    def release(self, job_id, owner=None):
+        """
+        Puts a leased job back in the queue, e.g. when its sender stops.
+        With owner, only if owner still holds it.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET status = '{STATUS_QUEUED}', owner = NULL, lease_expires = 0, "
+                f"claims = MAX(0, claims - 1) WHERE id = ? AND status = '{STATUS_LEASED}'"
+                + (" AND owner = ?" if owner else ""), (job_id, owner) if owner else (job_id,))
+        return cursor.rowcount > 0
+
+    def release_all(self, owner):
+        """
+        Puts every job owner still holds back in the queue.
+        """
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET status = '{STATUS_QUEUED}', owner = NULL, lease_expires = 0, "
+                f"claims = MAX(0, claims - 1) WHERE owner = ? AND status = '{STATUS_LEASED}'", (owner,))
+
+    def counts(self):
+        """
+        Number of jobs in each status.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = dict.fromkeys((STATUS_QUEUED, STATUS_LEASED, STATUS_SENT, STATUS_FAILED), 0)
+        counts.update(rows)
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _finish(self, job_id, status, error_msg, owner=None):
+        """
+        Settles job_id; with owner, only if owner still holds it. Returns
+        False if no job was updated, e.g. because the lease ran out and the
+        job went to another sender.
+        """
+        with self._lock:
+            if owner:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = ?, owner = NULL, finished = ?, error = ? WHERE id = ? AND owner = ?",
+                    (status, self._now(), error_msg, job_id, owner))
+            else:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = ?, owner = NULL, finished = ?, error = ? WHERE id = ?",
+                    (status, self._now(), error_msg, job_id))
+        if cursor.rowcount == 0:
+            logging.warning(f"Outbox job {job_id} was not marked {status}: "
+                            + ("its lease has passed to another sender" if owner else "no such job"))
+            return False
+        return True
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+class OutboxSource:
+    """
+    Feeds BatchSender from an Outbox: claims jobs a few at a time under
+    owner and yields them as SpoolJobs, renewing their leases in the
+    background until BatchSender settles each one. Ends once nothing is
+    left to claim, or with follow keeps waiting for new jobs until stopped.
+    """
+    def __init__(self, outbox, owner=None, lease_seconds=60.0, batch_size=8, follow=False, poll_interval=1.0):
+        self.outbox = outbox
+        self.owner = owner or new_owner_id()
+        self.lease_seconds = lease_seconds
+        self.batch_size = max(1, batch_size)
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+        self._closed = threading.Event()
+        self._heartbeat = None
+
+    def __iter__(self):
+        # Leases are renewed until close(), also for jobs BatchSender is
+        # still retrying after the queue has run dry
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._renew_loop, name="outbox-lease", daemon=True)
+            self._heartbeat.start()
+        while not self._stopped.is_set():
+            jobs = self.outbox.claim(self.owner, self.lease_seconds, self.batch_size)
+            for index, job in enumerate(jobs):
+                if self._stopped.is_set():
+                    # Claimed but never started: back in the queue for others
+                    for unsent in jobs[index:]:
+                        self.outbox.release(unsent.job_id, self.owner)
+                    return
+                yield job
+            if not jobs:
+                if not self.follow:
+                    return
+                self._stopped.wait(self.poll_interval)
+
+    def settle(self, job, error=None):
+        """
+        Records the outcome of a job. A job interrupted by stop() goes back
+        in the queue rather than failing.
+        """
+        if error is None:
+            self.outbox.complete(job.job_id, self.owner)
+        elif self._stopped.is_set() and (isinstance(error, InterruptedError) or is_transient_error(error)):
+            self.outbox.release(job.job_id, self.owner)
+        else:
+            self.outbox.fail(job.job_id, str(error), self.owner)
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        """
+        Stops renewing leases and releases whatever is still held.
+        """
+        self._stopped.set()
+        self._closed.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        self.outbox.release_all(self.owner)
+
+    def _renew_loop(self):
+        while not self._closed.wait(self.lease_seconds / 3):
+            try:
+                self.outbox.renew(self.owner, self.lease_seconds)
+            except sqlite3.Error as e:
+                logging.warning(f"Could not renew outbox leases for {self.owner}: {e}")
@@ -0,0 +1,613 @@
+import os
+import ssl
+import hmac
+import json
+import time
+import shutil
+import socket
+import hashlib
+import secrets
+import logging
+import tempfile
+import threading
+import ipaddress
+import socketserver
+from dataclasses import dataclass
+from outbox import STATUS_QUEUED, STATUS_LEASED, STATUS_SENT, SpoolJob, new_owner_id
+from retry_scheduler import is_transient_error
+from batch_sender import move_to_sent
+
+DEFAULT_PORT = 8470
+# Longest request or reply line; mail merge bodies travel in claim replies
+MAX_LINE = 4 * 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+# A node whose connection drops has this long to reconnect before its jobs
+# are handed to the other nodes
+RECONNECT_GRACE_SECONDS = 15
+# A connection has this long to finish the TLS handshake and log in
+LOGIN_TIMEOUT_SECONDS = 10
+
+# Protocol: one JSON object per line. The coordinator opens with a random
+# nonce, the node answers with 'hello' and an HMAC of the nonce under the
+# shared token, then sends 'claim', 'fetch', 'renew', 'settle' and finally
+# 'bye' requests, each answered by one reply line. A successful 'fetch'
+# reply is followed by exactly 'size' bytes of the file.
+
+
+class BrokerError(Exception):
+    """
+    The coordinator refused a request or could not be reached.
+    """
+
+
+def parse_address(address, default_port=DEFAULT_PORT):
+    """
+    Splits 'host:port' (IPv6 hosts in brackets, the port optional) into
+    (host, port).
+    """
+    text = address.strip()
+    host, separator, port = text.rpartition(':')
+    if not separator or ']' in port:
+        host, port = text, ''
+    host = host.strip('[]')
+    try:
+        port = int(port) if port else default_port
+    except ValueError:
+        port = -1
+    if not host or not 0 <= port <= 65535:
+        raise ValueError(f"Invalid address '{address}', expected HOST:PORT.")
+    return host, port
+
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def _mac(token, nonce):
+    return hmac.new(token.encode('utf-8'), nonce.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _encode(message):
+    return json.dumps(message).encode('utf-8') + b'\n'
+
+
+def _receive(rfile):
+    line = rfile.readline(MAX_LINE + 1)
+    if not line:
+        raise ConnectionError("Connection closed")
+    if len(line) > MAX_LINE:
+        raise ValueError("Message too long")
+    return json.loads(line)
+
+
+@dataclass
+class _Session:
+    node: str
+    owner: str
+    address: str
+
+
+class _BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, broker, ssl_context=None):
+        self.broker = broker
+        self.ssl_context = ssl_context
+        self.address_family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+        super().__init__(address, _BrokerHandler)
+
+    def get_request(self):
+        sock, address = super().get_request()
+        if self.ssl_context:
+            # The handshake happens in the handler thread, not the accept loop
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        self.connection.settimeout(LOGIN_TIMEOUT_SECONDS)
+        session = None
+        try:
+            if isinstance(self.connection, ssl.SSLSocket):
+                self.connection.do_handshake()
+            nonce = secrets.token_hex(16)
+            self.wfile.write(_encode({'hello': nonce}))
+            session = broker.open_session(_receive(self.rfile), nonce, self.client_address[0])
+            self.wfile.write(_encode(broker.session_settings()))
+            # Nodes renew every third of a lease, so this only trips for a vanished node
+            self.connection.settimeout(broker.lease_seconds)
+            while True:
+                request = _receive(self.rfile)
+                if request.get('op') == 'bye':
+                    broker.close_session(session, clean=True)
+                    session = None
+                    self.wfile.write(_encode({'ok': True}))
+                    return
+                if request.get('op') == 'fetch':
+                    self._send_file(broker, session, request)
+                else:
+                    self.wfile.write(_encode(broker.handle(session, request)))
+        except BrokerError as e:
+            try:
+                self.wfile.write(_encode({'ok': False, 'error': str(e)}))
+            except OSError:
+                pass
+        except (OSError, ValueError) as e:
+            logging.debug(f"Node connection from {self.client_address[0]} ended: {e}")
+        finally:
+            if session:
+                broker.close_session(session, clean=False)
+
+    def _send_file(self, broker, session, request):
+        try:
+            file_path = broker.fetch(session, request.get('job_id'))
+            f = open(file_path, 'rb')
+        except BrokerError as e:
+            self.wfile.write(_encode({'ok': False, 'error': str(e)}))
+            return
+        except OSError as e:
+            self.wfile.write(_encode({'ok': False, 'error': f"Could not read the file on the coordinator: {e}"}))
+            return
+        with f:
+            remaining = os.fstat(f.fileno()).st_size
+            self.wfile.write(_encode({'ok': True, 'size': remaining}))
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    # Truncated while being sent; the node cannot tell, so hang up
+                    raise OSError(f"{file_path} changed while it was being sent")
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class OutboxBroker:
+    """
+    Coordinator side of distributed sending: serves an Outbox over TCP to
+    sender nodes, which claim jobs, download their files and report each
+    outcome back. Results from every node go into one audit log here and
+    delivered files are moved to SENTEMAILS here. The jobs of a node that
+    drops out go to the other nodes once its leases run out.
+    """
+    def __init__(self, outbox, logger_manager, address, token='', ssl_context=None, lease_seconds=60.0,
+                 batch_size=8, poll_interval=1.0, follow=False, on_log=None):
+        self.outbox = outbox
+        self.logger_manager = logger_manager
+        self.host, self.port = parse_address(address)
+        if not token and not _is_loopback(self.host):
+            raise ValueError(f"A [CLUSTER] token is required to listen on {self.host}.")
+        self.token = token
+        self.ssl_context = ssl_context
+        self.lease_seconds = lease_seconds
+        self.batch_size = max(1, batch_size)
+        self.poll_interval = poll_interval
+        self.follow = follow
+        self.on_log = on_log or (lambda message: None)
+        self._lock = threading.Lock()
+        # Settling moves files; two reports for one job must not race
+        self._settle_lock = threading.Lock()
+        self._sessions = {}  # owner -> _Session
+        self._nodes = {}  # node name -> counts
+        self._stopping = threading.Event()
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Starts listening. Returns self.
+        """
+        self._server = _BrokerServer((self.host, self.port), self, self.ssl_context)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="outbox-broker", daemon=True)
+        self._thread.start()
+        self.on_log(f"Coordinating {self.outbox.path} on {self.host}:{self.port}"
+                    f"{' over TLS' if self.ssl_context else ''}.")
+        return self
+
+    def stop(self):
+        """
+        Stops handing out jobs. Nodes finish what they hold and disconnect.
+        """
+        self._stopping.set()
+
+    def wait(self):
+        """
+        Serves until every job is settled and the nodes have left (with
+        follow, until stop()). Returns the 'sent' and 'failed' counts of each
+        node.
+        """
+        drained_since = None
+        while not self._stopping.wait(self.poll_interval):
+            if self.follow:
+                continue
+            counts = self.outbox.counts()
+            if counts[STATUS_QUEUED] + counts[STATUS_LEASED]:
+                drained_since = None
+                continue
+            drained_since = drained_since or time.monotonic()
+            # A node that never says goodbye is not waited for forever
+            if not self.connected() or time.monotonic() - drained_since > self.lease_seconds:
+                break
+        if self._stopping.is_set():
+            deadline = time.monotonic() + self.lease_seconds
+            while self.connected() and time.monotonic() < deadline:
+                time.sleep(0.2)
+            if self.connected():
+                self.on_log("Some nodes did not finish in time; their jobs are sent again once their leases run out.")
+        return self.nodes()
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._thread.join()
+
+    def connected(self):
+        """
+        Number of node connections currently open.
+        """
+        with self._lock:
+            return len(self._sessions)
+
+    def nodes(self):
+        with self._lock:
+            return {node: {'sent': counts['sent'], 'failed': counts['failed']}
+                    for node, counts in self._nodes.items()}
+
+    def open_session(self, request, nonce, address):
+        if request.get('op') != 'hello':
+            raise BrokerError("Expected a hello.")
+        if not hmac.compare_digest(_mac(self.token, nonce), str(request.get('mac', ''))):
+            logging.warning(f"Rejected a node connecting from {address}: wrong token")
+            raise BrokerError("Authentication failed, check the [CLUSTER] token.")
+        session = _Session(str(request.get('node') or address), str(request.get('owner') or new_owner_id()), address)
+        with self._lock:
+            reconnected = session.owner in self._sessions
+            self._sessions[session.owner] = session
+            counts = self._nodes.setdefault(session.node, {'sent': 0, 'failed': 0, 'connections': 0})
+            if not reconnected:
+                counts['connections'] += 1
+            joined = counts['connections'] == 1 and not reconnected
+        if joined:
+            self.on_log(f"Node {session.node} joined from {address}.")
+        else:
+            logging.info(f"Node {session.node} {'re' if reconnected else ''}connected as {session.owner}")
+        return session
+
+    def session_settings(self):
+        return {'ok': True, 'lease_seconds': self.lease_seconds, 'batch_size': self.batch_size,
+                'poll_interval': self.poll_interval}
+
+    def close_session(self, session, clean):
+        with self._lock:
+            if self._sessions.get(session.owner) is not session:
+                return  # Replaced by a reconnect under the same owner
+            del self._sessions[session.owner]
+            counts = self._nodes[session.node]
+            counts['connections'] -= 1
+            left = counts['connections'] == 0
+        if clean:
+            # Whatever it claimed but never started
+            self.outbox.release_all(session.owner)
+            if left:
+                self.on_log(f"Node {session.node} left.")
+            return
+        self.outbox.expire(session.owner, RECONNECT_GRACE_SECONDS)
+        if left:
+            self.on_log(f"Node {session.node} dropped out; unless it reconnects, its jobs go to the other nodes "
+                        f"within {RECONNECT_GRACE_SECONDS}s.")
+        else:
+            logging.warning(f"Lost connection {session.owner} of node {session.node}")
+
+    def handle(self, session, request):
+        op = request.get('op')
+        try:
+            if op == 'claim':
+                return self._claim(session, int(request.get('limit', self.batch_size)))
+            if op == 'renew':
+                self.outbox.renew(session.owner, self.lease_seconds, [int(i) for i in request.get('job_ids', [])])
+                return {'ok': True}
+            if op == 'settle':
+                self._settle(session, int(request['job_id']), request.get('error'), bool(request.get('release')))
+                return {'ok': True}
+        except (KeyError, TypeError, ValueError) as e:
+            return {'ok': False, 'error': f"Malformed '{op}' request: {e}"}
+        return {'ok': False, 'error': f"Unknown request '{op}'."}
+
+    def fetch(self, session, job_id):
+        """
+        Path of the file of job_id, which must be leased to session.
+        """
+        found = self.outbox.get(job_id) if isinstance(job_id, int) else None
+        if found is None or found[1] != session.owner or found[2] != STATUS_LEASED:
+            raise BrokerError(f"Job {job_id} is not leased to this node.")
+        return found[0].file_path
+
+    def _claim(self, session, limit):
+        if self._stopping.is_set():
+            return {'ok': True, 'jobs': [], 'drained': True}
+        jobs = self.outbox.claim(session.owner, self.lease_seconds, max(1, min(limit, self.batch_size)))
+        drained = False
+        if not jobs and not self.follow:
+            counts = self.outbox.counts()
+            drained = counts[STATUS_QUEUED] + counts[STATUS_LEASED] == 0
+        return {'ok': True, 'drained': drained,
+                'jobs': [{'job_id': job.job_id, 'name': os.path.basename(job.file_path), 'recipient': job.recipient,
+                          'subject': job.subject, 'body': job.body, 'claims': job.claims} for job in jobs]}
+
+    def _settle(self, session, job_id, error, release):
+        with self._settle_lock:
+            found = self.outbox.get(job_id)
+            if found is None:
+                return
+            job, owner, status = found
+            held = owner == session.owner and status == STATUS_LEASED
+            if release or error is not None:
+                if not held:
+                    # Its lease ran out and the job has moved on; that sender's result counts
+                    logging.info(f"Ignoring the outcome of job {job_id} reported late by {session.node}")
+                elif release:
+                    self.outbox.release(job_id)
+                else:
+                    self.outbox.fail(job_id, error)
+                    self._record(session.node, job.file_path, job.recipient, error)
+                return
+            if status == STATUS_SENT:
+                return  # Reported twice across a reconnect
+            # Sent is sent, even if the lease had run out in the meantime
+            self.outbox.complete(job_id)
+            if job.move_sent:
+                try:
+                    move_to_sent(job.file_path)
+                except OSError as e:
+                    self._record(session.node, job.file_path, job.recipient, str(e))
+                    return
+            self._record(session.node, job.file_path, job.recipient)
+
+    def _record(self, node, file_path, recipient, error=None):
+        filename = os.path.basename(file_path)
+        self.logger_manager.log_delivery_status(file_path, recipient, error is None, error or "", node=node)
+        with self._lock:
+            self._nodes[node]['sent' if error is None else 'failed'] += 1
+        if error is None:
+            self.on_log(f"SUCCESS: {node} sent {filename} to {recipient}")
+        else:
+            self.on_log(f"FAILURE: {node} could not send {filename}. Error: {error}")
+
+
+class BrokerClient:
+    """
+    Node side of a connection to an OutboxBroker. Requests from any thread
+    are serialised over one connection. A dropped connection is
+    re-established for up to reconnect_seconds, under the same owner so the
+    node keeps its jobs.
+    """
+    def __init__(self, address, token='', node_name='', tls=False, tls_ca='', reconnect_seconds=60.0,
+                 timeout=30.0):
+        self.host, self.port = parse_address(address)
+        self.token = token
+        self.node = node_name or socket.gethostname()
+        self.owner = new_owner_id()
+        self.ssl_context = ssl.create_default_context(cafile=tls_ca or None) if tls else None
+        self.reconnect_seconds = reconnect_seconds
+        self.timeout = timeout
+        self.settings = None
+        self._sock = None
+        self._rfile = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Connects and logs in, waiting up to reconnect_seconds for the
+        coordinator to come up. Returns its lease settings.
+        """
+        self.request(None)
+        return self.settings
+
+    def call(self, op, **fields):
+        """
+        Sends one request and returns the reply, raising BrokerError if the
+        coordinator refused it.
+        """
+        reply = self.request({'op': op, **fields})
+        if not reply.get('ok'):
+            raise BrokerError(reply.get('error') or f"Request '{op}' failed.")
+        return reply
+
+    def request(self, message, dest=None):
+        """
+        Sends message and returns the reply; a file that follows the reply is
+        written to dest.
+        """
+        with self._lock:
+            deadline = None
+            delay = 1.0
+            while True:
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    if message is None:
+                        return self.settings
+                    return self._exchange(message, dest)
+                except ssl.SSLCertVerificationError as e:
+                    self._drop()
+                    raise BrokerError(f"Could not verify the coordinator at {self.host}:{self.port}: {e}") from e
+                except (OSError, ValueError) as e:
+                    self._drop()
+                    deadline = deadline or time.monotonic() + self.reconnect_seconds
+                    if time.monotonic() >= deadline:
+                        raise BrokerError(f"Lost the coordinator at {self.host}:{self.port}: {e}") from e
+                    logging.warning(f"No connection to the coordinator at {self.host}:{self.port} ({e}), "
+                                    f"retrying in {delay:.0f}s")
+                    time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+                    delay = min(delay * 2, 10.0)
+
+    def close(self):
+        """
+        Says goodbye, so the coordinator hands out whatever this node still
+        holds, and closes the connection.
+        """
+        with self._lock:
+            if self._sock is None:
+                return
+            try:
+                self._exchange({'op': 'bye'})
+            except (OSError, ValueError) as e:
+                logging.debug(f"Could not say goodbye to the coordinator: {e}")
+            self._drop()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            if self.ssl_context:
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+            rfile = sock.makefile('rb')
+            nonce = str(_receive(rfile).get('hello', ''))
+            sock.sendall(_encode({'op': 'hello', 'node': self.node, 'owner': self.owner,
+                                  'mac': _mac(self.token, nonce)}))
+            reply = _receive(rfile)
+        except BaseException:
+            sock.close()
+            raise
+        if not reply.get('ok'):
+            sock.close()
+            raise BrokerError(f"The coordinator at {self.host}:{self.port} refused this node: {reply.get('error')}")
+        self._sock, self._rfile, self.settings = sock, rfile, reply
+
+    def _exchange(self, message, dest=None):
+        self._sock.sendall(_encode(message))
+        reply = _receive(self._rfile)
+        if dest is None or not reply.get('ok'):
+            return reply
+        remaining = int(reply['size'])
+        with open(dest, 'wb') as f:
+            while remaining:
+                chunk = self._rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("Connection closed during a file transfer")
+                f.write(chunk)
+                remaining -= len(chunk)
+        return reply
+
+    def _drop(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = self._rfile = None
+
+
+class RemoteOutboxSource:
+    """
+    Feeds BatchSender from a coordinator, as OutboxSource does from a local
+    Outbox: claims jobs a few at a time, downloads each file to a staging
+    folder just before it is sent and reports every outcome back. Ends when
+    the coordinator has nothing left to hand out.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._closed = threading.Event()
+        self._heartbeat = None
+        self._staging = tempfile.mkdtemp(prefix='batch-email-node-')
+
+    def __iter__(self):
+        try:
+            settings = self.client.settings or self.client.connect()
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._renew_loop, args=(settings['lease_seconds'],),
+                                                   name="outbox-lease", daemon=True)
+                self._heartbeat.start()
+            while not self._stopped.is_set():
+                reply = self.client.call('claim', limit=settings['batch_size'])
+                jobs = [self._job(job) for job in reply['jobs']]
+                for index, job in enumerate(jobs):
+                    if self._stopped.is_set():
+                        for unsent in jobs[index:]:
+                            self._report(unsent, None, release=True)
+                        return
+                    self._download(job)
+                    yield job
+                if not jobs:
+                    if reply.get('drained'):
+                        return
+                    self._stopped.wait(settings['poll_interval'])
+        except BrokerError as e:
+            logging.error(f"Stopped taking jobs from the coordinator: {e}")
+
+    def settle(self, job, error=None):
+        """
+        Reports the outcome of a job. A job interrupted by stop() is handed
+        back rather than failed.
+        """
+        release = (error is not None and self._stopped.is_set()
+                   and (isinstance(error, InterruptedError) or is_transient_error(error)))
+        self._report(job, None if error is None else str(error), release)
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        """
+        Stops renewing leases, hands back whatever is still held and removes
+        the staging folder.
+        """
+        self._stopped.set()
+        self._closed.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        self.client.close()
+        shutil.rmtree(self._staging, ignore_errors=True)
+
+    def _job(self, job):
+        with self._held_lock:
+            self._held.add(job['job_id'])
+        # The coordinator's file name, but never a path outside the staging folder
+        name = os.path.basename(job['name']) or f"job{job['job_id']}"
+        if name in ('.', '..'):
+            name = f"job{job['job_id']}"
+        file_path = os.path.join(self._staging, str(job['job_id']), name)
+        # Left in place: the coordinator moves its own copy once sent
+        return SpoolJob(job['job_id'], file_path, job['recipient'], job.get('subject'), job.get('body'),
+                        move_sent=False, claims=job.get('claims', 0))
+
+    def _download(self, job):
+        os.makedirs(os.path.dirname(job.file_path), exist_ok=True)
+        try:
+            reply = self.client.request({'op': 'fetch', 'job_id': job.job_id}, dest=job.file_path)
+        except BrokerError as e:
+            job.error = str(e)
+            return
+        if not reply.get('ok'):
+            job.error = reply.get('error') or "Could not download the file from the coordinator."
+
+    def _report(self, job, error, release=False):
+        try:
+            self.client.call('settle', job_id=job.job_id, error=error, release=release)
+        except BrokerError as e:
+            logging.warning(f"Could not report job {job.job_id} to the coordinator; it is sent again once "
+                            f"its lease runs out: {e}")
+        finally:
+            with self._held_lock:
+                self._held.discard(job.job_id)
+            shutil.rmtree(os.path.join(self._staging, str(job.job_id)), ignore_errors=True)
+
+    def _renew_loop(self, lease_seconds):
+        # Also keeps the connection from timing out while only retries are left
+        while not self._closed.wait(lease_seconds / 3):
+            with self._held_lock:
+                job_ids = list(self._held)
+            try:
+                self.client.call('renew', job_ids=job_ids)
+            except BrokerError as e:
+                logging.warning(f"Could not renew leases with the coordinator: {e}")
@@ -0,0 +1,195 @@
+import sys
+import time
+import queue
+import signal
+import threading
+import logging
+import multiprocessing
+from config_manager import ConfigManager
+from logger_manager import LoggerManager
+from batch_sender import BatchSender
+from outbox import Outbox, OutboxSource
+from outbox_broker import BrokerClient, RemoteOutboxSource
+
+
+# How long workers get to finish their in-flight messages once asked to stop
+STOP_GRACE_SECONDS = 60.0
+
+
+class OutboxWorker:
+    """
+    Sends jobs from the outbox until it is empty (or, with follow, until
+    stopped). index and count identify this worker among count sender
+    processes; each writes its own audit log and gets an even share of the
+    rate limits. With coordinator, a HOST:PORT address, jobs come from a
+    coordinator on another host instead, which keeps the audit log.
+    """
+    def __init__(self, config_manager, logger_manager, index=1, count=1, follow=False,
+                 on_log=None, on_status=None, coordinator=None):
+        self.config_manager = config_manager
+        self.logger_manager = logger_manager
+        self.index = index
+        self.count = count
+        self.follow = follow
+        self.coordinator = coordinator
+        self.on_log = on_log or (lambda message: None)
+        self.on_status = on_status
+        self.batch_sender = None
+        self._stop_requested = False
+
+    def run(self):
+        """
+        Returns BatchSender's result counts.
+        """
+        self.batch_sender = BatchSender(self.config_manager, self.logger_manager,
+                                        on_log=self.on_log, on_status=self.on_status,
+                                        worker_share=(self.index, self.count) if self.count > 1 else None)
+        if self._stop_requested:
+            self.batch_sender.stop()
+        if self.coordinator:
+            return self._run_remote()
+        settings = self.config_manager.get_outbox_settings()
+        outbox = Outbox(settings['path'], settings['max_claims'])
+        source = OutboxSource(outbox, lease_seconds=settings['lease_seconds'], batch_size=settings['batch_size'],
+                              follow=self.follow, poll_interval=settings['poll_interval'])
+        if not self.logger_manager.log_file_path:
+            log_path = self.logger_manager.create_audit_log([], name=f"worker{self.index}" if self.count > 1 else None)
+            self.on_log(f"Audit Log created: {log_path}")
+        try:
+            return self.batch_sender.run(source)
+        finally:
+            source.close()
+            outbox.close()
+            self.logger_manager.close_audit_log()
+
+    def _run_remote(self):
+        cluster = self.config_manager.get_cluster_settings()
+        client = BrokerClient(self.coordinator, cluster['token'], cluster['node_name'], cluster['tls'],
+                              cluster['tls_ca'], cluster['reconnect_seconds'])
+        # Fails here, rather than as an empty run, if the coordinator is unreachable
+        client.connect()
+        self.on_log(f"Connected to the coordinator at {client.host}:{client.port} as node {client.node}.")
+        # Delivery results go to the coordinator's audit log
+        self.logger_manager.audit_elsewhere = True
+        source = RemoteOutboxSource(client)
+        try:
+            return self.batch_sender.run(source)
+        finally:
+            source.close()
+
+    def stop(self):
+        self._stop_requested = True
+        if self.batch_sender:
+            self.batch_sender.stop()
+
+
+def _worker_main(index, count, follow, debug, quiet, coordinator, stop_event, results):
+    config_manager = ConfigManager()
+    logger_manager = LoggerManager(debug_mode=debug, audit_settings=config_manager.get_audit_settings())
+
+    def progress(message):
+        if not quiet:
+            print(f"[worker {index}] {message}", file=sys.stderr, flush=True)
+
+    worker = OutboxWorker(config_manager, logger_manager, index, count, follow, on_log=progress,
+                          coordinator=coordinator)
+
+    def handle_signal(signum, frame):
+        # In-flight messages finish; unstarted jobs go back in the outbox
+        worker.stop()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, handle_signal)
+
+    def watch_stop():
+        # WorkerPool.stop(); a signal cannot be sent gracefully on every platform
+        stop_event.wait()
+        worker.stop()
+
+    threading.Thread(target=watch_stop, name="stop-watcher", daemon=True).start()
+    try:
+        outcome = worker.run()
+    except Exception as e:
+        logging.exception(f"Outbox worker {index} failed")
+        progress(f"Error: {e}")
+        outcome = {'error': str(e)}
+    results.put((index, {key: value for key, value in outcome.items() if key != 'relays'}))
+
+
+class WorkerPool:
+    """
+    Runs OutboxWorkers in count separate processes, so encoding and sending
+    use every core instead of sharing one interpreter.
+    """
+    def __init__(self, count, follow=False, debug=False, quiet=False, coordinator=None):
+        self.count = max(1, count)
+        self.follow = follow
+        self.debug = debug
+        self.quiet = quiet
+        self.coordinator = coordinator
+        # spawn, like the compression pool: no forked sender threads or locks
+        self._context = multiprocessing.get_context('spawn')
+        self._results = self._context.Queue()
+        self._stop_event = self._context.Event()
+        self._stop_deadline = None
+        self._processes = []
+
+    def start(self):
+        self._processes = [
+            self._context.Process(target=_worker_main, name=f"outbox-worker-{index}",
+                                  args=(index, self.count, self.follow, self.debug, self.quiet,
+                                        self.coordinator, self._stop_event, self._results))
+            for index in range(1, self.count + 1)]
+        for process in self._processes:
+            process.start()
+        return self
+
+    def stop(self):
+        """
+        Asks every worker to finish its in-flight messages and exit. Workers
+        still running STOP_GRACE_SECONDS later are terminated by wait().
+        """
+        if self._stop_deadline is None:
+            self._stop_deadline = time.monotonic() + STOP_GRACE_SECONDS
+        self._stop_event.set()
+
+    def wait(self):
+        """
+        Waits for every worker and returns their summed 'sent', 'failed' and
+        'skipped' counts, plus 'crashed' for workers that died without a
+        result. Results are collected while waiting, since a worker cannot
+        exit before the queue has taken its result.
+        """
+        outcomes = {}
+        running = list(self._processes)
+        while running:
+            self._collect(outcomes, timeout=0.5)
+            if self._stop_deadline is not None and time.monotonic() > self._stop_deadline:
+                for process in running:
+                    if process.is_alive():
+                        logging.warning(f"{process.name} did not stop in time, terminating it")
+                        process.terminate()
+                self._stop_deadline = float('inf')
+            running = [process for process in running if process.is_alive()]
+        for process in self._processes:
+            process.join()
+        self._collect(outcomes, timeout=1, until=len(self._processes))
+
+        totals = {'sent': 0, 'failed': 0, 'skipped': 0, 'crashed': 0}
+        for outcome in outcomes.values():
+            for key in ('sent', 'failed', 'skipped'):
+                totals[key] += outcome.get(key, 0)
+            if 'error' in outcome:
+                totals['crashed'] += 1
+        totals['crashed'] += len(self._processes) - len(outcomes)
+        return totals
+
+    def _collect(self, outcomes, timeout, until=None):
+        # Takes every result that arrives within timeout (or until until have)
+        while until is None or len(outcomes) < until:
+            try:
+                index, outcome = self._results.get(timeout=timeout)
+            except queue.Empty:
+                return
+            outcomes[index] = outcome
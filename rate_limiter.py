@@ -0,0 +1,362 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import datetime
+import threading
+import smtplib
+import logging
+from collections import deque
+
+if getattr(sys, 'frozen', False):
+    APP_PATH = os.path.dirname(sys.executable)
+else:
+    APP_PATH = os.path.dirname(os.path.abspath(__file__))
+
+QUOTA_FILE = os.path.join(APP_PATH, 'quota_state.db')
+# Where daily counts were kept before, read once when QUOTA_FILE is created
+LEGACY_QUOTA_FILE = os.path.join(APP_PATH, 'quota_state.json')
+
+# Per-minute limits that are split between worker processes. Daily quotas
+# are not: every process counts against the same QUOTA_FILE
+SHARED_LIMITS = ('messages_per_minute', 'recipients_per_minute')
+
+_QUOTA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    profile TEXT NOT NULL,
+    day TEXT NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    recipients INTEGER NOT NULL DEFAULT 0,
+    exhausted INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (profile, day)
+);
+"""
+
+
+def share_limits(settings, index, count):
+    """
+    Splits the per-minute limits in RateLimiter settings evenly between
+    count worker processes, so together they stay within what is configured
+    for one sender. Daily quotas need no split, since all processes share
+    one count.
+    """
+    settings = dict(settings)
+    for key in SHARED_LIMITS:
+        if settings[key]:
+            settings[key] = settings[key] / count
+    return settings
+
+# Replies providers use to push back on the sending rate. 450-452 usually
+# mean a busy mailbox or a local problem, so they only count as throttling
+# with an enhanced status code of class 4.7 (e.g. "451 4.7.1 Try again later")
+THROTTLE_CODES = (421, 454)
+_THROTTLE_STATUS_RE = re.compile(rb'^\s*4\.7\.\d{1,3}\b')
+# Words in a 5xx reply meaning "daily sending limit reached", e.g. Gmail's
+# "550 5.4.5 Daily user sending limit exceeded"
+QUOTA_REPLY_MARKERS = (b'quota', b'sending limit', b'limit exceeded')
+
+# How far the rate drops when the server throttles, and how quickly it
+# recovers with each message that goes through (about 14 messages to undo
+# one halving)
+THROTTLE_FACTOR = 0.5
+RECOVERY_FACTOR = 1.05
+MIN_RATE_FACTOR = 0.05
+
+# Span over which the achieved rate is measured when a limit is derived
+RATE_WINDOW_SECONDS = 60.0
+
+EXHAUSTED_MODES = ('wait', 'stop')
+
+
+def replies(error):
+    """
+    (code, message) SMTP replies carried by an exception, including
+    per-recipient ones.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return list(error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return [(error.smtp_code, error.smtp_error)]
+    return []
+
+
+def reply_codes(error):
+    """
+    SMTP reply codes carried by an exception, including per-recipient ones.
+    """
+    return [code for code, _ in replies(error)]
+
+
+def is_throttle_error(error):
+    return any(code in THROTTLE_CODES
+               or (400 <= code < 500 and isinstance(message, bytes) and _THROTTLE_STATUS_RE.match(message))
+               for code, message in replies(error))
+
+
+def is_quota_error(error):
+    return any(code >= 500 and isinstance(message, bytes)
+               and any(marker in message.lower() for marker in QUOTA_REPLY_MARKERS)
+               for code, message in replies(error))
+
+
+class QuotaExceeded(Exception):
+    """
+    The profile's daily quota is used up until resume_at.
+    """
+    def __init__(self, profile, resume_at):
+        super().__init__(f"Daily sending quota of profile '{profile}' reached.")
+        self.profile = profile
+        self.resume_at = resume_at
+
+
+class TokenBucket:
+    """
+    Allows rate units per second on average, with bursts of up to capacity.
+    reserve() always succeeds and returns how long the caller has to wait,
+    so callers queue up in the order they asked.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount=1):
+        self._refill()
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount=1):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class DailyQuota:
+    """
+    Messages and recipients sent today by each profile, kept in SQLite so
+    the count survives restarts and is shared by every process sending with
+    the same configuration: GUI and CLI runs and outbox workers alike.
+    Counts reset at local midnight.
+    """
+    def __init__(self, path=None):
+        self.path = path or QUOTA_FILE
+        created = not os.path.exists(self.path)
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_QUOTA_SCHEMA)
+        if created:
+            self._import_legacy()
+
+    def usage(self, profile):
+        row = self._conn.execute("SELECT messages, recipients, exhausted FROM usage WHERE profile = ? AND day = ?",
+                                 (profile, _today())).fetchone()
+        messages, recipients, exhausted = row or (0, 0, 0)
+        return {'messages': messages, 'recipients': recipients, 'exhausted': bool(exhausted)}
+
+    def claim(self, profile, messages, recipients, messages_per_day=0, recipients_per_day=0):
+        """
+        Counts messages to recipients against today's quota, unless that
+        would go over a limit (0 = none) or the quota was marked used up.
+        Returns False, counting nothing, in that case. The check and the
+        count are one transaction, so processes cannot overshoot together.
+        """
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            usage = self.usage(profile)
+            if (usage['exhausted']
+                    or (messages_per_day and usage['messages'] + messages > messages_per_day)
+                    or (recipients_per_day and usage['recipients'] + recipients > recipients_per_day)):
+                return False
+            self._add(profile, messages, recipients)
+        return True
+
+    def add(self, profile, messages, recipients):
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._add(profile, messages, recipients)
+
+    def mark_exhausted(self, profile):
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO usage (profile, day, exhausted) VALUES (?, ?, 1) "
+                "ON CONFLICT (profile, day) DO UPDATE SET exhausted = 1", (profile, _today()))
+
+    def close(self):
+        self._conn.close()
+
+    def _add(self, profile, messages, recipients):
+        self._conn.execute(
+            "INSERT INTO usage (profile, day, messages, recipients) VALUES (?, ?, MAX(0, ?), MAX(0, ?)) "
+            "ON CONFLICT (profile, day) DO UPDATE SET messages = MAX(0, messages + ?), "
+            "recipients = MAX(0, recipients + ?)", (profile, _today(), messages, recipients, messages, recipients))
+
+    def _import_legacy(self):
+        # Today's counts from quota_state.json, so upgrading mid-day does
+        # not reset the quota
+        try:
+            with open(LEGACY_QUOTA_FILE, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read quota state from {LEGACY_QUOTA_FILE}: {e}")
+            return
+        today = _today()
+        with self._conn:
+            for profile, entry in state.items():
+                if isinstance(entry, dict) and entry.get('date') == today:
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO usage (profile, day, messages, recipients, exhausted) "
+                        "VALUES (?, ?, ?, ?, ?)", (profile, today, int(entry.get('messages', 0)),
+                                                   int(entry.get('recipients', 0)), int(bool(entry.get('exhausted')))))
+
+
+def _today():
+    return datetime.date.today().isoformat()
+
+
+class RateLimiter:
+    """
+    Paces sending for one SMTP profile: token buckets for messages and
+    recipients per minute, plus daily quotas that persist across runs and
+    are shared with every other process sending as the profile. When
+    the server throttles, the rate is halved and then recovers by a few
+    percent with each message that goes through. A limit of 0 means
+    unlimited; with no per-minute limit configured, the first throttling
+    reply caps the rate at half of what was achieved over the last minute
+    (or since sending started, if that is shorter).
+    """
+    def __init__(self, profile='default', messages_per_minute=0, recipients_per_minute=0,
+                 messages_per_day=0, recipients_per_day=0, burst=5, when_exhausted='wait',
+                 quota=None):
+        if when_exhausted not in EXHAUSTED_MODES:
+            raise ValueError(f"Unknown quota mode '{when_exhausted}', expected one of {EXHAUSTED_MODES}.")
+        self.profile = profile
+        self.messages_per_minute = messages_per_minute
+        self.recipients_per_minute = recipients_per_minute
+        self.messages_per_day = messages_per_day
+        self.recipients_per_day = recipients_per_day
+        self.burst = burst
+        self.when_exhausted = when_exhausted
+        self.quota = quota if quota is not None else (DailyQuota() if messages_per_day or recipients_per_day else None)
+
+        self._lock = threading.Lock()
+        self._rate_factor = 1.0
+        self._paused_until = 0.0
+        self._recent = deque()
+        self._first_reserved = None
+        self._messages = self._bucket(messages_per_minute)
+        self._recipients = self._bucket(recipients_per_minute)
+
+    def _bucket(self, per_minute):
+        return TokenBucket(per_minute / 60.0, self.burst) if per_minute else None
+
+    @property
+    def enabled(self):
+        return bool(self._messages or self._recipients or self.quota)
+
+    def reserve(self, recipients=1):
+        """
+        Claims room for one message to recipients recipients. Returns the
+        number of seconds to wait before sending it, or raises QuotaExceeded
+        if today's quota is used up.
+        """
+        with self._lock:
+            if self.quota and not self.quota.claim(self.profile, 1, recipients,
+                                                   self.messages_per_day, self.recipients_per_day):
+                raise self._exceeded()
+            delay = max(0.0, self._paused_until - time.monotonic())
+            if self._messages:
+                delay = max(delay, self._messages.reserve(1))
+            if self._recipients:
+                delay = max(delay, self._recipients.reserve(recipients))
+            now = time.monotonic()
+            if self._first_reserved is None:
+                self._first_reserved = now
+            self._recent.append(now + delay)
+            while self._recent and self._recent[0] < now - RATE_WINDOW_SECONDS:
+                self._recent.popleft()
+            return delay
+
+    def refund(self, recipients=1):
+        """
+        Gives back a reservation for a message that was not accepted.
+        """
+        with self._lock:
+            if self._messages:
+                self._messages.refund(1)
+            if self._recipients:
+                self._recipients.refund(recipients)
+            if self.quota:
+                self.quota.add(self.profile, -1, -recipients)
+
+    def throttled(self, pause=0.0):
+        """
+        The server pushed back: halve the sending rate and hold everyone back
+        for pause seconds.
+        """
+        with self._lock:
+            if not self._messages:
+                # No configured limit yet: start from the rate the server just
+                # refused, measured over the window (or the time spent sending)
+                now = time.monotonic()
+                sending_for = now - self._first_reserved if self._first_reserved is not None else 0.0
+                window = min(RATE_WINDOW_SECONDS, max(1.0, sending_for))
+                recent = sum(1 for reserved in self._recent if reserved >= now - window)
+                self.messages_per_minute = max(1.0, recent * 60.0 / window)
+                self._messages = self._bucket(self.messages_per_minute)
+                self._messages.tokens = 0
+            self._rate_factor = max(MIN_RATE_FACTOR, self._rate_factor * THROTTLE_FACTOR)
+            self._apply_factor()
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        logging.warning(f"Profile '{self.profile}' throttled by the server, "
+                        f"slowing down to {self.messages_per_minute * self._rate_factor:.1f} messages/minute")
+
+    def succeeded(self):
+        with self._lock:
+            if self._rate_factor < 1.0:
+                self._rate_factor = min(1.0, self._rate_factor * RECOVERY_FACTOR)
+                self._apply_factor()
+
+    def exhausted(self):
+        """
+        The server says the daily quota is used up, whatever our count says.
+        """
+        with self._lock:
+            if self.quota is None:
+                self.quota = DailyQuota()
+            self.quota.mark_exhausted(self.profile)
+
+    def quota_reached(self):
+        """
+        True if today's quota is used up, without reserving anything.
+        """
+        with self._lock:
+            if not self.quota:
+                return False
+            usage = self.quota.usage(self.profile)
+            return (usage['exhausted']
+                    or bool(self.messages_per_day and usage['messages'] + 1 > self.messages_per_day)
+                    or bool(self.recipients_per_day and usage['recipients'] + 1 > self.recipients_per_day))
+
+    def close(self):
+        if self.quota:
+            with self._lock:
+                self.quota.close()
+
+    def _apply_factor(self):
+        if self._messages:
+            self._messages.rate = self.messages_per_minute / 60.0 * self._rate_factor
+        if self._recipients:
+            self._recipients.rate = self.recipients_per_minute / 60.0 * self._rate_factor
+
+    def _exceeded(self):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        return QuotaExceeded(self.profile, datetime.datetime.combine(tomorrow, datetime.time()))
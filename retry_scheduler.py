@@ -0,0 +1,154 @@
+import os
+import ssl
+import time
+import errno
+import socket
+import heapq
+import random
+import smtplib
+import itertools
+import threading
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+
+# Network conditions that usually clear up by themselves; other OSErrors,
+# such as a missing or unreadable file, will fail the same way next time
+TRANSIENT_ERRNOS = {getattr(errno, name) for name in ('ETIMEDOUT', 'ENETDOWN', 'ENETUNREACH', 'ENETRESET',
+                                                      'EHOSTDOWN', 'EHOSTUNREACH') if hasattr(errno, name)}
+
+
+def is_transient_error(error):
+    """
+    True if a failed SMTP delivery may succeed when tried again later:
+    4xx replies, dropped or refused connections, network timeouts and
+    unreachable networks. 5xx replies, authentication and certificate
+    problems, and local errors such as an unreadable file are permanent.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, ssl.SSLCertVerificationError):
+        return False
+    if isinstance(error, (ConnectionError, socket.timeout, ssl.SSLEOFError, ssl.SSLZeroReturnError)):
+        return True
+    if isinstance(error, socket.gaierror):
+        # A failed DNS lookup is worth retrying, an unknown host is not
+        return error.errno == socket.EAI_AGAIN
+    return isinstance(error, OSError) and error.errno in TRANSIENT_ERRNOS
+
+
+class RetryPolicy:
+    """
+    How many times a transient failure is retried, and how long to wait
+    before each attempt: exponential backoff from base_delay, capped at
+    max_delay, with jitter so files that failed together do not all come
+    back at the same moment.
+    """
+    def __init__(self, max_attempts=3, base_delay=5.0, max_delay=300.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, error, attempts):
+        return attempts < self.max_attempts and is_transient_error(error)
+
+    def backoff(self, attempts):
+        """
+        Seconds to wait after the given number of failed attempts.
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(ceiling / 2, ceiling)
+
+
+@dataclass
+class Delivery:
+    """
+    One file, or several bundled together, on its way out. The built
+    messages are kept between attempts so a retry only repeats the SMTP
+    stage; a file split into parts resumes from the first part not yet
+    delivered.
+    """
+    files: List[str]
+    recipient: str = ''
+    # Mail merge: rendered subject and body, None for the defaults
+    subject: Optional[str] = None
+    body: Optional[str] = None
+    messages: Optional[List[Any]] = None
+    sent_parts: int = 0
+    attempts: int = 0
+    last_error: Optional[BaseException] = None
+    # Future for the gzip copy, when the file is being compressed
+    compression: Optional[Any] = None
+    temp_path: Optional[str] = None
+    # Bytes of the file per message, when it has to be split
+    split_bytes: int = 0
+    # SMTP profile the messages were built for, and the last one that failed
+    relay: Optional[str] = None
+    failed_relay: Optional[str] = None
+    # Delivered files go to SENTEMAILS unless False (mail merge rows)
+    move_sent: bool = True
+    # The outbox job this delivery came from, settled once it is done
+    job: Optional[Any] = None
+    # Set once, so every attempt and relay sends the same Message-ID
+    message_id: Optional[str] = None
+
+    @property
+    def is_bundle(self):
+        return len(self.files) > 1
+
+    @property
+    def label(self):
+        name = os.path.basename(self.files[0])
+        if self.is_bundle:
+            return f"{name} and {len(self.files) - 1} more file(s)"
+        return name
+
+
+class RetryQueue:
+    """
+    Deliveries waiting for another attempt, ordered by when they are due.
+    Safe to use from several threads.
+    """
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, delivery, delay):
+        with self._lock:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._order), delivery))
+
+    def pop_ready(self):
+        """
+        Returns the next delivery that is due, or None.
+        """
+        with self._lock:
+            if self._heap and self._heap[0][0] <= time.monotonic():
+                return heapq.heappop(self._heap)[2]
+            return None
+
+    def seconds_until_ready(self):
+        """
+        Time until the next delivery is due, or None if the queue is empty.
+        """
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def drain(self):
+        """
+        Removes and returns every queued delivery.
+        """
+        with self._lock:
+            deliveries = [entry[2] for entry in sorted(self._heap)]
+            self._heap = []
+        return deliveries
@@ -0,0 +1,90 @@
+import os
+import fnmatch
+
+SCHEDULE_POLICIES = ('fifo', 'smallest', 'oldest', 'newest', 'priority')
+
+
+def _matches(pattern, rel_path, name):
+    # Like the [SCAN] patterns: with a slash, matched against the path
+    # relative to the scanned folder, otherwise against the name alone
+    return fnmatch.fnmatch(rel_path if '/' in pattern else name, pattern)
+
+
+def _common_folder(paths):
+    try:
+        return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else None
+    except ValueError:
+        return None  # On different drives
+
+
+class SendScheduler:
+    """
+    Decides the order in which the files of a batch are sent. policy is one
+    of SCHEDULE_POLICIES: fifo keeps the listed order, smallest sends small
+    files first, oldest and newest go by modification time, and priority
+    sends files matching priority_patterns first, in pattern order. With
+    large_file_bytes, files of that size and more are put in a lane of their
+    own, so a few big attachments cannot hold up the small ones. Patterns
+    with a slash are matched against the path relative to root, the folder
+    the files were listed from; without root, their common folder is used.
+    """
+    def __init__(self, policy='fifo', priority_patterns=(), large_file_bytes=0, root=None):
+        if policy not in SCHEDULE_POLICIES:
+            raise ValueError(f"Unknown schedule policy '{policy}', expected one of {SCHEDULE_POLICIES}.")
+        self.policy = policy
+        self.priority_patterns = tuple(priority_patterns)
+        self.large_file_bytes = large_file_bytes
+        self.root = root
+
+    @property
+    def reorders(self):
+        return self.policy != 'fifo' or bool(self.large_file_bytes)
+
+    def plan(self, items, path_of, lanes=True):
+        """
+        Returns (lanes, sizes): the items in sending order, as [small, large]
+        when lanes are on and large_file_bytes is set, else as a single
+        list; and the size in bytes of every file, keyed by path. path_of
+        gives the file of an item. Files that cannot be read count as empty
+        and are reported when their message is built.
+        """
+        stats = {}
+        for item in items:
+            path = path_of(item)
+            if path not in stats:
+                try:
+                    stats[path] = os.stat(path)
+                except OSError:
+                    stats[path] = None
+        sizes = {path: stat.st_size if stat else 0 for path, stat in stats.items()}
+
+        ordered = list(items)
+        if self.policy != 'fifo':
+            root = self.root if self.root is not None else _common_folder(stats)
+            # sorted() is stable, so ties keep the listed order
+            ordered.sort(key=lambda item: self._sort_key(path_of(item), stats[path_of(item)], root))
+        if not (lanes and self.large_file_bytes):
+            return [ordered], sizes
+        small = [item for item in ordered if sizes[path_of(item)] < self.large_file_bytes]
+        large = [item for item in ordered if sizes[path_of(item)] >= self.large_file_bytes]
+        return [small, large], sizes
+
+    def _sort_key(self, path, stat, root):
+        if self.policy == 'smallest':
+            return stat.st_size if stat else 0
+        if self.policy == 'oldest':
+            return stat.st_mtime if stat else 0
+        if self.policy == 'newest':
+            return -stat.st_mtime if stat else 0
+        name = os.path.basename(path)
+        rel_path = path
+        if root:
+            try:
+                rel_path = os.path.relpath(path, root)
+            except ValueError:
+                pass  # On another drive
+        rel_path = rel_path.replace(os.sep, '/')
+        for rank, pattern in enumerate(self.priority_patterns):
+            if _matches(pattern, rel_path, name):
+                return rank
+        return len(self.priority_patterns)
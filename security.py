@@ -1,5 +1,6 @@
 import os
 import sys
+import threading
 from cryptography.fernet import Fernet
 
 if getattr(sys, 'frozen', False):
@@ -9,15 +10,25 @@ else:
 
 KEY_FILE = os.path.join(APP_PATH, 'secret.key')
 
+# The key and its Fernet instance are kept in memory after the first use so
+# encrypting/decrypting does not hit the disk every time.
+_key_lock = threading.Lock()
+_cached_key = None
+_cached_fernet = None
+
 def load_key():
     """
     Load the previously generated key. If not exists, generate one.
     """
-    if not os.path.exists(KEY_FILE):
-        generate_key()
-    
-    with open(KEY_FILE, 'rb') as key_file:
-        return key_file.read()
+    global _cached_key
+    with _key_lock:
+        if _cached_key is None:
+            if not os.path.exists(KEY_FILE):
+                generate_key()
+
+            with open(KEY_FILE, 'rb') as key_file:
+                _cached_key = key_file.read()
+        return _cached_key
 
 def generate_key():
     """
@@ -26,13 +37,29 @@ def generate_key():
     key = Fernet.generate_key()
     with open(KEY_FILE, 'wb') as key_file:
         key_file.write(key)
+    clear_key_cache()
+
+def clear_key_cache():
+    """
+    Forgets the in-memory key so the next use reads secret.key again.
+    """
+    global _cached_key, _cached_fernet
+    _cached_key = None
+    _cached_fernet = None
+
+def _get_fernet():
+    global _cached_fernet
+    key = load_key()
+    fernet = _cached_fernet
+    if fernet is None:
+        fernet = _cached_fernet = Fernet(key)
+    return fernet
 
 def encrypt_password(password: str) -> str:
     """
     Encrypts a password using the loaded key.
     """
-    key = load_key()
-    f = Fernet(key)
+    f = _get_fernet()
     encrypted_password = f.encrypt(password.encode())
     return encrypted_password.decode()
 
@@ -43,8 +70,7 @@ def decrypt_password(encrypted_password: str) -> str:
     if not encrypted_password:
         return ""
     try:
-        key = load_key()
-        f = Fernet(key)
+        f = _get_fernet()
         decrypted_password = f.decrypt(encrypted_password.encode())
         return decrypted_password.decode()
     except Exception as e:
@@ -0,0 +1,362 @@
+import smtplib
+import socket
+import threading
+import time
+import itertools
+import logging
+from streaming_mime import StreamingMessage
+from metrics import registry
+
+# A session idle for longer than this is probed with NOOP before reuse.
+# Sessions used more recently are trusted as-is; a stale socket is caught
+# by the reconnect logic in the caller instead.
+NOOP_AFTER_IDLE_SECONDS = 30
+
+# Reply codes meaning "this connection is done, open a new one".
+RECONNECT_CODES = (421,)
+
+# BDAT chunks sent ahead of their replies when the server allows PIPELINING.
+BDAT_WINDOW = 8
+
+_session_ids = itertools.count(1)
+
+
+class MessageTooLargeError(smtplib.SMTPResponseException):
+    """
+    Raised before sending a message larger than the server's announced SIZE
+    limit, instead of uploading it only to have it rejected. Carries the
+    552 reply a server would give, so it is treated as a permanent failure.
+    """
+    def __init__(self, size, limit):
+        super().__init__(552, f"Message of {size} bytes exceeds the server's limit of {limit} bytes".encode())
+        self.size = size
+        self.limit = limit
+
+
+def message_size(message, binary=False):
+    """
+    Size of a message on the wire, as text or StreamingMessage (sent in
+    binary or base64).
+    """
+    if isinstance(message, StreamingMessage):
+        return message.size(binary)
+    return len(message)
+
+
+def is_connection_error(exc):
+    """
+    Returns True if the exception means the session is unusable and the
+    message should be retried on a fresh connection.
+    """
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code in RECONNECT_CODES:
+        return True
+    return False
+
+
+class SMTPSession:
+    """
+    A single authenticated SMTP connection that can carry many messages.
+    """
+    def __init__(self, server, port, email, password, use_tls=True, use_ssl=False,
+                 max_messages=0, timeout=60, binary_mime=True):
+        self.server = server
+        self.port = port
+        self.email = email
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.binary_mime = binary_mime
+
+        self.session_id = next(_session_ids)
+        self.smtp = None
+        self.messages_sent = 0
+        self.last_used = 0.0
+
+    def connect(self):
+        logging.debug(f"[session {self.session_id}] Connecting to SMTP server: "
+                      f"{self.server}:{self.port} (SSL: {self.use_ssl}, TLS: {self.use_tls})")
+
+        # Connecting runs up to the first EHLO reply (and the TLS handshake with SSL)
+        start = time.perf_counter()
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.server, self.port, timeout=self.timeout)
+        else:
+            smtp = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+
+        try:
+            # Streamed messages go out in several writes before the reply is
+            # read; with Nagle on, each would wait for the server's delayed ACK.
+            # asyncio connections already disable it.
+            smtp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            smtp.set_debuglevel(1 if logging.getLogger().getEffectiveLevel() == logging.DEBUG else 0)
+
+            code, response = smtp.ehlo()
+            registry.observe('connect', time.perf_counter() - start)
+            logging.debug(f"EHLO response: {code} {response}")
+
+            if self.use_tls and not self.use_ssl:
+                logging.debug("Starting TLS...")
+                with registry.timer('tls'):
+                    smtp.starttls()
+                    code, response = smtp.ehlo() # Re-identify after TLS
+                logging.debug(f"EHLO (after TLS) response: {code} {response}")
+
+            logging.debug(f"Logging in as {self.email}...")
+            with registry.timer('auth'):
+                smtp.login(self.email, self.password)
+        except Exception:
+            self._close_quietly(smtp)
+            raise
+
+        self.smtp = smtp
+        self.last_used = time.monotonic()
+        registry.count('connections')
+
+    @property
+    def exhausted(self):
+        return bool(self.max_messages) and self.messages_sent >= self.max_messages
+
+    @property
+    def max_message_size(self):
+        """
+        Largest message the server accepts, from the EHLO SIZE extension,
+        or 0 if it does not announce a limit.
+        """
+        if self.smtp is None:
+            return 0
+        size = self.smtp.esmtp_features.get('size', '').strip()
+        return int(size) if size.isdigit() else 0
+
+    @property
+    def supports_binary_mime(self):
+        """
+        True if streamed attachments go out unencoded: the server announced
+        both BINARYMIME and CHUNKING (RFC 3030) and binary_mime is on.
+        """
+        return (self.binary_mime and self.smtp is not None
+                and self.smtp.has_extn('binarymime') and self.smtp.has_extn('chunking'))
+
+    def is_alive(self):
+        """
+        Cheap liveness check: the socket must still be open, and only sessions
+        that sat idle for a while pay for a NOOP round-trip.
+        """
+        if self.smtp is None or self.smtp.sock is None:
+            return False
+        if time.monotonic() - self.last_used < NOOP_AFTER_IDLE_SECONDS:
+            return True
+        try:
+            code, response = self.smtp.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        if code != 250:
+            logging.debug(f"[session {self.session_id}] NOOP check failed: {code} {response}")
+            return False
+        self.last_used = time.monotonic()
+        return True
+
+    def sendmail(self, from_addr, recipients, msg):
+        """
+        Sends one message over this session. Returns the dict of refused
+        recipients, like smtplib.SMTP.sendmail.
+        """
+        if self.smtp is None:
+            self.connect()
+        binary = isinstance(msg, StreamingMessage) and self.supports_binary_mime
+        size = message_size(msg, binary)
+        limit = self.max_message_size
+        if limit and size > limit:
+            raise MessageTooLargeError(size, limit)
+        with registry.timer('data'):
+            if isinstance(msg, StreamingMessage):
+                failed_recipients = self._send_stream(from_addr, recipients, msg, binary)
+            else:
+                failed_recipients = self.smtp.sendmail(from_addr, recipients, msg)
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+        registry.count('messages_sent')
+        registry.count('bytes_sent', size)
+        if binary:
+            registry.count('binary_messages')
+        return failed_recipients
+
+    def _send_stream(self, from_addr, recipients, message, binary=False):
+        """
+        Same envelope handling as smtplib.SMTP.sendmail, but the message body
+        is written to the socket chunk by chunk as it is encoded, or with
+        binary, sent unencoded in BDAT chunks.
+        """
+        smtp = self.smtp
+        mail_options = []
+        if smtp.has_extn('size'):
+            mail_options.append(f"size={message.size(binary)}")
+        if binary:
+            mail_options.append("BODY=BINARYMIME")
+
+        code, response = smtp.mail(from_addr, mail_options)
+        if code != 250:
+            self._abandon_transaction(code)
+            raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+        refused = {}
+        for addr in recipients:
+            code, response = smtp.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, response)
+            if code == 421:
+                self._abandon_transaction(code)
+                raise smtplib.SMTPRecipientsRefused(refused)
+        if len(refused) == len(recipients):
+            self._abandon_transaction(code)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        if binary:
+            code, response = self._send_bdat(message)
+        else:
+            code, response = smtp.docmd("data")
+            if code != 354:
+                self._abandon_transaction(code)
+                raise smtplib.SMTPDataError(code, response)
+
+            for chunk in message.iter_chunks():
+                smtp.send(chunk)
+            smtp.send(b".\r\n")
+            code, response = smtp.getreply()
+
+        if code != 250:
+            self._abandon_transaction(code)
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def _send_bdat(self, message):
+        """
+        Sends the message in binary as BDAT chunks, ended by an empty
+        BDAT 0 LAST. With PIPELINING, up to BDAT_WINDOW chunks are written
+        before their replies are read. Returns the first failed reply, or
+        the reply to LAST.
+        """
+        smtp = self.smtp
+        window = BDAT_WINDOW if smtp.has_extn('pipelining') else 1
+        pending = 0
+        failure = None
+        for chunk in message.iter_chunks(binary=True):
+            smtp.send(f"BDAT {len(chunk)}\r\n".encode('ascii'))
+            smtp.send(chunk)
+            pending += 1
+            if pending >= window:
+                code, response = smtp.getreply()
+                pending -= 1
+                if code != 250:
+                    failure = (code, response)
+                    break
+        if failure is None:
+            smtp.send(b"BDAT 0 LAST\r\n")
+            pending += 1
+        # Replies to chunks already written still have to be read, unless
+        # the server is closing the connection
+        reply = None
+        while pending and not (failure and failure[0] == 421):
+            reply = smtp.getreply()
+            pending -= 1
+            if failure is None and reply[0] != 250:
+                failure = reply
+        return failure or reply
+
+    def _abandon_transaction(self, code):
+        if code == 421:
+            self.close()
+            return
+        try:
+            self.smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    def close(self):
+        if self.smtp is not None:
+            self._close_quietly(self.smtp)
+            self.smtp = None
+
+    @staticmethod
+    def _close_quietly(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """
+    Keeps authenticated SMTP sessions open across messages. Sessions are
+    handed out by acquire() and must be given back with release().
+    """
+    def __init__(self, session_factory, max_size=1):
+        self.session_factory = session_factory
+        self.max_size = max(1, int(max_size))
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._closed_stats = []
+
+    def acquire(self):
+        """
+        Returns a live, logged-in session, reusing an idle one when possible.
+        Blocks while max_size sessions are already checked out.
+        """
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    session = self._idle.pop() if self._idle else None
+                if session is None:
+                    break
+                if not session.exhausted and session.is_alive():
+                    return session
+                self._retire(session)
+
+            session = self.session_factory()
+            session.connect()
+            return session
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, session, discard=False):
+        """
+        Returns a session to the pool. Sessions that are broken, or that hit
+        the per-connection message cap, are closed instead of reused.
+        """
+        try:
+            if discard or session.exhausted or session.smtp is None:
+                self._retire(session)
+            else:
+                with self._lock:
+                    self._idle.append(session)
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            self._retire(session)
+
+    def connection_stats(self):
+        """
+        Returns (session_id, messages_sent) for every session closed so far.
+        """
+        with self._lock:
+            return list(self._closed_stats)
+
+    def _retire(self, session):
+        session.close()
+        with self._lock:
+            self._closed_stats.append((session.session_id, session.messages_sent))
+        logging.info(f"Closed SMTP session {session.session_id} after "
+                     f"{session.messages_sent} message(s)")
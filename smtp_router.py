@@ -0,0 +1,188 @@
+import ssl
+import time
+import smtplib
+import logging
+import threading
+from rate_limiter import QuotaExceeded, is_throttle_error, is_quota_error
+from retry_scheduler import is_transient_error
+from smtp_pool import is_connection_error
+
+
+def is_relay_error(error):
+    """
+    True if the error says more about the relay than about the message:
+    the relay is unreachable, refuses our credentials, throttles us or has
+    used up its quota. Another relay may well accept the same message.
+    """
+    if isinstance(error, (QuotaExceeded, smtplib.SMTPAuthenticationError, ssl.SSLError)):
+        return True
+    if is_connection_error(error) or is_throttle_error(error) or is_quota_error(error):
+        return True
+    if isinstance(error, (smtplib.SMTPResponseException, FileNotFoundError, PermissionError, InterruptedError)):
+        return False
+    return isinstance(error, OSError)
+
+
+class Relay:
+    """
+    One SMTP profile as seen by the router: its sender, rate limiter and
+    health. A relay is taken out of rotation until down_until after a
+    relay error, or after failure_threshold failures in a row.
+    """
+    def __init__(self, settings, sender, limiter):
+        self.settings = settings
+        self.sender = sender
+        self.limiter = limiter
+        self.outstanding = 0
+        self.sent = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self.last_error = None
+        # Announced by the server (EHLO SIZE), 0 if none or not known yet
+        self.size_limit = 0
+        # Smooth weighted round-robin state
+        self.current_weight = 0.0
+
+    @property
+    def name(self):
+        return self.settings.name
+
+    @property
+    def capacity(self):
+        return self.settings.max_connections
+
+    def is_up(self, now=None):
+        return self.down_until <= (time.monotonic() if now is None else now)
+
+    def health(self):
+        return {
+            'profile': self.name,
+            'server': self.settings.server,
+            'healthy': self.is_up(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'outstanding': self.outstanding,
+            'last_error': str(self.last_error) if self.last_error else None,
+        }
+
+
+class SMTPRouter:
+    """
+    Spreads messages over several relays, either in proportion to their
+    weight or to whichever has the fewest messages in flight for its number
+    of connections, and steers around relays that are down, throttling or
+    out of quota. Safe to use from several threads.
+    """
+    def __init__(self, relays, strategy='weighted', failure_threshold=3, cooldown=60.0):
+        if not relays:
+            raise ValueError("At least one SMTP profile is required.")
+        self.relays = relays
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.relays)
+
+    def choose(self, exclude=None):
+        """
+        Picks the relay for the next message and counts it as outstanding
+        until finished() is called. exclude, a relay name, is avoided if any
+        other relay is available. When every relay is down, the one that
+        comes back first is used anyway.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [r for r in self.relays
+                          if r.is_up(now) and not r.limiter.quota_reached() and r.name != exclude]
+            if not candidates:
+                candidates = [r for r in self.relays if r.is_up(now) and not r.limiter.quota_reached()]
+            if not candidates:
+                candidates = [min(self.relays, key=lambda r: r.down_until)]
+            relay = self._pick(candidates)
+            relay.outstanding += 1
+            return relay
+
+    def _pick(self, candidates):
+        if self.strategy == 'least_outstanding':
+            # Relative to its connections, so nobody queues on a busy pool
+            return min(candidates, key=lambda r: r.outstanding / max(r.settings.weight, 0.01) / r.capacity)
+        total = sum(r.settings.weight for r in candidates)
+        if total <= 0:
+            return candidates[0]
+        for relay in candidates:
+            relay.current_weight += relay.settings.weight
+        relay = max(candidates, key=lambda r: r.current_weight)
+        relay.current_weight -= total
+        return relay
+
+    def has_alternative(self, relay):
+        """
+        True if a relay other than relay could take a message right now.
+        """
+        with self._lock:
+            now = time.monotonic()
+            return any(r is not relay and r.is_up(now) and not r.limiter.quota_reached()
+                       for r in self.relays)
+
+    def release(self, relay):
+        """
+        Hands back a relay from choose() without sending anything through it.
+        """
+        with self._lock:
+            relay.outstanding = max(0, relay.outstanding - 1)
+
+    def finished(self, relay, error=None, pause=0.0):
+        """
+        Records the outcome of a message sent through relay. Relay errors
+        take it out of rotation for the cooldown, or for pause seconds when
+        the server asked us to back off; other temporary errors only do so
+        after failure_threshold of them in a row. Permanent rejections of a
+        message say nothing about the relay.
+        """
+        with self._lock:
+            relay.outstanding = max(0, relay.outstanding - 1)
+            if error is None:
+                relay.sent += 1
+                relay.consecutive_failures = 0
+                return
+            relay.failed += 1
+            relay.last_error = error
+            if is_relay_error(error):
+                down_for = pause if is_throttle_error(error) and pause else self.cooldown
+            elif is_transient_error(error):
+                relay.consecutive_failures += 1
+                if relay.consecutive_failures < self.failure_threshold:
+                    return
+                down_for = self.cooldown
+            else:
+                return
+        self.mark_down(relay, error, down_for)
+
+    def mark_down(self, relay, error, down_for=None):
+        """
+        Takes relay out of rotation for down_for seconds (the cooldown by
+        default).
+        """
+        down_for = self.cooldown if down_for is None else down_for
+        with self._lock:
+            was_up = relay.is_up()
+            relay.last_error = error
+            relay.down_until = max(relay.down_until, time.monotonic() + down_for)
+        if was_up and len(self.relays) > 1:
+            logging.warning(f"SMTP profile '{relay.name}' ({relay.settings.server}) taken out of rotation "
+                            f"for {down_for:.0f}s: {error}")
+
+    def size_limit(self):
+        """
+        The smallest SIZE limit announced by any relay, so a message fits
+        whichever relay it fails over to. 0 if none announces one.
+        """
+        limits = [r.size_limit for r in self.relays if r.size_limit]
+        return min(limits) if limits else 0
+
+    def health(self):
+        with self._lock:
+            return [relay.health() for relay in self.relays]
@@ -0,0 +1,120 @@
+import os
+import re
+import mmap
+import base64
+import email.policy
+from email.mime.base import MIMEBase
+
+# base64 turns every 57 input bytes into one 76 character line. Reading in
+# multiples of 57 keeps line breaks identical to encoding the whole file.
+BASE64_LINE_BYTES = 57
+READ_CHUNK_BYTES = BASE64_LINE_BYTES * 16384  # ~0.9 MB per read
+
+_PLACEHOLDER = "@@STREAMED-ATTACHMENT-PAYLOAD@@"
+_DOT_RE = re.compile(rb'(?m)^\.')
+
+
+def base64_size(raw_size):
+    """
+    Size in bytes of raw_size bytes once base64-encoded into CRLF-terminated
+    76 character lines.
+    """
+    full_lines, remainder = divmod(raw_size, BASE64_LINE_BYTES)
+    size = full_lines * 78
+    if remainder:
+        size += (remainder + 2) // 3 * 4 + 2
+    return size
+
+
+def raw_size_within(encoded_size):
+    """
+    Largest number of bytes that stays within encoded_size once
+    base64-encoded (whole lines only).
+    """
+    return max(0, encoded_size // 78) * BASE64_LINE_BYTES
+
+
+class StreamingMessage:
+    """
+    A MIME message whose file attachment is base64-encoded chunk by chunk
+    while it is being sent, so memory use does not grow with the file size.
+    The headers and text parts are rendered up front by the email package;
+    only the attachment payload is streamed. For servers that take
+    BINARYMIME, the attachment can instead be sent as raw bytes
+    (binary=True), a third smaller than base64.
+
+    offset and length select a slice of the file, for sending a file that
+    is too large for the server in several parts.
+    """
+    def __init__(self, msg, file_path, filename, offset=0, length=None):
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(_PLACEHOLDER)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header(
+            "Content-Disposition",
+            f"attachment; filename= {filename}",
+        )
+        msg.attach(part)
+        self._msg = msg
+        self._part = part
+
+        head, tail = self._render()
+        # Headers and text parts are small and never contain the attachment,
+        # so dot-stuffing them here is cheap. base64 lines never start with '.'.
+        self.head = _DOT_RE.sub(b'..', head)
+        self.tail = _DOT_RE.sub(b'..', tail)
+        if not self.tail.endswith(b'\r\n'):
+            self.tail += b'\r\n'
+        self._binary_head = self._binary_tail = None
+
+        self.file_path = file_path
+        self.offset = offset
+        available = max(0, os.path.getsize(file_path) - offset)
+        self.file_size = available if length is None else min(length, available)
+
+    def _render(self):
+        rendered = self._msg.as_bytes(policy=email.policy.SMTP)
+        return rendered.split(_PLACEHOLDER.encode('ascii'))
+
+    def _binary_parts(self):
+        """
+        Head and tail around the raw attachment, rendered on first use. They
+        are sent with BDAT, so nothing is dot-stuffed.
+        """
+        if self._binary_head is None:
+            self._part.replace_header('Content-Transfer-Encoding', 'binary')
+            try:
+                head, tail = self._render()
+            finally:
+                self._part.replace_header('Content-Transfer-Encoding', 'base64')
+            self._binary_head, self._binary_tail = head, tail
+        return self._binary_head, self._binary_tail
+
+    def size(self, binary=False):
+        """
+        Exact number of bytes iter_chunks(binary) will produce.
+        """
+        if binary:
+            head, tail = self._binary_parts()
+            return len(head) + self.file_size + len(tail)
+        return len(self.head) + base64_size(self.file_size) + len(self.tail)
+
+    def iter_chunks(self, binary=False):
+        """
+        Yields the message as dot-stuffed, CRLF-terminated bytes ready to be
+        written after the DATA command (without the terminating '.'), or,
+        with binary, as BDAT chunks carrying the attachment unencoded.
+        """
+        head, tail = self._binary_parts() if binary else (self.head, self.tail)
+        yield head
+        with open(self.file_path, 'rb') as f:
+            end = min(self.offset + self.file_size, os.fstat(f.fileno()).st_size)
+            if end > self.offset:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for offset in range(self.offset, end, READ_CHUNK_BYTES):
+                        chunk = mapped[offset:min(offset + READ_CHUNK_BYTES, end)]
+                        if binary:
+                            yield chunk
+                        else:
+                            yield base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+        yield tail